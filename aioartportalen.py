@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+"""
+Python module for interacting with Artportalens API from asyncio programs. It has the same
+methods as the API classes in the module artportalen, but they are coroutines that use aiohttp,
+so they don't block the event loop. The search filters are the `artportalen.SearchFilter`.
+"""
+
+import time
+import json
+import asyncio
+import contextlib
+import aiohttp
+from apretry import API_KEY_HEADER, AdaptiveConcurrency, RequestExecutor, retry_after_seconds
+from apmetrics import PARSED, RequestRecord
+from artportalen import (API_ROOT_URL, API_MAX_TAKE, DEFAULT_POOL_SIZE, APIError, SearchFilter,
+                         auth_headers, search_params, page_records, merge_observations)
+
+# Constants
+DEFAULT_MAX_CONCURRENCY = 10  # Number of requests that may be in flight at the same time
+ADAPTIVE_POLL_INTERVAL = 0.01  # Seconds between checks of a full adaptive concurrency limit
+
+
+def new_session(pool_size: int = DEFAULT_POOL_SIZE):
+    """Returns a new aiohttp session with a pool of at most `pool_size` kept-alive connections
+       and gzip compressed responses. A session can be shared by several API instances. It must
+       be created when an event loop is running."""
+    connector = aiohttp.TCPConnector(limit=pool_size, limit_per_host=pool_size)
+    return aiohttp.ClientSession(connector=connector,
+                                 headers={'Accept-Encoding': 'gzip, deflate'})
+
+
+@contextlib.asynccontextmanager
+async def adaptive_slot(adaptive: AdaptiveConcurrency = None):
+    """Async context manager that waits, without blocking the event loop, until `adaptive`
+       allows another request, and holds its place for the request. Does nothing if `adaptive`
+       is None."""
+    if adaptive is None:
+        yield
+        return
+    while not adaptive.try_acquire():
+        await asyncio.sleep(ADAPTIVE_POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        adaptive.release()
+
+
+def query_params(params: dict):
+    """Returns `params` with the values converted to strings the way aiohttp wants them."""
+    return {k: str(v).lower() if isinstance(v, bool) else str(v) for k, v in params.items()}
+
+
+class AsyncSessionClient:
+    """Base class for the async API classes. Manages the aiohttp session and a semaphore that
+       bounds the number of concurrent requests. If no session is given a session of its own is
+       created on the first request, which is closed by `close()`. A given session is owned by
+       the caller and is left open. A semaphore can be shared by several API instances to bound
+       their requests together. Failed requests are retried, and requests rate limited and their
+       concurrency adapted to throttling, as the `apretry.RequestExecutor` `executor` says.
+       Instances are async context managers."""
+
+    def __init__(self, session: aiohttp.ClientSession = None,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 semaphore: asyncio.Semaphore = None,
+                 executor: RequestExecutor = None):
+        """Initialization."""
+        self.owns_session = session is None
+        self._session = session
+        self.semaphore = semaphore if semaphore is not None else asyncio.Semaphore(max_concurrency)
+        self.executor = executor if executor is not None else RequestExecutor()
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = new_session()
+        return self._session
+
+    async def close(self):
+        """Close the session, if this instance created it."""
+        if self.owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def request(self, method: str, url: str, verbose=False, **kwargs):
+        """Returns the tuple (status code, decoded JSON body or None) of an HTTP request. If the
+           executor has hooks (see the module apmetrics), they are called with a record of the
+           request."""
+        record = RequestRecord(method, url, self.executor.hooks) if self.executor.hooks else None
+        start = time.perf_counter()
+        api_key = (kwargs.get('headers') or {}).get(API_KEY_HEADER)
+        attempt = 0
+        while True:
+            while (wait := self.executor.paused(api_key)) > 0:
+                await asyncio.sleep(wait)
+            bucket = self.executor.bucket(api_key)
+            if bucket is not None:
+                await asyncio.sleep(bucket.reserve())
+            try:
+                async with self.semaphore, adaptive_slot(self.executor.adaptive):
+                    if verbose:
+                        print('%s %s' % (method, url))
+                    attempt_start = time.perf_counter()
+                    async with self.session.request(method, url, **kwargs) as r:
+                        if verbose:
+                            print('HTTP Status code: %s' % (r.status))
+                        if not self.executor.should_retry(r.status):
+                            self.executor.congestion(api_key, False)
+                        elif r.status == 429:
+                            self.executor.congestion(api_key, True)
+                        if r.ok or (not self.executor.should_retry(r.status)
+                                    or attempt >= self.executor.max_retries):
+                            headers_time = time.perf_counter()
+                            body = await r.read()
+                            read_time = time.perf_counter()
+                            value = json.loads(body) if r.ok and body else None
+                            if record is not None:
+                                record.attempts = attempt + 1
+                                record.status = r.status
+                                record.bytes = len(body)
+                                record.ttfb = headers_time - attempt_start
+                                record.download = read_time - headers_time
+                                record.seconds = read_time - start
+                                record.emit()
+                                if r.ok:
+                                    record.parse = time.perf_counter() - read_time
+                                    record.phase = PARSED
+                                    record.emit()
+                            return r.status, value
+                        delay = self.executor.retry_delay(attempt, r)
+                        if r.status == 429 and retry_after_seconds(r) is not None:
+                            self.executor.pause(api_key, delay)
+                            delay = 0
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.executor.max_retries:
+                    if record is not None:
+                        record.attempts = attempt + 1
+                        record.error = type(e).__name__
+                        record.seconds = time.perf_counter() - start
+                        record.emit()
+                    raise
+                delay = self.executor.retry_delay(attempt)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+class AsyncSpeciesAPI(AsyncSessionClient):
+    """Handles requests to Artportalens Artfakta - Species information API."""
+
+    def __init__(self, api_key: str, session: aiohttp.ClientSession = None,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 semaphore: asyncio.Semaphore = None,
+                 executor: RequestExecutor = None,
+                 root_url: str = API_ROOT_URL):
+        """Initialization. The client is responsible for managing secrets. `root_url` can be
+           set to use a stand-in server."""
+        super().__init__(session, max_concurrency, semaphore, executor)
+        self.key = api_key
+        self.url = root_url + "/information/v1/speciesdataservice/v1/"
+        self.search_url = self.url + "speciesdata"
+        self.headers = auth_headers(self.key)
+
+    async def taxa_by_name(self, name, exact_match=True, verbose=False):
+        """Returns list of all taxa that match the name."""
+        url = self.search_url + "/search"
+        status, taxa = await self.request('GET', url, params={"searchString": name},
+                                          headers=self.headers, verbose=verbose)
+        if taxa:
+            if not exact_match:
+                return taxa
+            for d in taxa:
+                if d['swedishName'] == name.lower():
+                    return [d]
+        return None
+
+    async def taxon_by_id(self, id, verbose=False):
+        """Returns the taxon with the given id."""
+        url = self.search_url + f"?taxa={id}"
+        status, taxon = await self.request('GET', url, headers=self.headers, verbose=verbose)
+        if not taxon:
+            return None
+        return taxon
+
+
+class AsyncObservationsAPI(AsyncSessionClient):
+    """Handles requests to Artportalens Species Observations Service API."""
+
+    DEFAULT_SORT_BY_ATTRIBUTE_FOR_OBSERVATIONS = 'event.startDate'
+
+    def __init__(self, api_key: str, session: aiohttp.ClientSession = None,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 semaphore: asyncio.Semaphore = None,
+                 executor: RequestExecutor = None,
+                 root_url: str = API_ROOT_URL):
+        """Initialization. The client is responsible for managing secrets. `root_url` can be
+           set to use a stand-in server."""
+        super().__init__(session, max_concurrency, semaphore, executor)
+        self.key = api_key
+        self.url = root_url + "/species-observation-system/v1/"
+        self.search_url = self.url + "Observations/Search"
+        self.headers = auth_headers(self.key)
+
+    async def version(self, verbose=False):
+        """Returns version of the API. This can be used to ping the API."""
+        status, v = await self.request('GET', self.url + "api/ApiInfo",
+                                       headers=self.headers, verbose=verbose)
+        return v
+
+    async def data_providers(self, verbose=False):
+        """Returns a list of data providers that have observations in the API."""
+        status, providers = await self.request('GET', self.url + "DataProviders",
+                                               headers=self.headers, verbose=verbose)
+        return providers
+
+    async def observations(self, search_filter: SearchFilter,
+                           skip: int = 0,
+                           take: int = 100,  # Maximum is 1000
+                           sortBy: str = DEFAULT_SORT_BY_ATTRIBUTE_FOR_OBSERVATIONS,
+                           sort_descending: bool = True,
+                           validateSearchFilter: bool = False,
+                           translationCultureCode: str = None,
+                           verbose=False):
+        """Returns `take` observations starting at `skip` + 1 according to the criteria in
+           the `search_filter` and the other request parameters, or None if the request fails."""
+        params = search_params(skip, take, sortBy, sort_descending,
+                               validateSearchFilter, translationCultureCode)
+        headers = self.headers | {"Content-Type": "application/json"}
+        status, page = await self.request('POST', self.search_url, params=query_params(params),
+                                          headers=headers, data=search_filter.json_string(),
+                                          verbose=verbose)
+        return page
+
+    async def iter_observations(self, search_filter: SearchFilter,
+                                page_size: int = API_MAX_TAKE,
+                                sortBy: str = DEFAULT_SORT_BY_ATTRIBUTE_FOR_OBSERVATIONS,
+                                sort_descending: bool = True,
+                                skip: int = 0,
+                                limit: int = None,
+                                verbose=False):
+        """Async generator of the observations matching `search_filter`, fetched page by page
+           with `page_size` observations per request. The next page is fetched in a task while
+           the current page is being consumed. At most `limit` observations are yielded if
+           `limit` is given. Raises APIError if a page request fails."""
+        assert 0 < page_size <= API_MAX_TAKE
+        if limit is not None and limit <= 0:
+            return
+
+        async def fetch(skip):
+            take = page_size if limit is None else min(page_size, limit - (skip - start))
+            page = await self.observations(search_filter, skip=skip, take=take, sortBy=sortBy,
+                                           sort_descending=sort_descending, verbose=verbose)
+            if page is None:
+                raise APIError(f"Observations search failed at skip={skip}")
+            return page
+
+        start = position = skip
+        task = asyncio.ensure_future(fetch(position))
+        try:
+            while task is not None:
+                page = await task
+                task = None
+                records = page_records(page)
+                position += len(records)
+                total = page.get("totalCount") if isinstance(page, dict) else None
+                more = len(records) == page_size and (total is None or position < total)
+                if limit is not None and position - start >= limit:
+                    more = False
+                if more:
+                    task = asyncio.ensure_future(fetch(position))
+                page = None
+                for record in records:
+                    yield record
+        finally:
+            if task is not None:
+                task.cancel()
+
+    async def sharded_observations(self, filters: list[SearchFilter],
+                                   page_size: int = API_MAX_TAKE,
+                                   sortBy: str = DEFAULT_SORT_BY_ATTRIBUTE_FOR_OBSERVATIONS,
+                                   sort_descending: bool = True,
+                                   verbose=False):
+        """Returns the observations matching any of the search filters in `filters`, searched
+           concurrently and merged like `artportalen.ObservationsAPI.sharded_observations()`
+           does. Concurrency is bounded by the semaphore of this instance."""
+        async def fetch(f):
+            return [o async for o in self.iter_observations(f, page_size=page_size, sortBy=sortBy,
+                                                            sort_descending=sort_descending,
+                                                            verbose=verbose)]
+
+        shards = await asyncio.gather(*(fetch(f) for f in filters))
+        return merge_observations(shards, sortBy, sort_descending)
@@ -0,0 +1,652 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks of the module artportalen against a local mock of Artdatabankens API:s, so the
+throughput of the client can be measured without the network or API quota.
+
+The mock server answers the Observations API search, count, reference data and export resources
+and the Species API taxon resources with synthetic responses, or with recorded responses replayed
+from a directory. Its latency, the size of the observations and throttling (429 responses with a
+Retry-After header) can be set. Each benchmark scenario is run in a process of its own, which
+reports the number of requests per second, the p50 and p99 request latency, the number of bytes
+received and the peak resident memory of the process.
+
+Searches of the synthetic observations honour the date range and modified date of the search
+filter, the sort order and the output fields, so the mock server can also be used as a stand-in
+server in tests. Export jobs of them run for a number of status requests and then succeed, or
+fail if the test says so, and their files are zipped GeoJSON feature collections. The server
+keeps a log of the latest requests and their headers.
+
+Recorded responses are JSON files in the replay directory: "search.json" (a page of
+observations, or a list of them, which are repeated to make up the result set and are not
+filtered), "species.json" (a list of taxa), and "version.json", "dataproviders.json" and
+"areas.json".
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import zipfile
+import argparse
+import collections
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import requests
+from requests.adapters import HTTPAdapter
+import artportalen
+from artportalen import field_value
+import apcache
+from apretry import TokenBucket
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Constants
+OBSERVATIONS_PATH = '/species-observation-system/v1/'
+SPECIES_PATH = '/information/v1/speciesdataservice/v1/'
+STATS_PATH = '/_stats'
+FILES_PATH = '/_files/'  # Export files, as if on another host than the API:s
+REQUEST_LOG_SIZE = 1000  # Requests kept in the request log of the mock server
+DEFAULT_OBSERVATIONS = 20000  # Observations matching every search of the mock server
+DEFAULT_RECORD_SIZE = 1500  # Approximate bytes per synthetic observation
+DEFAULT_TAXA = 2000  # Taxon ids asked for in the taxon fan-out scenario
+DEFAULT_REPEAT = 50  # Requests of the single page and cache scenarios
+SCENARIOS = ['single_page', 'full_pagination', 'streamed_pagination', 'taxon_fanout',
+             'cold_cache', 'warm_cache']
+# The attributes of the synthetic observations that searches can filter and sort by.
+SEARCH_ATTRIBUTES = ('occurrence.occurrenceId', 'taxon.id', 'event.startDate', 'event.endDate',
+                     'modified')
+
+
+def synthetic_observation(i: int, record_size: int = DEFAULT_RECORD_SIZE):
+    """Returns a synthetic observation number `i`, padded to about `record_size` bytes of
+       JSON."""
+    day = 1 + i % 28
+    o = {"occurrence": {"occurrenceId": f"urn:lsid:bench:sighting:{i}",
+                        "recordedBy": "Bench Marker",
+                        "reportedBy": "Bench Marker",
+                        "occurrenceRemarks": ""},
+         "taxon": {"id": 100000 + i % 500,
+                   "scientificName": f"Species {i % 500}",
+                   "vernacularName": f"art {i % 500}"},
+         "event": {"startDate": f"2024-05-{day:02d}T06:00:00+02:00",
+                   "endDate": f"2024-05-{day:02d}T08:00:00+02:00",
+                   "discoveryMethod": {"value": "Sedd"}},
+         "location": {"decimalLongitude": 11.0 + (i * 7919 % 1200) / 100,
+                      "decimalLatitude": 55.3 + (i * 104729 % 1400) / 100,
+                      "locality": f"Site {i % 3000}",
+                      "county": {"name": "Uppsala"},
+                      "municipality": {"name": "Uppsala"}},
+         "dataProviderId": 1,
+         "modified": f"2024-06-{day:02d}T12:00:00Z"}
+    o["occurrence"]["occurrenceRemarks"] = "x" * max(0, record_size - len(json.dumps(o)))
+    return o
+
+
+def synthetic_taxon(id: int):
+    """Returns a synthetic taxon with the id `id`."""
+    return {"taxonId": id, "swedishName": f"art {id}", "scientificName": f"Species {id}"}
+
+
+def project(o: dict, fields: list):
+    """Returns the observation `o` with only the attributes (dot separated paths) `fields`."""
+    result = {}
+    for path in fields:
+        value = field_value(o, path)
+        if value is None:
+            continue
+        *parents, name = path.split('.')
+        d = result
+        for parent in parents:
+            d = d.setdefault(parent, {})
+        d[name] = value
+    return result
+
+
+def flatten(o: dict, prefix: str = ''):
+    """Returns the nested dictionary `o` as a flat dictionary with dot separated keys."""
+    flat = {}
+    for key, value in o.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def load_recordings(directory: str):
+    """Returns the recorded responses in `directory` as a dictionary indexed by file name
+       without the .json extension."""
+    recordings = {}
+    for name in os.listdir(directory):
+        if name.endswith('.json'):
+            with open(os.path.join(directory, name)) as f:
+                recordings[name[:-5]] = json.load(f)
+    return recordings
+
+
+class MockServer:
+    """A local mock of Artdatabankens API:s, served by a thread. Every response is delayed by
+       `latency` seconds plus a random part of at most `jitter` seconds. Every search matches
+       `observations` observations of about `record_size` bytes each, unless recorded
+       observations are given in `recordings`. If `throttle` is given, more than `throttle`
+       requests per second are answered with 429 and a Retry-After of `retry_after` seconds,
+       or no Retry-After if it is None.
+       Failures can be injected with `fail()`. Export jobs are running for `export_polls`
+       status requests, and then get the status `export_status`. The status of a succeeded job
+       has a download URL on `download_host` if it is given, and otherwise the file is
+       downloaded from the download resource. `log` holds the latest requests as tuples of
+       (method, path, headers). Instances are context managers."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0,
+                 observations: int = DEFAULT_OBSERVATIONS,
+                 record_size: int = DEFAULT_RECORD_SIZE,
+                 throttle: float = None, retry_after: float = 0.1,
+                 recordings: dict = None, host: str = '127.0.0.1', port: int = 0,
+                 export_polls: int = 1, export_status: str = "Succeeded",
+                 download_host: str = None):
+        """Initialization. Encodes the observations of the searches."""
+        self.latency = latency
+        self.jitter = jitter
+        self.observations = observations
+        self.retry_after = retry_after
+        self.recordings = recordings or {}
+        self.bucket = TokenBucket(throttle) if throttle else None
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "bytes": 0, "throttled": 0}
+        self.failure = None
+        self.selections = {}
+        self.export_polls = export_polls
+        self.export_status = export_status
+        self.download_host = download_host
+        self.jobs = {}
+        self.log = collections.deque(maxlen=REQUEST_LOG_SIZE)
+        records = artportalen.page_records(self.recordings.get("search"))
+        if records:
+            self.records = [json.dumps(records[i % len(records)]).encode()
+                            for i in range(observations)]
+            self.attributes = None
+        else:
+            synthetic = [synthetic_observation(i, record_size) for i in range(observations)]
+            self.records = [json.dumps(o).encode() for o in synthetic]
+            self.attributes = [{a: field_value(o, a) for a in SEARCH_ATTRIBUTES}
+                               for o in synthetic]
+        self.taxa = {t["taxonId"]: t for t in self.recordings.get("species", [])}
+        self.httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        """The root URL of the server, to use as the `root_url` of the API classes."""
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Start serving in a thread."""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, args=(0.05,),
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def count(self, name: str, n: int = 1):
+        """Add `n` to the statistics counter `name`."""
+        with self.lock:
+            self.stats[name] += n
+
+    def retry_after_headers(self):
+        """Returns the headers of a 429 response."""
+        return {'Retry-After': str(self.retry_after)} if self.retry_after is not None else {}
+
+    def fail(self, status: int = 503, after: int = 0, times: int = None):
+        """Answer API requests with `status` after `after` more requests have been answered,
+           `times` times, or until `recover()` is called if `times` is None. A 429 status is
+           answered with the Retry-After of the server."""
+        with self.lock:
+            self.failure = [status, after, times]
+
+    def recover(self):
+        """Stop answering requests with the status given to `fail()`."""
+        with self.lock:
+            self.failure = None
+
+    def modify(self, i: int, modified: str):
+        """Set the modified time of the synthetic observation number `i` to `modified`."""
+        with self.lock:
+            o = json.loads(self.records[i])
+            o["modified"] = modified
+            self.records[i] = json.dumps(o).encode()
+            self.attributes[i]["modified"] = modified
+            self.selections.clear()
+
+    def failing(self):
+        """Returns the status to answer a request with if it should fail, otherwise None."""
+        with self.lock:
+            if self.failure is None:
+                return None
+            status, after, times = self.failure
+            if after > 0:
+                self.failure[1] -= 1
+                return None
+            if times is not None:
+                if times <= 0:
+                    self.failure = None
+                    return None
+                self.failure[2] -= 1
+            return status
+
+    def matches(self, attributes: dict, search_filter: dict):
+        """True if the synthetic observation with the `attributes` matches the date range and
+           the modified date of `search_filter`."""
+        date = search_filter.get("date") or {}
+        start, end = date.get("startDate"), date.get("endDate")
+        if end and attributes['event.startDate'][:10] > end[:10]:
+            return False
+        if start and attributes['event.endDate'][:10] < start[:10]:
+            return False
+        modified_from = (search_filter.get("modifiedDate") or {}).get("from")
+        return not modified_from or attributes['modified'] >= modified_from
+
+    def select(self, body: bytes, query: dict = None):
+        """Returns the list of the indexes of the observations matching the search filter in
+           `body`, sorted as the request parameters `query` say."""
+        if self.attributes is None:
+            return range(len(self.records))
+        search_filter = json.loads(body) if body else {}
+        sort_by = (query or {}).get("sortBy", [None])[0]
+        descending = (query or {}).get("sortOrder", ["Asc"])[0].lower() == 'desc'
+        criteria = {k: search_filter.get(k) for k in ("date", "modifiedDate")}
+        key = (json.dumps(criteria, sort_keys=True), sort_by, descending)
+        with self.lock:
+            selection = self.selections.get(key)
+        if selection is None:
+            selection = [i for i, a in enumerate(self.attributes)
+                         if self.matches(a, search_filter)]
+            if sort_by in SEARCH_ATTRIBUTES:
+                selection.sort(key=lambda i: (self.attributes[i][sort_by], i),
+                               reverse=descending)
+            with self.lock:
+                self.selections[key] = selection
+        return selection
+
+    def search_page(self, query: dict, body: bytes = b''):
+        """Returns the body of a search response."""
+        skip = int(query.get("skip", ["0"])[0])
+        take = int(query.get("take", ["100"])[0])
+        selection = self.select(body, query)
+        page = [self.records[i] for i in selection[skip:skip + take]]
+        fields = ((json.loads(body) if body else {}).get("output") or {}).get("fields")
+        if fields and self.attributes is not None:
+            page = [json.dumps(project(json.loads(r), fields)).encode() for r in page]
+        total = len(selection)
+        head = b'{"skip":%d,"take":%d,"totalCount":%d,"records":[' % (skip, take, total)
+        return head + b','.join(page) + b']}'
+
+    def species(self, query: dict):
+        """Returns the body of a species data response."""
+        if "searchString" in query:
+            name = query["searchString"][0]
+            taxa = [t for t in self.taxa.values() if t["swedishName"] == name.lower()]
+            return json.dumps(taxa or [synthetic_taxon(1) | {"swedishName": name.lower()}])
+        ids = [int(id) for id in query.get("taxa", [""])[0].split(',') if id]
+        return json.dumps([self.taxa.get(id) or synthetic_taxon(id) for id in ids])
+
+    def order_export(self, body: bytes):
+        """Returns the body of an export order response, after creating the job."""
+        selection = list(self.select(body))
+        with self.lock:
+            job_id = f"job-{len(self.jobs) + 1}"
+            self.jobs[job_id] = {"selection": selection, "polls": 0}
+        return json.dumps(job_id)
+
+    def job_status(self, job_id: str):
+        """Returns the body of a job status response, or None if there is no such job."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            job["polls"] += 1
+            status = self.export_status if job["polls"] > self.export_polls else "Processing"
+        result = {"jobId": job_id, "status": status}
+        if status == "Succeeded" and self.download_host:
+            port = self.httpd.server_address[1]
+            result["downloadUrl"] = f"http://{self.download_host}:{port}{FILES_PATH}{job_id}"
+        return json.dumps(result)
+
+    def export_file(self, job_id: str):
+        """Returns the zipped GeoJSON export file of the job `job_id`, or None if there is no
+           such job."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        features = []
+        for i in job["selection"]:
+            o = json.loads(self.records[i])
+            location = o.get("location") or {}
+            features.append({"type": "Feature",
+                             "geometry": {"type": "Point",
+                                          "coordinates": [location.get("decimalLongitude"),
+                                                          location.get("decimalLatitude")]},
+                             "properties": flatten(o)})
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("export.geojson", json.dumps({"type": "FeatureCollection",
+                                                           "features": features}))
+        return buffer.getvalue()
+
+    def reference(self, name: str, default):
+        """Returns the body of a reference data response."""
+        return json.dumps(self.recordings.get(name, default))
+
+    def handler_class(self):
+        """Returns the request handler class of the server."""
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Send the headers and the body of a response in one segment.
+            wbufsize = 65536
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self.handle_request()
+
+            def do_POST(self):
+                self.handle_request()
+
+            def reply(self, status: int, body=b'', headers: dict = None, counted=True):
+                if body is None:
+                    status, body = 404, b''
+                if isinstance(body, str):
+                    body = body.encode()
+                self.send_response(status)
+                headers = {'Content-Type': 'application/json'} | (headers or {})
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                if counted:
+                    mock.count("bytes", len(body))
+
+            def handle_request(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path == STATS_PATH:
+                    with mock.lock:
+                        body = json.dumps(mock.stats)
+                    self.reply(200, body, counted=False)
+                    return
+                mock.log.append((self.command, url.path, dict(self.headers)))
+                mock.count("requests")
+                if mock.bucket is not None and mock.bucket.available() < 1:
+                    mock.count("throttled")
+                    self.reply(429, b'', mock.retry_after_headers())
+                    return
+                if mock.bucket is not None:
+                    mock.bucket.reserve()
+                if mock.latency or mock.jitter:
+                    time.sleep(mock.latency + random.uniform(0, mock.jitter))
+                status = mock.failing()
+                if status is not None:
+                    headers = mock.retry_after_headers() if status == 429 else None
+                    self.reply(status, json.dumps({"status": status, "title": "Injected"}),
+                               headers)
+                    return
+                self.route(url.path, query, body)
+
+            def route(self, path: str, query: dict, body: bytes = b''):
+                cached = {'ETag': '"bench"', 'Cache-Control': 'max-age=3600'}
+                if path.startswith(OBSERVATIONS_PATH):
+                    resource = path[len(OBSERVATIONS_PATH):].lstrip('/')
+                    if resource == "Observations/Search":
+                        self.reply(200, mock.search_page(query, body))
+                    elif resource == "Observations/Count":
+                        self.reply(200, str(len(mock.select(body))))
+                    elif resource == "api/ApiInfo":
+                        self.reply(200, mock.reference("version", {"apiName": "Mock"}), cached)
+                    elif resource == "DataProviders":
+                        self.reply(200, mock.reference("dataproviders",
+                                                       [{"id": 1, "name": "Artportalen"}]),
+                                   cached)
+                    elif resource == "Areas":
+                        self.reply(200, mock.reference("areas", {"totalCount": 0,
+                                                                 "records": []}), cached)
+                    elif resource.startswith("Exports/Order/") and self.command == 'POST':
+                        self.reply(200, mock.order_export(body))
+                    elif resource.startswith("Jobs/") and resource.endswith("/Status"):
+                        self.reply(200, mock.job_status(resource.split('/')[1]))
+                    elif resource.startswith("Exports/Download/"):
+                        self.reply(200, mock.export_file(resource.split('/')[2]),
+                                   {'Content-Type': 'application/zip'})
+                    else:
+                        self.reply(404)
+                elif path.startswith(FILES_PATH):
+                    self.reply(200, mock.export_file(path[len(FILES_PATH):]),
+                               {'Content-Type': 'application/zip'})
+                elif path.startswith(SPECIES_PATH + "speciesdata"):
+                    self.reply(200, mock.species(query))
+                else:
+                    self.reply(404)
+
+        return Handler
+
+
+class TimedSession(requests.Session):
+    """A requests session, set up like `artportalen.new_session()`, that records the latency of
+       every request in `latencies`."""
+
+    def __init__(self, pool_size: int = artportalen.DEFAULT_POOL_SIZE):
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        self.latencies = []
+
+    def request(self, *args, **kwargs):
+        start = time.perf_counter()
+        r = super().request(*args, **kwargs)
+        self.latencies.append(time.perf_counter() - start)
+        return r
+
+
+def percentile(values: list, q: float):
+    """Returns the `q` quantile (0 to 1) of the list of numbers `values`, or None if it is
+       empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def peak_rss_mb():
+    """Returns the peak resident memory of this process in megabytes, or None if unknown."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes.
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def run_scenario(name: str, url: str, options: dict):
+    """Run the scenario `name` against the mock server at `url`, and return its results as a
+       dictionary."""
+    with tempfile.TemporaryDirectory(prefix='apbench-') as cache_dir:
+        return timed_scenario(name, url, options, cache_dir)
+
+
+def timed_scenario(name: str, url: str, options: dict, cache_dir: str):
+    """Run the scenario `name` against the mock server at `url`, with the caches in
+       `cache_dir`, and return its results as a dictionary."""
+    session = TimedSession()
+    stats_url = url + STATS_PATH
+    before = session.get(stats_url).json()
+    session.latencies.clear()
+    oapi = artportalen.ObservationsAPI("bench", session=session, root_url=url)
+    sapi = artportalen.SpeciesAPI("bench", session=session, root_url=url)
+    search_filter = artportalen.SearchFilter()
+    search_filter.set_date("2024-01-01", "2024-12-31", "OverlappingStartDateAndEndDate", [])
+    repeat = options.get("repeat", DEFAULT_REPEAT)
+    operations = 0
+    start = time.perf_counter()
+    if name == 'single_page':
+        for i in range(repeat):
+            oapi.observations(search_filter, take=artportalen.API_MAX_TAKE)
+            operations += 1
+    elif name in ('full_pagination', 'streamed_pagination'):
+        for o in oapi.iter_observations(search_filter, stream=name == 'streamed_pagination'):
+            operations += 1
+    elif name == 'taxon_fanout':
+        operations = len(sapi.taxa_by_ids(range(1, options.get("taxa", DEFAULT_TAXA) + 1)))
+    elif name in ('cold_cache', 'warm_cache'):
+        # The warm cache scenario fills the cache before it is timed.
+        cache = apcache.open_cache("bench", cache_dir)
+        oapi = artportalen.ObservationsAPI("bench", session=session, root_url=url,
+                                           cache=cache, search_cache=cache)
+        if name == 'warm_cache':
+            oapi.version()
+            oapi.observations(search_filter)
+            before = session.get(stats_url).json()
+            session.latencies.clear()
+            start = time.perf_counter()
+        for i in range(repeat):
+            if name == 'cold_cache':
+                cache.clear()
+            oapi.version()
+            oapi.observations(search_filter)
+            operations += 1
+        cache.close()
+    else:
+        raise ValueError(f"Unknown scenario {name}")
+    seconds = time.perf_counter() - start
+    latencies = list(session.latencies)
+    after = session.get(stats_url).json()
+    return {"scenario": name,
+            "operations": operations,
+            "seconds": seconds,
+            "requests": after["requests"] - before["requests"],
+            "throttled": after["throttled"] - before["throttled"],
+            "requests_per_second": len(latencies) / seconds if seconds else None,
+            "p50_ms": percentile(latencies, 0.5) * 1000 if latencies else None,
+            "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+            "bytes": after["bytes"] - before["bytes"],
+            "peak_rss_mb": peak_rss_mb()}
+
+
+def run(scenarios: list, server: MockServer, options: dict, isolate: bool = True):
+    """Run the benchmark `scenarios` against the running mock `server` and return the list of
+       their results. Each scenario is run in a new process if `isolate` is true, so the peak
+       memory is that of the scenario alone."""
+    results = []
+    for name in scenarios:
+        if isolate:
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                results.append(executor.submit(run_scenario, name, server.url,
+                                               options).result())
+        else:
+            results.append(run_scenario(name, server.url, options))
+    return results
+
+
+def format_value(value, decimals: int = 1):
+    """Returns `value` formatted for the results table."""
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return f"{value:.{decimals}f}"
+    return str(value)
+
+
+def print_results(results: list):
+    """Print the benchmark results as a table."""
+    columns = [("scenario", "scenario"), ("operations", "ops"), ("requests", "requests"),
+               ("throttled", "429s"), ("requests_per_second", "req/s"), ("p50_ms", "p50 ms"),
+               ("p99_ms", "p99 ms"), ("bytes", "bytes"), ("peak_rss_mb", "peak RSS MB")]
+    rows = [[title for key, title in columns]]
+    rows += [[format_value(r[key]) for key, title in columns] for r in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(v.ljust(w) if i == 0 else v.rjust(w)
+                        for i, (v, w) in enumerate(zip(row, widths))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the artportalen module against "
+                                     "a local mock of Artdatabankens API:s.")
+    parser.add_argument('scenarios', nargs='*',
+                        help=f"Scenarios to run [all]: {', '.join(SCENARIOS)}")
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help="Mock server latency in seconds [0.01]")
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help="Random extra mock server latency in seconds, at most [0]")
+    parser.add_argument('--observations', type=int, default=DEFAULT_OBSERVATIONS,
+                        help=f"Observations matching a search [{DEFAULT_OBSERVATIONS}]")
+    parser.add_argument('--record-size', type=int, default=DEFAULT_RECORD_SIZE,
+                        help=f"Approximate bytes per observation [{DEFAULT_RECORD_SIZE}]")
+    parser.add_argument('--throttle', type=float,
+                        help="Requests per second the mock server allows before it answers 429")
+    parser.add_argument('--replay',
+                        help="Directory with recorded responses to replay")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help=f"Requests of the single page and cache scenarios [{DEFAULT_REPEAT}]")
+    parser.add_argument('--taxa', type=int, default=DEFAULT_TAXA,
+                        help=f"Taxa of the taxon fan-out scenario [{DEFAULT_TAXA}]")
+    parser.add_argument('--in-process', action='store_true', default=False,
+                        help="Run the scenarios in this process instead of one process each")
+    parser.add_argument('--json', action='store_true', default=False,
+                        help="Print the results as JSON")
+    parser.add_argument('--serve', action='store_true', default=False,
+                        help="Only run the mock server, until interrupted")
+    args = parser.parse_args()
+    unknown = [s for s in args.scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+    recordings = load_recordings(args.replay) if args.replay else None
+    with MockServer(latency=args.latency, jitter=args.jitter, observations=args.observations,
+                    record_size=args.record_size, throttle=args.throttle,
+                    recordings=recordings) as server:
+        if args.serve:
+            print(f"Mock server at {server.url}")
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                return
+        options = {"repeat": args.repeat, "taxa": args.taxa}
+        results = run(args.scenarios or SCENARIOS, server, options, isolate=not args.in_process)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
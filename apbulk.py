@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+"""
+Python module for bulk exports of observations from Artportalens ObservationsAPI, for result sets
+too big for paging with skip and take. An export job is ordered with a SearchFilter, its status
+is polled until the export file is ready, and the compressed file is downloaded in chunks to a
+local file. The GeoJSON features in the file are then decoded one at a time, so the observations
+can be stored in an `apstore.ObservationStore` or a columnar file (see the module apexport)
+without loading the whole export into memory.
+
+The paths of the export resources are relative to the URL of the ObservationsAPI instance, and
+can be changed with the `paths` of a BulkExport, for instance to use a stand-in server. The API
+key and the user token are only sent to the host of the ObservationsAPI, not to download URLs
+or redirects on other hosts, like a file storage service.
+"""
+
+import os
+import gzip
+import time
+import shutil
+import zipfile
+import tempfile
+from contextlib import contextmanager
+from urllib.parse import urljoin, urlsplit
+import apexport
+from artportalen import APIError, ObservationsAPI, SearchFilter, print_http_response
+from apstream import DEFAULT_CHUNK_SIZE, JSONArrayStream
+from apmetrics import response_json
+
+# Constants
+DEFAULT_FORMAT = 'GeoJson'
+DEFAULT_POLL_INTERVAL = 10.0  # Seconds between status requests
+DEFAULT_TIMEOUT = 6 * 3600  # Seconds to wait for an export job
+DEFAULT_BATCH_SIZE = 1000  # Observations stored per transaction
+EXPORT_PATHS = {"order": "Exports/Order/{format}",
+                "status": "Jobs/{job_id}/Status",
+                "download": "Exports/Download/{job_id}"}
+SUCCEEDED_STATUSES = frozenset(["succeeded", "completed", "done"])
+FAILED_STATUSES = frozenset(["failed", "deleted", "cancelled", "canceled"])
+GZIP_MAGIC = b'\x1f\x8b'
+MAX_REDIRECTS = 5
+ZIP_MAGIC = b'PK\x03\x04'
+
+
+def unflatten(properties: dict):
+    """Returns the flat dictionary `properties`, with dot separated keys like
+       "occurrence.occurrenceId", as nested dictionaries. Keys without dots are kept as they
+       are."""
+    result = {}
+    for key, value in properties.items():
+        *parents, name = key.split('.')
+        d = result
+        for parent in parents:
+            d = d.setdefault(parent, {})
+        d[name] = value
+    return result
+
+
+def feature_observation(feature: dict):
+    """Returns the observation of the GeoJSON feature `feature` of an export file. The
+       coordinates of a point geometry are set as the WGS 84 location of the observation if it
+       has none."""
+    observation = unflatten(feature.get("properties") or {})
+    geometry = feature.get("geometry") or {}
+    if geometry.get("type") == "Point":
+        location = observation.setdefault("location", {})
+        if location.get("decimalLongitude") is None:
+            location["decimalLongitude"], location["decimalLatitude"] = geometry["coordinates"][:2]
+    return observation
+
+
+@contextmanager
+def open_export(path: str):
+    """Context manager giving a binary file object of the JSON document in the export file
+       `path`, which may be a zip archive (the first .json or .geojson file in it is used), gzip
+       compressed or uncompressed. The document is decompressed while it is read."""
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(ZIP_MAGIC):
+        with zipfile.ZipFile(path) as archive:
+            names = [n for n in archive.namelist() if n.lower().endswith(('.json', '.geojson'))]
+            if not names:
+                raise ValueError(f"There is no JSON file in the export archive {path}")
+            with archive.open(names[0]) as f:
+                yield f
+    elif magic.startswith(GZIP_MAGIC):
+        with gzip.open(path, 'rb') as f:
+            yield f
+    else:
+        with open(path, 'rb') as f:
+            yield f
+
+
+def export_observations(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Yields the observations in the export file `path` one at a time."""
+    with open_export(path) as f:
+        chunks = iter(lambda: f.read(chunk_size), b'')
+        for feature in JSONArrayStream(chunks, "features"):
+            yield feature_observation(feature)
+
+
+def same_origin(url: str, other: str):
+    """True if the URLs `url` and `other` have the same scheme, host and port."""
+    a, b = urlsplit(url), urlsplit(other)
+    return (a.scheme.lower(), a.hostname, a.port) == (b.scheme.lower(), b.hostname, b.port)
+
+
+def job_status(status):
+    """Returns the lower case status name of the job status response `status`."""
+    if isinstance(status, dict):
+        return str(status.get("status") or status.get("jobStatus") or "").lower()
+    return str(status or "").lower()
+
+
+class BulkExport:
+    """Bulk exports with the ObservationsAPI `api`. `paths` overrides the paths of the export
+       resources in EXPORT_PATHS. Ordering exports may need a user `auth_token` in addition to
+       the API key."""
+
+    def __init__(self, api: ObservationsAPI, paths: dict = None, auth_token: str = None,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL, timeout: float = DEFAULT_TIMEOUT):
+        """Initialization."""
+        self.api = api
+        self.paths = EXPORT_PATHS | (paths or {})
+        self.headers = dict(api.headers)
+        if auth_token:
+            self.headers["Authorization"] = f"Bearer {auth_token}"
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    def url(self, name: str, **kwargs):
+        """Returns the URL of the export resource `name`."""
+        return self.api.url + self.paths[name].format(**kwargs)
+
+    def order(self, search_filter: SearchFilter, format: str = DEFAULT_FORMAT,
+              description: str = None, verbose=False):
+        """Order an export of the observations matching `search_filter` and return the id of
+           the export job. Raises APIError if the order fails."""
+        url = self.url("order", format=format)
+        params = {"description": description} if description else {}
+        headers = self.headers | {"Content-Type": "application/json"}
+        r = self.api.request('POST', url, params=params, headers=headers,
+                             data=search_filter.json_string())
+        if verbose:
+            print(f"HTTP request: POST {url}")
+            print_http_response(r)
+        if not r.ok:
+            raise APIError("Ordering the export failed", self.api.last_response())
+        job = response_json(r)
+        if isinstance(job, dict):
+            job = job.get("jobId") or job.get("id")
+        if not job:
+            raise APIError("The export order returned no job id", self.api.last_response())
+        return str(job)
+
+    def status(self, job_id: str, verbose=False):
+        """Returns the status response of the export job `job_id`. Raises APIError if the
+           request fails."""
+        url = self.url("status", job_id=job_id)
+        r = self.api.request('GET', url, headers=self.headers)
+        if verbose:
+            print(f"HTTP request: GET {url}")
+            print(f"HTTP Status code: {r.status_code}")
+        if not r.ok:
+            raise APIError(f"Getting the status of export job {job_id} failed",
+                           self.api.last_response())
+        return response_json(r)
+
+    def wait(self, job_id: str, verbose=False):
+        """Poll the status of the export job `job_id` until it has succeeded, and return the
+           last status response. Raises APIError if the job fails or doesn't succeed within
+           `timeout` seconds."""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            status = self.status(job_id, verbose)
+            name = job_status(status)
+            if name in SUCCEEDED_STATUSES:
+                return status
+            if name in FAILED_STATUSES:
+                raise APIError(f"Export job {job_id} {name}")
+            if time.monotonic() + self.poll_interval > deadline:
+                raise APIError(f"Export job {job_id} didn't finish in {self.timeout} seconds")
+            time.sleep(self.poll_interval)
+
+    def download(self, job_id: str, path: str, status=None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, verbose=False):
+        """Download the export file of the job `job_id` to `path` in chunks of `chunk_size`
+           bytes. The file is downloaded from the URL in the status response `status` if it has
+           one, and otherwise from the download resource. Redirects are followed, sending the
+           authentication headers to the host of the ObservationsAPI only. `path` only appears
+           when the download is complete. Returns `path`."""
+        url = None
+        if isinstance(status, dict):
+            url = status.get("downloadUrl") or status.get("fileUrl")
+        url = url or self.url("download", job_id=job_id)
+        for i in range(MAX_REDIRECTS + 1):
+            api_host = same_origin(url, self.api.url)
+            r = self.api.request('GET', url, authenticated=api_host,
+                                 headers=self.headers if api_host else {}, stream=True,
+                                 allow_redirects=False)
+            if verbose:
+                print(f"HTTP request: GET {url}")
+                print(f"HTTP Status code: {r.status_code}")
+            if not r.is_redirect:
+                break
+            r.close()
+            url = urljoin(url, r.headers['Location'])
+        else:
+            raise APIError(f"Downloading export job {job_id} was redirected more than "
+                           f"{MAX_REDIRECTS} times", self.api.last_response())
+        try:
+            if not r.ok:
+                raise APIError(f"Downloading export job {job_id} failed",
+                               self.api.last_response())
+            # Let requests undo the Content-Encoding but keep the export file compressed.
+            r.raw.decode_content = True
+            part = path + '.part'
+            with open(part, 'wb') as f:
+                shutil.copyfileobj(r.raw, f, chunk_size)
+            os.replace(part, path)
+        finally:
+            r.close()
+        return path
+
+    def run(self, search_filter: SearchFilter, path: str, format: str = DEFAULT_FORMAT,
+            description: str = None, verbose=False):
+        """Order an export of the observations matching `search_filter`, wait for it and
+           download it to `path`. Returns `path`."""
+        job_id = self.order(search_filter, format, description, verbose)
+        status = self.wait(job_id, verbose)
+        return self.download(job_id, path, status, verbose=verbose)
+
+    def observations(self, search_filter: SearchFilter, path: str = None, keep: bool = False,
+                     verbose=False):
+        """Yields the observations matching `search_filter` one at a time, from a GeoJSON
+           export downloaded to `path`, or a temporary file if `path` is None. The file is
+           removed when all observations have been yielded unless `keep` is true."""
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix='.export')
+            os.close(fd)
+        try:
+            self.run(search_filter, path, verbose=verbose)
+            yield from export_observations(path)
+        finally:
+            if not keep and os.path.exists(path):
+                os.remove(path)
+
+    def to_store(self, search_filter: SearchFilter, store, path: str = None,
+                 batch_size: int = DEFAULT_BATCH_SIZE, verbose=False):
+        """Export the observations matching `search_filter` into the `apstore.ObservationStore`
+           `store`, `batch_size` observations per transaction. Returns the number of
+           observations stored."""
+        n = 0
+        batch = []
+        for observation in self.observations(search_filter, path, verbose=verbose):
+            batch.append(observation)
+            if len(batch) >= batch_size:
+                n += store.upsert(batch)
+                batch = []
+        if batch:
+            n += store.upsert(batch)
+        return n
+
+    def to_columnar(self, search_filter: SearchFilter, columnar_path: str, path: str = None,
+                    verbose=False, **kwargs):
+        """Export the observations matching `search_filter` to the columnar file
+           `columnar_path`, with `apexport.export_observations()` and its keyword arguments
+           `kwargs`. Returns the number of observations written."""
+        return apexport.export_observations(self.observations(search_filter, path,
+                                                              verbose=verbose),
+                                            columnar_path, **kwargs)
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+
+"""
+Python module with caches for responses from Artportalens API:s. A cache maps a string key to a
+CacheEntry. There is an in-memory LRU cache, a persistent SQLite cache and a tiered cache that
+puts the former in front of the latter. An HTTPCache uses such a cache to cache the responses to
+GET requests the way HTTP says, with Cache-Control and conditional requests.
+"""
+
+import os
+import os.path
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from apretry import API_KEY_HEADER
+from apmetrics import response_json
+
+# Constants
+CACHE_DIR_ENV_NAME = 'ADB_CACHE_DIR'
+DEFAULT_LRU_MAXSIZE = 4096
+
+
+def default_cache_dir():
+    """The directory for persistent caches. It is the value of the environment variable
+       ADB_CACHE_DIR if it is set, otherwise "artdatabanken-utils" in the user's cache directory."""
+    if CACHE_DIR_ENV_NAME in os.environ:
+        return os.environ[CACHE_DIR_ENV_NAME]
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'artdatabanken-utils')
+
+
+class CacheEntry:
+    """A cached value, the time (seconds since the epoch) it expires, and the validators of the
+       HTTP response it came from, which are used to revalidate the entry when it has expired."""
+
+    __slots__ = ('value', 'expires', 'etag', 'last_modified')
+
+    def __init__(self, value, expires: float, etag: str = None, last_modified: str = None):
+        self.value = value
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def fresh(self, now: float = None):
+        """True if the entry has not expired."""
+        return (now if now is not None else time.time()) < self.expires
+
+    def revalidatable(self):
+        """True if the entry can be revalidated with a conditional request."""
+        return bool(self.etag or self.last_modified)
+
+
+class LRUCache:
+    """An in-memory cache of at most `maxsize` entries, evicting the least recently used entry."""
+
+    def __init__(self, maxsize: int = DEFAULT_LRU_MAXSIZE):
+        """Initialization."""
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        """Returns the entry for `key`, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry: CacheEntry):
+        """Set the entry for `key`."""
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key: str):
+        """Remove the entry for `key`, if there is one."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Remove all entries."""
+        with self.lock:
+            self.entries.clear()
+
+    def close(self):
+        """Nothing to close."""
+
+
+class SQLiteCache:
+    """A persistent cache stored in the SQLite database `path`. Values must be JSON serializable.
+       If `max_bytes` is given, the least recently used entries are evicted when the values take
+       up more than `max_bytes` bytes. The cache can be used from several threads."""
+
+    def __init__(self, path: str, table: str = 'cache', max_bytes: int = None):
+        """Initialization. Creates the database and its directory if they don't exist."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.table = table
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} ("
+                            "key TEXT PRIMARY KEY, value TEXT, expires REAL, "
+                            "etag TEXT, last_modified TEXT, size INTEGER, accessed REAL)")
+            columns = [row[1] for row in self.db.execute(f"PRAGMA table_info({table})")]
+            if "size" not in columns:
+                # Add the eviction columns to a cache made before entries were evicted.
+                self.db.execute(f"ALTER TABLE {table} ADD COLUMN size INTEGER")
+                self.db.execute(f"ALTER TABLE {table} ADD COLUMN accessed REAL")
+                self.db.execute(f"UPDATE {table} SET size = length(value), accessed = 0")
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed)")
+
+    def get(self, key: str):
+        """Returns the entry for `key`, or None."""
+        with self.lock:
+            row = self.db.execute(f"SELECT value, expires, etag, last_modified FROM {self.table} "
+                                  "WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.max_bytes is not None:
+                with self.db:
+                    self.db.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?",
+                                    (time.time(), key))
+        if row is None:
+            return None
+        return CacheEntry(json.loads(row[0]), row[1], row[2], row[3])
+
+    def set(self, key: str, entry: CacheEntry):
+        """Set the entry for `key`, evicting the least recently used entries if the cache has
+           grown too big."""
+        value = json.dumps(entry.value)
+        with self.lock, self.db:
+            self.db.execute(f"INSERT OR REPLACE INTO {self.table} "
+                            "(key, value, expires, etag, last_modified, size, accessed) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (key, value, entry.expires, entry.etag, entry.last_modified,
+                             len(value), time.time()))
+            if self.max_bytes is not None:
+                self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the values take up at most `max_bytes`
+           bytes. Must be called with the lock held."""
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+        keys = []
+        for key, size in self.db.execute(f"SELECT key, size FROM {self.table} "
+                                         "ORDER BY accessed"):
+            keys.append((key,))
+            excess -= size or 0
+            if excess <= 0:
+                break
+        self.db.executemany(f"DELETE FROM {self.table} WHERE key = ?", keys)
+
+    def size(self):
+        """Returns the number of bytes the values take up."""
+        return self.db.execute(f"SELECT coalesce(sum(size), 0) FROM {self.table}").fetchone()[0]
+
+    def delete(self, key: str):
+        """Remove the entry for `key`, if there is one."""
+        with self.lock, self.db:
+            self.db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def clear(self):
+        """Remove all entries."""
+        with self.lock, self.db:
+            self.db.execute(f"DELETE FROM {self.table}")
+
+    def close(self):
+        """Close the database."""
+        with self.lock:
+            self.db.close()
+
+
+class TieredCache:
+    """A cache with an in-memory cache in front of a persistent cache. Entries found in the
+       persistent cache are copied to the in-memory cache."""
+
+    def __init__(self, memory=None, store=None):
+        """Initialization. `memory` defaults to an LRUCache. `store` may be None, in which case
+           nothing is persisted."""
+        self.memory = memory if memory is not None else LRUCache()
+        self.store = store
+
+    def get(self, key: str):
+        """Returns the entry for `key`, or None."""
+        entry = self.memory.get(key)
+        if entry is None and self.store is not None:
+            entry = self.store.get(key)
+            if entry is not None:
+                self.memory.set(key, entry)
+        return entry
+
+    def set(self, key: str, entry: CacheEntry):
+        """Set the entry for `key`."""
+        self.memory.set(key, entry)
+        if self.store is not None:
+            self.store.set(key, entry)
+
+    def delete(self, key: str):
+        """Remove the entry for `key`, if there is one."""
+        self.memory.delete(key)
+        if self.store is not None:
+            self.store.delete(key)
+
+    def clear(self):
+        """Remove all entries."""
+        self.memory.clear()
+        if self.store is not None:
+            self.store.clear()
+
+    def close(self):
+        """Close the persistent cache."""
+        if self.store is not None:
+            self.store.close()
+
+
+def open_cache(name: str, cache_dir: str = None, maxsize: int = DEFAULT_LRU_MAXSIZE,
+               max_bytes: int = None):
+    """Returns a TieredCache with an LRUCache of `maxsize` entries in front of the SQLiteCache
+       "`name`.sqlite" in `cache_dir`, which defaults to `default_cache_dir()`, and holds at most
+       `max_bytes` bytes if it is given."""
+    path = os.path.join(cache_dir or default_cache_dir(), name + '.sqlite')
+    return TieredCache(LRUCache(maxsize), SQLiteCache(path, max_bytes=max_bytes))
+
+
+def cache_control(headers):
+    """Returns the directives of the Cache-Control header in `headers` as a dictionary of
+       lower case directive names and values (None for directives without a value)."""
+    directives = {}
+    for part in (headers.get('Cache-Control') or '').split(','):
+        name, _, value = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip('"') if value else None
+    return directives
+
+
+def key_scope(api_key: str):
+    """Returns the scope of the cache keys of requests made with `api_key`: a short hash of the
+       key, so responses to different keys are not mixed up and keys are not stored."""
+    if not api_key:
+        return '-'
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+
+class CacheStats:
+    """Counts of the lookups in an HTTPCache: `hits` (fresh entries), `revalidated` (expired
+       entries confirmed by a 304 response), `misses` (entries fetched anew) and `stores`."""
+
+    def __init__(self):
+        """Initialization."""
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.stores = 0
+        self.lock = threading.Lock()
+
+    def count(self, name: str):
+        """Increment the count `name`."""
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def requests(self):
+        """Returns the number of lookups that needed a network request."""
+        return self.revalidated + self.misses
+
+    def hit_rate(self):
+        """Returns the share of the lookups that didn't need a network request."""
+        lookups = self.hits + self.requests()
+        return self.hits / lookups if lookups else 0.0
+
+    def as_dict(self):
+        """Returns the counts and the hit rate as a dictionary."""
+        return {"hits": self.hits, "revalidated": self.revalidated, "misses": self.misses,
+                "stores": self.stores, "hit_rate": self.hit_rate()}
+
+
+class CachedResponse:
+    """A response served from an HTTPCache. It has the attributes of a requests response that
+       the API classes use. `cache` is "hit" for a fresh entry, and "revalidated" for an entry
+       confirmed with a conditional request."""
+
+    status_code = 200
+    ok = True
+    from_cache = True
+
+    def __init__(self, entry: CacheEntry, url: str = None, cache: str = 'hit'):
+        self.entry = entry
+        self.url = url
+        self.cache = cache
+        self.headers = {'Content-Type': 'application/json'}
+        if entry.etag:
+            self.headers['ETag'] = entry.etag
+        if entry.last_modified:
+            self.headers['Last-Modified'] = entry.last_modified
+
+    def json(self):
+        return self.entry.value
+
+    @property
+    def text(self):
+        return json.dumps(self.entry.value)
+
+    @property
+    def content(self):
+        return self.text.encode()
+
+    def close(self):
+        pass
+
+
+class HTTPCache:
+    """Caches the JSON bodies of successful responses to GET requests in `cache` (see
+       `open_cache()`), keyed by the URL and the scope of the API key of the request. Responses
+       are fresh as long as their Cache-Control max-age or Expires header says, and otherwise
+       for `default_ttl` seconds. Responses with Cache-Control no-store are not cached. Expired
+       responses with an ETag or Last-Modified header are revalidated with a conditional
+       request. The lookups are counted in `stats`."""
+
+    def __init__(self, cache, default_ttl: float):
+        """Initialization."""
+        self.cache = cache
+        self.default_ttl = default_ttl
+        self.stats = CacheStats()
+
+    def key(self, url: str, headers: dict):
+        """Returns the cache key of a request to `url` with `headers`."""
+        return key_scope((headers or {}).get(API_KEY_HEADER)) + ' ' + url
+
+    def lifetime(self, response):
+        """Returns the number of seconds `response` is fresh, or None if it may not be cached."""
+        directives = cache_control(response.headers)
+        if 'no-store' in directives:
+            return None
+        if 'no-cache' in directives:
+            return 0
+        if 'max-age' in directives:
+            try:
+                return max(0, int(directives['max-age']))
+            except ValueError:
+                return 0
+        expires = response.headers.get('Expires')
+        if expires:
+            try:
+                return max(0.0, parsedate_to_datetime(expires).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return 0
+        return self.default_ttl
+
+    def lookup(self, url: str, headers: dict):
+        """Returns the fresh cached JSON body of a GET request, or None."""
+        entry = self.cache.get(self.key(url, headers))
+        return entry.value if entry is not None and entry.fresh() else None
+
+    def put(self, url: str, headers: dict, value, ttl: float = None):
+        """Cache `value` as the JSON body of a GET request for `ttl` seconds, which defaults to
+           `default_ttl`."""
+        ttl = self.default_ttl if ttl is None else ttl
+        self.cache.set(self.key(url, headers), CacheEntry(value, time.time() + ttl))
+        self.stats.count('stores')
+
+    def get(self, send, url: str, headers: dict, verbose=False):
+        """Returns the response to a GET request to `url` with `headers`, from the cache if it
+           is fresh there. `send(url, headers)` sends the request and returns a requests
+           response. Cached responses, and responses confirmed by a 304 response, are returned
+           as CachedResponse."""
+        return self.fetch(send, url, headers, verbose)[0]
+
+    def get_json(self, send, url: str, headers: dict, verbose=False):
+        """Like `get()`, but returns the tuple (status code, decoded JSON body). The body is None
+           if the request failed."""
+        response, value = self.fetch(send, url, headers, verbose)
+        return response.status_code, value
+
+    def fetch(self, send, url: str, headers: dict, verbose=False):
+        """Returns the tuple (response, decoded JSON body or None) of `get()`."""
+        key = self.key(url, headers)
+        entry = self.cache.get(key)
+        if entry is not None and entry.fresh():
+            if verbose:
+                print('GET %s (cached)' % url)
+            self.stats.count('hits')
+            return CachedResponse(entry, url), entry.value
+        if entry is not None and entry.revalidatable():
+            headers = dict(headers or {})
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        r = send(url, headers)
+        if r.status_code == 304 and entry is not None:
+            self.stats.count('revalidated')
+            ttl = self.lifetime(r)
+            entry.expires = time.time() + (ttl if ttl is not None else 0)
+            self.cache.set(key, entry)
+            return CachedResponse(entry, url, 'revalidated'), entry.value
+        self.stats.count('misses')
+        if r.status_code != 200:
+            return r, None
+        value = response_json(r)
+        ttl = self.lifetime(r)
+        if ttl is not None:
+            self.cache.set(key, CacheEntry(value, time.time() + ttl, r.headers.get('ETag'),
+                                           r.headers.get('Last-Modified')))
+            self.stats.count('stores')
+        return r, value
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+"""
+Python module for decoding a page of observations from Artportalens ObservationsAPI, as JSON
+objects, into an ObservationBatch: a compact structure of typed arrays (from the standard array
+module) with one element per observation. Dates are parsed once per distinct date string, which
+makes decoding pages where many observations share dates much faster than parsing every date.
+"""
+
+import math
+import array
+from functools import lru_cache
+from datetime import datetime, timezone, timedelta
+from artportalen import (field_value, observation_id, observation_wgs84, parse_iso_datetime,
+                         Projection,
+                         ID_ATTRIBUTES, TAXON_ID_ATTRIBUTES, DATE_ATTRIBUTES, WGS84_ATTRIBUTES)
+
+# Constants
+INT64_MIN = -2 ** 63  # Marks a missing date, like NumPy's NaT
+START_DATE_ATTRIBUTE, END_DATE_ATTRIBUTE = DATE_ATTRIBUTES
+TAXON_ID_ATTRIBUTE = TAXON_ID_ATTRIBUTES[0]
+# The typed arrays of an ObservationBatch and the attributes they are decoded from, by column.
+NUMERIC_COLUMNS = {"taxon_id": ("taxon_ids", TAXON_ID_ATTRIBUTES),
+                   "start_date": ("start", [START_DATE_ATTRIBUTE]),
+                   "end_date": ("end", [END_DATE_ATTRIBUTE]),
+                   "easting": ("easting", WGS84_ATTRIBUTES),
+                   "northing": ("northing", WGS84_ATTRIBUTES)}
+
+
+@lru_cache(maxsize=65536)
+def parse_date(date: str):
+    """Returns the ISO 8601 date and time `date` as the tuple (seconds since the epoch, UTC
+       offset in seconds). Dates without time zone are taken to be UTC."""
+    d = parse_iso_datetime(date)
+    offset = d.utcoffset()
+    if offset is None:
+        return int(d.replace(tzinfo=timezone.utc).timestamp()), 0
+    return int(d.timestamp()), int(offset.total_seconds())
+
+
+class ObservationRecord:
+    """One observation of an ObservationBatch."""
+
+    __slots__ = ('batch', 'index')
+
+    def __init__(self, batch, index: int):
+        self.batch = batch
+        self.index = index
+
+    @property
+    def id(self):
+        return self.batch.ids[self.index]
+
+    @property
+    def taxon_id(self):
+        taxon_id = self.batch.taxon_ids[self.index]
+        return taxon_id if taxon_id >= 0 else None
+
+    @property
+    def start_date(self):
+        """The start date as a datetime in the time zone it was given in, or None."""
+        return self.batch.datetime(self.batch.start, self.batch.start_offset, self.index)
+
+    @property
+    def end_date(self):
+        """The end date as a datetime in the time zone it was given in, or None."""
+        return self.batch.datetime(self.batch.end, self.batch.end_offset, self.index)
+
+    @property
+    def easting(self):
+        e = self.batch.easting[self.index]
+        return None if math.isnan(e) else e
+
+    @property
+    def northing(self):
+        n = self.batch.northing[self.index]
+        return None if math.isnan(n) else n
+
+    def string(self, name: str):
+        """The value of the string attribute `name` of the batch, or None."""
+        return self.batch.strings[name][self.index]
+
+
+class ObservationBatch:
+    """Decoded observations. `ids` is a list of observation ids, `taxon_ids` int64 taxon ids
+       (-1 if missing), `start` and `end` int64 seconds since the epoch (INT64_MIN if missing),
+       `start_offset` and `end_offset` the UTC offsets of the dates in seconds, and `easting`
+       and `northing` float64 WGS 84 coordinates (NaN if missing). `strings` maps names to lists
+       of attribute values, for the string attributes asked for when decoding."""
+
+    __slots__ = ('ids', 'taxon_ids', 'start', 'start_offset', 'end', 'end_offset',
+                 'easting', 'northing', 'strings')
+
+    def __init__(self, string_names=()):
+        self.ids = []
+        self.taxon_ids = array.array('q')
+        self.start = array.array('q')
+        self.start_offset = array.array('i')
+        self.end = array.array('q')
+        self.end_offset = array.array('i')
+        self.easting = array.array('d')
+        self.northing = array.array('d')
+        self.strings = {name: [] for name in string_names}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index: int):
+        if not -len(self) <= index < len(self):
+            raise IndexError("observation index out of range")
+        return ObservationRecord(self, index % len(self))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield ObservationRecord(self, i)
+
+    def datetime(self, seconds, offsets, index: int):
+        """Returns element `index` of the date array `seconds` as a datetime with the UTC offset
+           in `offsets`, or None if it is missing."""
+        if seconds[index] == INT64_MIN:
+            return None
+        tz = timezone(timedelta(seconds=offsets[index]))
+        return datetime.fromtimestamp(seconds[index], tz)
+
+
+def numeric_columns(projection: Projection = None):
+    """Returns the names of the columns in NUMERIC_COLUMNS that `decode_observations()` decodes
+       from observations searched for with `projection`: those whose attributes it includes."""
+    return [name for name, (_, attributes) in NUMERIC_COLUMNS.items()
+            if projection is None or all(projection.includes(a) for a in attributes)]
+
+
+def decoded_attributes(strings: dict = None, projection: Projection = None):
+    """Returns the list of observation attributes read by `decode_observations()` when
+       decoding the string attributes `strings` of observations searched for with
+       `projection`."""
+    attributes = list(ID_ATTRIBUTES)
+    for name in numeric_columns(projection):
+        attributes.extend(NUMERIC_COLUMNS[name][1])
+    return list(dict.fromkeys(attributes + list((strings or {}).values())))
+
+
+def decode_observations(observations: list, strings: dict = None,
+                        projection: Projection = None):
+    """Returns an ObservationBatch of the observations in `observations`. `strings` maps names
+       to the attributes (dot separated paths, like "location.locality") to decode as strings
+       into the `strings` of the batch. If the observations were searched for with the
+       `projection`, the strings default to its strings, and the attributes not in the
+       projection are not looked for but set as missing."""
+    if projection is not None and strings is None:
+        strings = projection.strings
+    strings = strings or {}
+    n = len(observations)
+
+    def included(attribute):
+        return projection is None or projection.includes(attribute)
+
+    batch = ObservationBatch(strings)
+    batch.ids = [str(observation_id(o)) for o in observations]
+    if included(TAXON_ID_ATTRIBUTE):
+        taxon_ids = [field_value(o, TAXON_ID_ATTRIBUTE) for o in observations]
+        batch.taxon_ids = array.array('q', [int(t) if t is not None else -1 for t in taxon_ids])
+    else:
+        batch.taxon_ids = array.array('q', [-1]) * n
+    for attribute, seconds, offsets in ((START_DATE_ATTRIBUTE, batch.start, batch.start_offset),
+                                        (END_DATE_ATTRIBUTE, batch.end, batch.end_offset)):
+        if included(attribute):
+            parsed = [parse_date(d) if d else (INT64_MIN, 0)
+                      for d in (field_value(o, attribute) for o in observations)]
+            seconds.extend(p[0] for p in parsed)
+            offsets.extend(p[1] for p in parsed)
+        else:
+            seconds.extend(array.array('q', [INT64_MIN]) * n)
+            offsets.extend(array.array('i', [0]) * n)
+    if all(included(a) for a in WGS84_ATTRIBUTES):
+        coordinates = [observation_wgs84(o) for o in observations]
+        batch.easting = array.array('d', [float(e) if e is not None else math.nan
+                                          for e, _ in coordinates])
+        batch.northing = array.array('d', [float(n) if n is not None else math.nan
+                                           for _, n in coordinates])
+    else:
+        batch.easting = array.array('d', [math.nan]) * n
+        batch.northing = array.array('d', [math.nan]) * n
+    for name, attribute in strings.items():
+        values = [field_value(o, attribute) for o in observations]
+        batch.strings[name] = [str(v) if v is not None else None for v in values]
+    return batch
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+"""
+Python module for exporting observations from Artportalens ObservationsAPI to a typed, columnar
+file. The file is a NumPy .npz archive (a zip file of .npy arrays) that is written with standard
+modules only, so it can be read with `numpy.load()` as well as with `read_columns()` here.
+
+The observations are written in row groups of a fixed number of rows, so only one row group is
+held in memory. The arrays of row group N are named "rgNNNN/<column>". The columns are:
+
+* id: the observation id, as a fixed width Unicode string.
+* taxon_id: the taxon id as int64, -1 if missing.
+* start_date, end_date: the event start and end dates as int64 seconds since the epoch,
+  INT64_MIN (NumPy's NaT) if missing.
+* easting, northing: the WGS 84 longitude and latitude as float64, NaN if missing.
+* One int32 column per dictionary encoded string attribute, holding indexes into the array
+  "dict/<column>" of distinct values, -1 if missing.
+
+When the observations were searched for with a projection (see `artportalen.PROJECTIONS`), only
+the numeric columns whose attributes are in it are written (see `apdecode.NUMERIC_COLUMNS`), and
+the string columns default to the strings of the projection.
+"""
+
+import ast
+import array
+import struct
+import zipfile
+from itertools import islice
+from artportalen import PROJECTIONS, Projection
+from apdecode import (NUMERIC_COLUMNS, ObservationBatch, decode_observations, decoded_attributes,
+                      numeric_columns)
+
+# Constants
+DEFAULT_ROW_GROUP_SIZE = 65536
+DECODE_BATCH_SIZE = 1000  # Number of observations decoded at a time
+# The string attributes that are dictionary encoded without a projection, by column name.
+DEFAULT_STRING_COLUMNS = PROJECTIONS["export"].strings
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+NPY_TYPES = {'q': '<i8', 'i': '<i4', 'd': '<f8'}  # .npy types of array module types
+
+
+def npy_bytes(descr: str, count: int, data: bytes):
+    """Returns a .npy file (format version 1.0) with the one-dimensional array of `count`
+       elements of type `descr` whose raw little-endian contents are `data`."""
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (descr, count)
+    padding = 64 - (len(NPY_MAGIC) + 2 + len(header) + 1) % 64
+    header = (header + ' ' * padding + '\n').encode('latin1')
+    return NPY_MAGIC + struct.pack('<H', len(header)) + header + data
+
+
+def numeric_npy(typecode: str, descr: str, values):
+    """Returns a .npy file with the numbers `values` stored as `descr`, using the array module
+       type `typecode` for the conversion."""
+    a = array.array(typecode, values)
+    if struct.pack('=H', 1) != struct.pack('<H', 1):
+        a.byteswap()
+    return npy_bytes(descr, len(a), a.tobytes())
+
+
+def string_npy(values: list):
+    """Returns a .npy file with the strings `values` as a fixed width Unicode array."""
+    width = max((len(v) for v in values), default=0) or 1
+    data = b''.join(v.ljust(width, '\0').encode('utf-32-le') for v in values)
+    return npy_bytes('<U%d' % width, len(values), data)
+
+
+def read_npy(data: bytes):
+    """Returns the one-dimensional array in the .npy file `data` as a list of Python values."""
+    header_length = struct.unpack('<H', data[8:10])[0]
+    header = ast.literal_eval(data[10:10 + header_length].decode('latin1'))
+    body = data[10 + header_length:]
+    descr = header['descr']
+    count = header['shape'][0]
+    if descr.startswith('<U'):
+        width = int(descr[2:])
+        return [body[i * width * 4:(i + 1) * width * 4].decode('utf-32-le').rstrip('\0')
+                for i in range(count)]
+    a = array.array({d: t for t, d in NPY_TYPES.items()}[descr])
+    a.frombytes(body)
+    if struct.pack('=H', 1) != struct.pack('<H', 1):
+        a.byteswap()
+    return a.tolist()
+
+
+class ColumnarWriter:
+    """Writes observations to the columnar file `path`, in row groups of `row_group_size`
+       observations. `string_columns` maps the names of the dictionary encoded columns to the
+       observation attributes they hold. It defaults to the strings of `projection` if it is
+       given, and otherwise to DEFAULT_STRING_COLUMNS. If the observations were searched for
+       with the `projection`, only the numeric columns whose attributes are in it are written,
+       and ValueError is raised if it lacks any of the attributes of the string columns.
+       Instances are context managers."""
+
+    def __init__(self, path: str, row_group_size: int = DEFAULT_ROW_GROUP_SIZE,
+                 string_columns: dict = None, projection: Projection = None):
+        """Initialization. Creates the file."""
+        if string_columns is None:
+            string_columns = (projection.strings if projection is not None
+                              else DEFAULT_STRING_COLUMNS)
+        if projection is not None:
+            projection.check(decoded_attributes(string_columns, projection),
+                             "the columnar export")
+        self.projection = projection
+        self.path = path
+        self.row_group_size = row_group_size
+        self.numeric_columns = numeric_columns(projection)
+        self.string_columns = dict(string_columns)
+        self.dictionaries = {name: {} for name in self.string_columns}
+        self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        self.row_groups = 0
+        self.count = 0
+        self.new_row_group()
+
+    def new_row_group(self):
+        """Start collecting the rows of a new row group."""
+        self.rows = ObservationBatch(self.string_columns)
+        self.codes = {name: [] for name in self.string_columns}
+
+    def write(self, o: dict):
+        """Write the observation `o`."""
+        self.write_batch(decode_observations([o], self.string_columns, self.projection))
+
+    def write_many(self, observations):
+        """Write the observations in the iterable `observations`. Returns the number written.
+           The observations are decoded in batches."""
+        n = self.count
+        observations = iter(observations)
+        while True:
+            page = list(islice(observations, DECODE_BATCH_SIZE))
+            if not page:
+                return self.count - n
+            self.write_batch(decode_observations(page, self.string_columns, self.projection))
+
+    def write_batch(self, batch: ObservationBatch):
+        """Write the observations in `batch`, decoded with the string columns of this writer."""
+        start = 0
+        while start < len(batch):
+            end = min(len(batch), start + self.row_group_size - len(self.rows))
+            rows = self.rows
+            rows.ids.extend(batch.ids[start:end])
+            for column in ObservationBatch.__slots__[1:-1]:
+                getattr(rows, column).extend(getattr(batch, column)[start:end])
+            for name in self.string_columns:
+                codes = self.dictionaries[name]
+                self.codes[name].extend(codes.setdefault(v, len(codes)) if v is not None else -1
+                                        for v in batch.strings[name][start:end])
+            self.count += end - start
+            start = end
+            if len(self.rows) == self.row_group_size:
+                self.flush()
+
+    def flush(self):
+        """Write the observations written since the last row group as a row group."""
+        rows = self.rows
+        if not len(rows):
+            return
+        prefix = "rg%04d/" % self.row_groups
+        self.zip.writestr(prefix + "id.npy", string_npy(rows.ids))
+        for column in self.numeric_columns:
+            values = getattr(rows, NUMERIC_COLUMNS[column][0])
+            self.zip.writestr(prefix + column + ".npy",
+                              numeric_npy(values.typecode, NPY_TYPES[values.typecode], values))
+        for name in self.string_columns:
+            self.zip.writestr(prefix + name + ".npy", numeric_npy('i', '<i4', self.codes[name]))
+        self.row_groups += 1
+        self.new_row_group()
+
+    def close(self):
+        """Write the last row group and the dictionaries, and close the file."""
+        self.flush()
+        for name, codes in self.dictionaries.items():
+            self.zip.writestr("dict/" + name + ".npy", string_npy(list(codes)))
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def export_observations(observations, path: str, row_group_size: int = DEFAULT_ROW_GROUP_SIZE,
+                        string_columns: dict = None, projection: Projection = None):
+    """Write the observations in the iterable `observations`, for instance from
+       `ObservationsAPI.iter_observations()`, to the columnar file `path`. Returns the number
+       of observations written."""
+    with ColumnarWriter(path, row_group_size, string_columns, projection) as writer:
+        return writer.write_many(observations)
+
+
+def read_columns(path: str, decode_strings: bool = True):
+    """Returns the columns in the columnar file `path` as a dictionary of lists, with the row
+       groups concatenated. Dictionary encoded columns are decoded to strings (None if missing)
+       if `decode_strings` is true."""
+    columns = {}
+    dictionaries = {}
+    with zipfile.ZipFile(path) as z:
+        for name in z.namelist():
+            group, column = name[:-len(".npy")].split('/')
+            values = read_npy(z.read(name))
+            if group == "dict":
+                dictionaries[column] = values
+            else:
+                columns.setdefault(column, []).extend(values)
+    if decode_strings:
+        for column, values in dictionaries.items():
+            columns[column] = [values[i] if i >= 0 else None for i in columns.get(column, [])]
+    return columns
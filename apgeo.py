@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+Python module with the geometry needed for searching observations within polygons: splitting
+polygons into bounding box tiles that can be searched separately, and testing which points are
+inside polygons. Coordinates are WGS 84 (longitude, latitude) pairs, and polygons are nested
+lists like GeoJSON coordinates: a polygon is a list of rings, the first being the exterior and
+the rest holes, and a ring is a list of [longitude, latitude] points.
+"""
+
+import math
+import bisect
+
+# Constants
+DEFAULT_TILE_SIZE = 0.5  # Degrees
+
+
+def polygons(geometry: list):
+    """Returns `geometry` as a list of polygons. `geometry` can be a ring, a polygon (a list of
+       rings) or a multipolygon (a list of polygons), with the nesting of GeoJSON coordinates."""
+    depth = 0
+    g = geometry
+    while isinstance(g, (list, tuple)) and g and isinstance(g[0], (list, tuple)):
+        depth += 1
+        g = g[0]
+    if depth == 1:
+        return [[geometry]]
+    if depth == 2:
+        return [geometry]
+    if depth == 3:
+        return list(geometry)
+    raise ValueError("The geometry is not a ring, polygon or multipolygon")
+
+
+def bounding_box(polygons: list):
+    """Returns the bounding box (west, south, east, north) of the list of polygons."""
+    xs = [p[0] for polygon in polygons for p in polygon[0]]
+    ys = [p[1] for polygon in polygons for p in polygon[0]]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def segment_intersects_box(x0, y0, x1, y1, box):
+    """True if the line segment from (x0, y0) to (x1, y1) intersects the box (west, south,
+       east, north). Uses Liang-Barsky clipping."""
+    west, south, east, north = box
+    t0, t1 = 0.0, 1.0
+    dx, dy = x1 - x0, y1 - y0
+    for p, q in ((-dx, x0 - west), (dx, east - x0), (-dy, y0 - south), (dy, north - y0)):
+        if p == 0:
+            if q < 0:
+                return False
+        else:
+            t = q / p
+            if p < 0:
+                t0 = max(t0, t)
+            else:
+                t1 = min(t1, t)
+            if t0 > t1:
+                return False
+    return True
+
+
+def box_intersects_polygons(box, polygons: list):
+    """True if the box (west, south, east, north) intersects any of the polygons."""
+    west, south, east, north = box
+    for polygon in polygons:
+        for ring in polygon:
+            for (x0, y0), (x1, y1) in zip(ring, ring[1:] + ring[:1]):
+                if segment_intersects_box(x0, y0, x1, y1, box):
+                    return True
+    # No edge crosses the box, so it is either entirely inside or entirely outside.
+    return points_in_polygons([west], [south], polygons)[0]
+
+
+def tiles(polygons: list, tile_size: float = DEFAULT_TILE_SIZE):
+    """Returns the list of tiles, boxes (west, south, east, north) of at most `tile_size`
+       degrees, of a grid over the bounding box of the polygons that intersect the polygons."""
+    west, south, east, north = bounding_box(polygons)
+    columns = max(1, math.ceil((east - west) / tile_size))
+    rows = max(1, math.ceil((north - south) / tile_size))
+    width = (east - west) / columns
+    height = (north - south) / rows
+    result = []
+    for row in range(rows):
+        for column in range(columns):
+            box = (west + column * width, south + row * height,
+                   east if column == columns - 1 else west + (column + 1) * width,
+                   north if row == rows - 1 else south + (row + 1) * height)
+            if box_intersects_polygons(box, polygons):
+                result.append(box)
+    return result
+
+
+def points_in_polygons(xs: list, ys: list, polygons: list):
+    """Returns a list of booleans telling which of the points (xs[i], ys[i]) are inside any of
+       the polygons. Points on an edge may be counted as inside or outside. The test is done for
+       all points at once with the even-odd rule, one polygon edge at a time: the points are
+       sorted by latitude once, so each edge only visits the points within its latitude span."""
+    n = len(xs)
+    order = sorted(range(n), key=ys.__getitem__)
+    sorted_ys = [ys[i] for i in order]
+    result = [False] * n
+    for polygon in polygons:
+        inside = [False] * n
+        for ring in polygon:
+            for (x0, y0), (x1, y1) in zip(ring, ring[1:] + ring[:1]):
+                if y0 == y1:
+                    continue
+                ylo, yhi = (y0, y1) if y0 < y1 else (y1, y0)
+                slope = (x1 - x0) / (y1 - y0)
+                for k in range(bisect.bisect_left(sorted_ys, ylo),
+                               bisect.bisect_left(sorted_ys, yhi)):
+                    i = order[k]
+                    if xs[i] < x0 + (ys[i] - y0) * slope:
+                        inside[i] = not inside[i]
+        result = [a or b for a, b in zip(result, inside)]
+    return result
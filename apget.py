@@ -1,26 +1,46 @@
 #!/usr/bin/env python3
 
-"""This is the new CLI program that gets stuff from the Artdatabanken Observations API and Species API and prints it to stdout."""
+"""This is the new CLI program that gets stuff from the Artdatabanken Observations API and Species
+API and prints it to stdout."""
 
 import sys
+import atexit
 import argparse
 import os
 import os.path
 from datetime import datetime
-import dateutil.parser
 import pprint
 import artportalen
+import apcache
+import apretry
+import apkeys
+import apmetrics
+import apbulk
+import applan
+import taxonindex
+import apexport
+import apdecode
 
 # Constants
 DEFAULT_CONF_FILE_PATH = 'adb-get.conf'
 DEFAULT_FROM_DATE_RFC3339 = '1900-01-01T00:00'
 ADB_SPECIES_API_KEY_ENV_NAME = 'ADB_SPECIES_API_KEY'
 ADB_OBSERVATIONS_API_KEY_ENV_NAME = 'ADB_OBSERVATIONS_API_KEY'
+ADB_OBSERVATIONS_API_KEYS_ENV_NAME = 'ADB_OBSERVATIONS_API_KEYS'
+ADB_AUTH_TOKEN_ENV_NAME = 'ADB_AUTH_TOKEN'
 ADB_API_ROOT_URL = 'https://api.artdatabanken.se'
+ADB_API_ROOT_URL_ENV_NAME = 'ADB_API_ROOT_URL'
 ADB_SPECIES_API_PATH = '/information/v1/speciesdataservice/v1/'
 ADB_OBSERVATIONS_API_PATH = '/species-observation-system/v1/Observations/Search'
 ADB_COORDINATSYSTEM_WGS_84_ID = 10
 AVES_TAXON_ID = 4000104
+SEARCH_CACHE_PAGES = 64  # Search result pages kept in memory
+SEARCH_CACHE_BYTES = 256 * 1024 * 1024  # Maximum size of the search result cache on disk
+# The observation attributes printed by pretty_print_observations, by name.
+OBSERVATION_DISPLAY_ATTRIBUTES = artportalen.PROJECTIONS["display"].strings
+# All observation attributes read by pretty_print_observations.
+PRETTY_PRINT_ATTRIBUTES = (artportalen.DATE_ATTRIBUTES + artportalen.WGS84_ATTRIBUTES
+                           + list(OBSERVATION_DISPLAY_ATTRIBUTES.values()))
 
 
 def species_api_key():
@@ -39,6 +59,27 @@ def observations_api_key():
         return None
 
 
+def observations_key_pool():
+    """A key pool of the Observations API keys in the keys environment variable if it is set,
+       otherwise None. Raises ValueError if a rate or quota in it is not a number."""
+    keys = apkeys.parse_keys(os.environ.get(ADB_OBSERVATIONS_API_KEYS_ENV_NAME, ''))
+    return apkeys.KeyPool(keys) if keys else None
+
+
+def api_root_url():
+    """Value of the API root URL environment variable if it is set, otherwise the root URL of
+       Artdatabankens API:s."""
+    return os.environ.get(ADB_API_ROOT_URL_ENV_NAME, ADB_API_ROOT_URL)
+
+
+def print_key_usage(key_pool):
+    """Print the usage statistics of the keys of 'key_pool' to stdout."""
+    for usage in key_pool.usage():
+        print(f"API key {usage['name']}: {usage['requests']} requests, "
+              f"{usage['throttled']} throttled, {usage['errors']} errors, "
+              f"{usage['remaining']} left of the quota")
+
+
 def pretty_print_taxon(t):
     """Pretty print the taxon 't' to stdout."""
     print("%s (%s) taxon id: %s" % (t['swedishName'].capitalize(),
@@ -52,46 +93,45 @@ def pretty_print_taxon(t):
         print(" Text: %s" % (item['criterionText']))
 
 
-def pretty_print_observation(o):
-    """Pretty print the observation 'o' to stdout."""
-    fdate = dateutil.parser.parse(o['startDate'])
-    edate = dateutil.parser.parse(o['endDate'])
-    if fdate != edate:
-        if fdate.hour != 0 and fdate.minute != 0 and edate.hour != 0 and edate.minute != 0:
-            print("%s %s-%s" % ('{:%Y-%m-%d}'.format(fdate),
-                                '{:%H:%M}'.format(fdate),
-                                '{:%H:%M}'.format(edate)))
-        else:
-            print("%s" % ('{:%Y-%m-%d}'.format(fdate)))
-    else:
-        if fdate.hour != 0 and fdate.minute != 0:
-            print("%s" % ('{:%Y-%m-%d %H:%M}'.format(fdate)))
+def pretty_print_observations(observations, projection=None):
+    """Pretty print the observations in the list 'observations' to stdout. The observations are
+    decoded in one batch, which is much faster than decoding them one at a time. 'projection' is
+    the projection the observations were searched for with, if any."""
+    batch = apdecode.decode_observations(observations, OBSERVATION_DISPLAY_ATTRIBUTES,
+                                         projection)
+    for o in batch:
+        fdate = o.start_date
+        edate = o.end_date or fdate
+        if fdate is None:
+            print("<attributet saknas>")
+        elif fdate != edate:
+            if fdate.hour != 0 and fdate.minute != 0 and edate.hour != 0 and edate.minute != 0:
+                print("%s %s-%s" % ('{:%Y-%m-%d}'.format(fdate),
+                                    '{:%H:%M}'.format(fdate),
+                                    '{:%H:%M}'.format(edate)))
+            else:
+                print("%s" % ('{:%Y-%m-%d}'.format(fdate)))
         else:
-            print("%s" % ('{:%Y-%m-%d}'.format(fdate)))
-    if 'discoveryMethod' in o:
-        print(" Upptäcksmetod: %s" % (o['discoveryMethod']))
-    else:
-        print(" Upptäcksmetod: %s" % ("<attributet saknas>"))
-    print(" Rapportör: %s" % (o['owner']))
-    print(" Observatörer: %s" % (o['sightingObservers']))
-    print(" Var: %s" % (o['site']['presentationName']))
-    if 'publicComment' in o:
-        print(" Kommentar: %s " % (o['publicComment'].strip()))
-    else:
-        print(" Kommentar: %s" % ("<atributet saknas>"))
-    # Get WGS 84 coordinates so we can create URL:s for Google Maps and Open Street Map
-    for c in o['site']['coordinates']:
-        if c['coordinateSystemId'] == ADB_COORDINATSYSTEM_WGS_84_ID:
-            easting = c['easting']
-            northing = c['northing']
-    gm_url = "https://www.google.com/maps/search/?api=1&query=%s,%s" % (northing, easting)
-    osm_url = "https://www.openstreetmap.org/?mlat=%s&mlon=%s" % (northing, easting)
-    print(" Google Maps location: %s" % (gm_url))
-    print(" Open Street Maps location: %s" % (osm_url))
-#    print(" Google Maps location: %s" % ("https://www.google.com/maps/@?api=1&
-# map_action=map&center=56.711061,16.3535513&zoom=12&basemap=terrain"))
-#    print(" Open Street Maps location: %s" % ("https://www.openstreetmap.org/?
-# mlat=-38.3653&mlon=144.9069#map=9/-38.3653/144.9069"))
+            if fdate.hour != 0 and fdate.minute != 0:
+                print("%s" % ('{:%Y-%m-%d %H:%M}'.format(fdate)))
+            else:
+                print("%s" % ('{:%Y-%m-%d}'.format(fdate)))
+        print(" Upptäcksmetod: %s" % (o.string('discovery_method') or "<attributet saknas>"))
+        print(" Rapportör: %s" % (o.string('reporter')))
+        print(" Observatörer: %s" % (o.string('observers')))
+        print(" Var: %s" % (o.string('site')))
+        comment = o.string('comment')
+        print(" Kommentar: %s" % (comment.strip() if comment else "<atributet saknas>"))
+        # Get WGS 84 coordinates so we can create URL:s for Google Maps and Open Street Map
+        easting = o.easting
+        northing = o.northing
+        if easting is None or northing is None:
+            print(" Plats: <attributet saknas>")
+            continue
+        gm_url = "https://www.google.com/maps/search/?api=1&query=%s,%s" % (northing, easting)
+        osm_url = "https://www.openstreetmap.org/?mlat=%s&mlon=%s" % (northing, easting)
+        print(" Google Maps location: %s" % (gm_url))
+        print(" Open Street Maps location: %s" % (osm_url))
 
 
 def today_RFC3339():
@@ -101,10 +141,24 @@ def today_RFC3339():
 
 
 def main():
+    """Run the program. Exits with an error message if the quotas of all API keys are used."""
+    try:
+        run()
+    except apkeys.QuotaExhausted as e:
+        print(f"Error: {e}")
+        sys.exit(9)
+
+
+def run():
     desc = """CLI-program for getting stuff from the Artdatabanken API:s. Note that you must set the
 two API keys as environment variables. Ie:
 export ADB_SPECIES_API_KEY=<API-KEY>
-export ADB_OBSERVATIONS_API_KEY=<API-KEY>"""
+export ADB_OBSERVATIONS_API_KEY=<API-KEY>
+Requests to the Observations API can be spread over several API keys, each optionally followed by
+its rate per second and daily quota, with for instance:
+export ADB_OBSERVATIONS_API_KEYS=<API-KEY>:5:100000,<API-KEY>::50000
+A stand-in server, like the mock server of apbench.py, can be used with:
+export ADB_API_ROOT_URL=http://127.0.0.1:<PORT>"""
     parser = argparse.ArgumentParser(description=desc)
     parser.add_argument('-v', '--verbose', action='store_true', default=False,
                         help="print info about what's going on [False].")
@@ -116,6 +170,9 @@ export ADB_OBSERVATIONS_API_KEY=<API-KEY>"""
                         help="Artdatabanken's taxon name in Swedish")
     parser.add_argument('--exact-match', action='store_true', default=False,
                         help="Do exact match on taxon name [False]")
+    parser.add_argument('--fuzzy-match', action='store_true', default=False,
+                        help="Match taxon names with spelling mistakes in the --taxon-index "
+                        "[False]")
     parser.add_argument('--print-full-taxon-info', action='store_true', default=False,
                         help="Print full info on every taxon [False]")
     parser.add_argument('--pretty-print', action='store_true', default=False,
@@ -137,28 +194,83 @@ export ADB_OBSERVATIONS_API_KEY=<API-KEY>"""
                         help="Offset [0]")
     parser.add_argument('--limit', default=200,
                         help="Limit [200]")
+    parser.add_argument('--area-type', default="Municipality",
+                        help="Type of the area to get observations in [Municipality]")
+    parser.add_argument('--area-name',
+                        help="Name of the area to get observations in. Use with '-g'")
+    parser.add_argument('--projection', choices=sorted(artportalen.PROJECTIONS),
+                        help="Only get the observation attributes in this projection. Defaults "
+                        "to 'display' with '--pretty-print' and 'export' with '--export'")
+    parser.add_argument('--export',
+                        help="Export the observations to this columnar .npz file. Use with '-g'")
+    parser.add_argument('--bulk', action='store_true', default=False,
+                        help="Export with a bulk export job instead of paging, for big exports. "
+                        "Use with '--export'. Set a user token in ADB_AUTH_TOKEN if needed [False]")
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help="Parse the pages of observations while they are downloaded, when "
+                        "exporting by paging. Use with '--export' [False]")
+    parser.add_argument('--plan', action='store_true', default=False,
+                        help="Count the observations first and print a plan for fetching all of "
+                        "them. With '--export' the plan is then carried out [False]")
+    parser.add_argument('--metrics',
+                        help="Write Prometheus metrics of the API requests to this file on exit")
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help="Don't use the local caches of species, area, search and API data "
+                        "[False]")
+    parser.add_argument('--taxon-index',
+                        help="Local taxon name index file, made with taxonindex.py")
     args = parser.parse_args()
     if not species_api_key():
         print("Error: Environment variable ADB_SPECIES_API_KEY not set.")
         sys.exit(1)
-    if not observations_api_key():
+    try:
+        key_pool = observations_key_pool()
+    except ValueError as e:
+        print(f"Error: Environment variable ADB_OBSERVATIONS_API_KEYS is invalid: {e}")
+        sys.exit(1)
+    if not observations_api_key() and key_pool is None:
         print("Error: Environment variable ADB_OBSERVATIONS_API_KEY not set.")
         sys.exit(1)
-    sapi = artportalen.SpeciesAPI(species_api_key())
-    oapi = artportalen.ObservationsAPI(observations_api_key())
+    session = artportalen.new_session()
+    executor = apretry.RequestExecutor()
+    if args.metrics:
+        metrics = apmetrics.PrometheusMetrics()
+        executor.add_hook(metrics)
+        atexit.register(metrics.write, args.metrics)
+    species_cache = None if args.no_cache else apcache.open_cache("species")
+    index = taxonindex.TaxonIndex(args.taxon_index) if args.taxon_index else None
+    sapi = artportalen.SpeciesAPI(species_api_key(), session=session, cache=species_cache,
+                                  index=index, executor=executor, root_url=api_root_url())
+    area_cache = None if args.no_cache else apcache.open_cache("areas")
+    http_cache = None if args.no_cache else apcache.open_cache("http")
+    search_cache = None
+    if not args.no_cache:
+        search_cache = apcache.open_cache("searches", maxsize=SEARCH_CACHE_PAGES,
+                                          max_bytes=SEARCH_CACHE_BYTES)
+    oapi = artportalen.ObservationsAPI(observations_api_key() or key_pool.keys[0].key,
+                                       session=session, area_cache=area_cache, cache=http_cache,
+                                       search_cache=search_cache, executor=executor,
+                                       key_pool=key_pool, root_url=api_root_url())
+    if key_pool is not None and args.verbose:
+        atexit.register(print_key_usage, key_pool)
     if args.get_api_versions:
         v = oapi.version(args.verbose)
         print("Observations API:")
         pprint.pprint(v)
         print("Species API: No API resource for version")
+        if args.verbose and oapi.http_cache is not None:
+            print(f"HTTP cache: {oapi.http_cache.stats.as_dict()}")
         sys.exit(0)
+    if args.fuzzy_match and not args.taxon_index:
+        print("Error: Flag --fuzzy-match needs a --taxon-index.")
+        sys.exit(1)
     if args.taxon_name and args.taxon_id:
         print("Error: Flags --taxon-name and --taxon-id cannot be used at the same time.")
         sys.exit(1)
     if args.taxon_name:
         taxa = sapi.taxa_by_name(args.taxon_name,
                                  exact_match=args.exact_match,
-                                 verbose=args.verbose)
+                                 verbose=args.verbose, fuzzy=args.fuzzy_match)
         if not taxa:
             errmsg = (f"No taxon/taxa with name '{args.taxon_name}' found "
                       "in Artdatabankens Species API.")
@@ -186,7 +298,7 @@ export ADB_OBSERVATIONS_API_KEY=<API-KEY>"""
     if args.get_observations:
         result = None
         if args.taxon_name:
-            taxa = sapi.taxa_by_name(args.taxon_name)
+            taxa = sapi.taxa_by_name(args.taxon_name, fuzzy=args.fuzzy_match)
             if not taxa:
                 errmsg = (f"Error: No taxon with name '{args.taxon_name}' found "
                           "in Artdatabankens Species API.")
@@ -204,9 +316,30 @@ export ADB_OBSERVATIONS_API_KEY=<API-KEY>"""
             else:
                 taxon_id = args.taxon_id
         sfilter = artportalen.SearchFilter()
-        sfilter.set_geographics_areas(areas=[{"area_type": "Municipality", "featureId": "180"}])
+        if args.area_name:
+            areas = oapi.area_catalog.resolve(args.area_type, args.area_name, args.verbose)
+            if not areas:
+                print(f"Error: No area of type {args.area_type} named '{args.area_name}'.")
+                sys.exit(6)
+        else:
+            areas = [{"area_type": "Municipality", "featureId": "180"}]
+        sfilter.set_geographics_areas(areas=areas)
         sfilter.set_verification_status()
-        sfilter.set_output()
+        projection = None
+        if args.projection:
+            projection = artportalen.PROJECTIONS[args.projection]
+        elif args.export:
+            projection = artportalen.PROJECTIONS["export"]
+        elif args.pretty_print:
+            projection = artportalen.PROJECTIONS["display"]
+        if projection is not None:
+            missing = projection.missing(PRETTY_PRINT_ATTRIBUTES)
+            if args.pretty_print and not args.export and missing:
+                print(f"Warning: The projection {projection.name} lacks the attributes "
+                      f"{', '.join(missing)}, that are printed as missing.")
+            sfilter.set_projection(projection)
+        else:
+            sfilter.set_output()
         sfilter.set_date(startDate=args.from_date,
                          endDate=args.to_date,
                          dateFilterType="OverlappingStartDateAndEndDate",
@@ -215,11 +348,52 @@ export ADB_OBSERVATIONS_API_KEY=<API-KEY>"""
         sfilter.set_dataProvider()
         if args.taxon_name or args.taxon_id:
             sfilter.set_taxon(ids=[taxon_id])
-        result = oapi.observations(sfilter,
-                                   skip=args.offset,
-                                   take=args.limit,
-                                   sort_descending=not args.sort_reverse)
-        pprint.pprint(result)
+        if args.plan:
+            planner = applan.SearchPlanner(oapi)
+            try:
+                plan = planner.plan(sfilter, verbose=args.verbose)
+            except artportalen.APIError as e:
+                print(f"Error: {e}")
+                sys.exit(8)
+            print(f"Plan: {plan}")
+            if not args.export:
+                sys.exit(0)
+        if args.export:
+            try:
+                if args.plan:
+                    observations = planner.execute(plan, sort_descending=not args.sort_reverse,
+                                                   verbose=args.verbose)
+                    n = apexport.export_observations(observations, args.export,
+                                                     projection=projection)
+                elif args.bulk:
+                    bulk = apbulk.BulkExport(oapi,
+                                             auth_token=os.environ.get(ADB_AUTH_TOKEN_ENV_NAME))
+                    n = bulk.to_columnar(sfilter, args.export, verbose=args.verbose,
+                                         projection=projection)
+                else:
+                    observations = oapi.iter_observations(sfilter,
+                                                          skip=int(args.offset),
+                                                          limit=int(args.limit),
+                                                          sort_descending=not args.sort_reverse,
+                                                          stream=args.stream)
+                    n = apexport.export_observations(observations, args.export,
+                                                     projection=projection)
+            except ValueError as e:
+                print(f"Error: {e}")
+                sys.exit(7)
+            except artportalen.APIError as e:
+                print(f"Error: {e}")
+                sys.exit(8)
+            print(f"Exported {n} observations to {args.export}")
+        else:
+            result = oapi.observations(sfilter,
+                                       skip=args.offset,
+                                       take=args.limit,
+                                       sort_descending=not args.sort_reverse)
+            if args.pretty_print and result is not None:
+                pretty_print_observations(artportalen.page_records(result), projection)
+            else:
+                pprint.pprint(result)
         if args.show_search_filter:
             print("==============")
             print("Search filter:")
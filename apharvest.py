@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""
+Python module with resumable harvest jobs, that download all observations matching a search
+filter from Artportalens ObservationsAPI to a local `apstore.ObservationStore`. The date range of
+the filter can be split into shards that are paged through concurrently. The progress of the job
+is saved in a state file after every stored page: the hash of the filter, the date ranges of the
+shards and the number of observations stored of each shard. A job that is interrupted, for
+instance by a crash or by throttling, continues from the saved progress when it is run again,
+skipping the completed shards and pages. Storing is idempotent, since a stored observation is
+replaced by the same observation if a page is fetched again.
+"""
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from artportalen import (API_MAX_TAKE, API_MAX_SKIP_TAKE, DEFAULT_MAX_WORKERS, APIError,
+                         ObservationsAPI, SearchFilter, page_records)
+from apstore import ObservationStore, read_json, write_json_atomic
+
+
+class HarvestJob:
+    """Harvests the observations matching a search filter from `api` to `store`, saving the
+       progress in the JSON file `state_path`."""
+
+    def __init__(self, api: ObservationsAPI, store: ObservationStore, state_path: str):
+        """Initialization."""
+        self.api = api
+        self.store = store
+        self.state_path = state_path
+        self.state = read_json(state_path)
+        self.lock = threading.Lock()
+
+    def filter_key(self, search_filter: SearchFilter, sortBy: str):
+        """Returns the key of the job of `search_filter` sorted by `sortBy`."""
+        return search_filter.canonical_hash(sort_lists=True) + ':' + sortBy
+
+    def reset(self):
+        """Forget the progress, so the next run starts from the beginning."""
+        self.state = None
+        write_json_atomic(self.state_path, self.state)
+
+    def start(self, search_filter: SearchFilter, shards: int, sortBy: str):
+        """Returns the state of the job of `search_filter`: the saved one if there is one, or a
+           new one with the filter split by date into at most `shards` shards. Raises ValueError
+           if the saved state is of another search filter."""
+        key = self.filter_key(search_filter, sortBy)
+        if self.state:
+            if self.state["filter"] != key:
+                raise ValueError(f"The harvest state {self.state_path} is of another search "
+                                 "filter. Reset it to start a new harvest.")
+            return self.state
+        filters = [search_filter]
+        date = search_filter.filter.get("date") or {}
+        if shards > 1 and date.get("startDate") and date.get("endDate"):
+            filters = search_filter.split_by_date(shards)
+        self.state = {"filter": key, "sortBy": sortBy, "started": time.time(),
+                      "shards": [{"startDate": f.filter.get("date", {}).get("startDate"),
+                                  "endDate": f.filter.get("date", {}).get("endDate"),
+                                  "offset": 0, "pages": 0, "total": None, "done": False}
+                                 for f in filters]}
+        write_json_atomic(self.state_path, self.state)
+        return self.state
+
+    def shard_filter(self, search_filter: SearchFilter, shard: dict):
+        """Returns a copy of `search_filter` with the date range of `shard`."""
+        f = search_filter.copy()
+        for name in ("startDate", "endDate"):
+            if shard[name]:
+                f.filter["date"][name] = shard[name]
+        return f
+
+    def commit(self, shard: dict, page: list, total: int, page_size: int):
+        """Store the observations in `page` of `shard` and then save the progress. The shard
+           is done after a short page, or when `total`, if known, has been stored."""
+        n = self.store.upsert(page)
+        with self.lock:
+            shard["offset"] += len(page)
+            shard["pages"] += 1
+            if total is not None:
+                shard["total"] = total
+            shard["done"] = (len(page) < page_size
+                             or (total is not None and shard["offset"] >= total))
+            self.state["updated"] = time.time()
+            write_json_atomic(self.state_path, self.state)
+        return n
+
+    def harvest_shard(self, search_filter: SearchFilter, shard: dict, page_size: int,
+                      sortBy: str, verbose=False):
+        """Page through the observations of `shard` from its saved offset and store them.
+           Returns the number of observations stored. Raises APIError if a request fails or
+           the shard has more observations than can be paged through."""
+        f = self.shard_filter(search_filter, shard)
+        stored = 0
+        while not shard["done"]:
+            skip = shard["offset"]
+            if skip >= API_MAX_SKIP_TAKE:
+                raise APIError(f"The shard {shard['startDate']}..{shard['endDate']} has more "
+                               f"than {API_MAX_SKIP_TAKE} observations. Use more shards.")
+            take = min(page_size, API_MAX_SKIP_TAKE - skip)
+            result = self.api.observations(f, skip=skip, take=take, sortBy=sortBy,
+                                           sort_descending=False, verbose=verbose)
+            if result is None:
+                raise APIError(f"Observations search failed at skip={skip}",
+                               self.api.last_response())
+            total = result.get("totalCount") if isinstance(result, dict) else None
+            stored += self.commit(shard, page_records(result) or [], total, take)
+        return stored
+
+    def run(self, search_filter: SearchFilter, shards: int = 1,
+            max_workers: int = DEFAULT_MAX_WORKERS, page_size: int = API_MAX_TAKE,
+            sortBy: str = ObservationsAPI.DEFAULT_SORT_BY_ATTRIBUTE_FOR_OBSERVATIONS,
+            verbose=False):
+        """Harvest the observations matching `search_filter`, split by date into at most
+           `shards` shards that are harvested with at most `max_workers` at a time, with
+           `page_size` observations per request, sorted by `sortBy` in ascending order.
+           Continues from the saved progress if the job has been run before. Returns the number
+           of observations stored by this run."""
+        assert 0 < page_size <= API_MAX_TAKE
+        state = self.start(search_filter, shards, sortBy)
+        todo = [shard for shard in state["shards"] if not shard["done"]]
+        if verbose:
+            print(f"Harvesting {len(todo)} of {len(state['shards'])} shards")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return sum(executor.map(lambda shard: self.harvest_shard(search_filter, shard,
+                                                                     page_size, sortBy,
+                                                                     verbose),
+                                    todo))
+
+    def progress(self):
+        """Returns the progress of the job as a dictionary with the number of shards, the
+           completed shards, the stored observations and pages, and the total number of
+           observations of the shards that have been started, or None if there is no job."""
+        if not self.state:
+            return None
+        with self.lock:
+            shards = self.state["shards"]
+            return {"shards": len(shards),
+                    "done": sum(1 for s in shards if s["done"]),
+                    "stored": sum(s["offset"] for s in shards),
+                    "pages": sum(s["pages"] for s in shards),
+                    "total": sum(s["total"] or 0 for s in shards)}
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""
+Python module with a pool of API keys for Artportalens API:s, for spreading the requests of an
+organisation with several subscriptions over all of them. Every key has its own rate limit and
+quota. Each request is sent with the key that can send it soonest, and a key that is throttled
+is backed off without holding up the requests that can use the other keys. A pool is used by
+giving it to an API class as `key_pool`, and can be shared by several API instances and threads.
+"""
+
+import time
+import threading
+from apretry import DEFAULT_BACKOFF, DEFAULT_MAX_BACKOFF, TokenBucket, retry_after_seconds
+
+# Constants
+DEFAULT_QUOTA_PERIOD = 24 * 3600  # Seconds of the period of a quota
+THROTTLE_STATUS_CODES = frozenset([429, 503])
+
+
+class QuotaExhausted(Exception):
+    """Raised when the quotas of all keys of a KeyPool have been used for the period."""
+
+
+class APIKey:
+    """An API key `key`, shown as `name` in the usage statistics, that may be used for `rate`
+       requests per second in bursts of `burst`, and for at most `quota` requests every `period`
+       seconds. A limit that is None is not enforced."""
+
+    def __init__(self, key: str, name: str = None, rate: float = None, burst: float = None,
+                 quota: int = None, period: float = DEFAULT_QUOTA_PERIOD):
+        """Initialization."""
+        self.key = key
+        self.name = name if name is not None else key[:4] + '...'
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.quota = quota
+        self.period = period
+        self.period_start = time.time()
+        self.used = 0
+        self.active = 0
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.strikes = 0
+        self.blocked_until = 0.0
+
+    def remaining(self, now: float):
+        """Returns the number of requests left of the quota in the period of `now`, or None if
+           the key has no quota."""
+        if self.quota is None:
+            return None
+        if now - self.period_start >= self.period:
+            self.period_start = now
+            self.used = 0
+        return max(0, self.quota - self.used)
+
+    def wait(self, now: float):
+        """Returns the number of seconds before a request may be sent with the key."""
+        wait = max(0.0, self.blocked_until - now)
+        if self.bucket is not None:
+            wait = max(wait, (1 - self.bucket.available()) / self.bucket.rate)
+        return wait
+
+    def usage(self):
+        """Returns the usage statistics of the key as a dictionary."""
+        now = time.time()
+        return {"name": self.name, "requests": self.requests, "throttled": self.throttled,
+                "errors": self.errors, "active": self.active, "used": self.used,
+                "quota": self.quota, "remaining": self.remaining(now),
+                "backoff": max(0.0, self.blocked_until - now)}
+
+
+class KeyPool:
+    """A pool of APIKey:s. `acquire()` picks the key a request is sent with, and `release()`
+       registers the response. A key whose request is throttled is backed off for the time in
+       the Retry-After header, or else an exponential backoff from `backoff` to `max_backoff`
+       seconds, while the other keys are used."""
+
+    def __init__(self, keys: list, backoff: float = DEFAULT_BACKOFF,
+                 max_backoff: float = DEFAULT_MAX_BACKOFF):
+        """Initialization. `keys` are APIKey:s or key strings without limits."""
+        self.keys = [k if isinstance(k, APIKey) else APIKey(k) for k in keys]
+        if not self.keys:
+            raise ValueError("A key pool needs at least one key")
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def choose(self, now: float):
+        """Returns the tuple (key, seconds to wait) of the key that can send a request soonest,
+           preferring the key with the fewest active requests and the most quota left, or
+           (None, None) if all quotas are used."""
+        best, best_rank = None, None
+        for key in self.keys:
+            remaining = key.remaining(now)
+            if remaining == 0:
+                continue
+            share = remaining / key.quota if remaining is not None else 1.0
+            rank = (key.wait(now), key.active, -share)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = key, rank
+        return (best, best_rank[0]) if best is not None else (None, None)
+
+    def acquire(self):
+        """Pick a key, wait until it may be used, and return it. Raises QuotaExhausted if the
+           quotas of all keys are used."""
+        with self.lock:
+            key, wait = self.choose(time.time())
+            if key is None:
+                reset = min(k.period_start + k.period for k in self.keys)
+                raise QuotaExhausted(f"The quotas of all {len(self.keys)} API keys are used "
+                                     f"until {time.ctime(reset)}")
+            if key.bucket is not None:
+                wait = max(wait, key.bucket.reserve())
+            key.used += 1
+            key.active += 1
+        if wait > 0:
+            time.sleep(wait)
+        return key
+
+    def release(self, key: APIKey, response=None):
+        """Register the `response` to a request sent with `key`, or a failed request if it is
+           None."""
+        with self.lock:
+            key.active -= 1
+            key.requests += 1
+            if response is None:
+                key.errors += 1
+            elif response.status_code in THROTTLE_STATUS_CODES:
+                key.throttled += 1
+                delay = retry_after_seconds(response)
+                if delay is None:
+                    delay = self.backoff * 2 ** key.strikes
+                key.strikes += 1
+                key.blocked_until = time.time() + min(delay, self.max_backoff)
+            else:
+                key.strikes = 0
+
+    def usage(self):
+        """Returns the list of the usage statistics of the keys."""
+        with self.lock:
+            return [key.usage() for key in self.keys]
+
+
+def parse_keys(value: str, period: float = DEFAULT_QUOTA_PERIOD):
+    """Returns the list of APIKey:s in the comma separated string `value`, where each key may be
+       followed by its rate per second and its quota per `period`, separated by colons, like
+       "key1:5:100000,key2::50000". Raises ValueError if a limit is not a number."""
+    keys = []
+    for i, item in enumerate(v.strip() for v in value.split(',')):
+        if not item:
+            continue
+        key, rate, quota = (item.split(':') + ['', ''])[:3]
+        keys.append(APIKey(key, f"key-{i + 1}", rate=float(rate) if rate else None,
+                           quota=int(quota) if quota else None, period=period))
+    return keys
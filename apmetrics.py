@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+"""
+Python module with instrumentation of the requests to Artportalens API:s. A hook is a callable
+that is called with a RequestRecord for every request an `apretry.RequestExecutor` sends, and
+for every response served from a cache. Hooks are added with `RequestExecutor.add_hook()`, and
+when there are none the requests are not timed at all.
+
+There are hooks that collect Prometheus style counters and histograms, and that make
+OpenTelemetry spans if the opentelemetry package is installed. A ResponseTracker keeps the
+metadata of the last responses of each thread or asyncio task, for diagnosing failed requests.
+"""
+
+import time
+import asyncio
+import threading
+import weakref
+from collections import deque
+from urllib.parse import urlparse
+
+# Constants
+RESPONSE = 'response'  # The phase of a record of a request, or a cached response
+PARSED = 'parsed'  # The phase of a record whose JSON body has been parsed
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DEFAULT_TRACKED_RESPONSES = 16  # Responses kept per thread or task by a ResponseTracker
+MAX_ERROR_TEXT = 1000  # Characters of the body of a failed response kept by a ResponseTracker
+REQUEST_ID_HEADERS = ('x-ms-request-id', 'apim-request-id', 'x-request-id', 'request-id')
+
+
+class RequestRecord:
+    """The measurements of one request. `seconds` is the time of the whole request including
+       retries, `ttfb` the time from sending the last attempt to having its response headers,
+       `download` the time to read the body after that, and `parse` the time to decode the JSON
+       body. `attempts` is 0 for responses served from a cache, and then `cache` is "hit" or
+       "revalidated". Times that were not measured are None. A record is given to the hooks
+       once when the response arrives, and again with the phase PARSED when its body has been
+       decoded with `response_json()`."""
+
+    __slots__ = ('phase', 'method', 'url', 'endpoint', 'status', 'attempts', 'bytes', 'start',
+                 'seconds', 'ttfb', 'download', 'parse', 'cache', 'error', 'hooks')
+
+    def __init__(self, method: str, url: str, hooks: list = ()):
+        self.phase = RESPONSE
+        self.method = method
+        self.url = url
+        self.endpoint = urlparse(url).path
+        self.status = None
+        self.attempts = 0
+        self.bytes = None
+        self.start = time.time()
+        self.seconds = None
+        self.ttfb = None
+        self.download = None
+        self.parse = None
+        self.cache = None
+        self.error = None
+        self.hooks = hooks
+
+    @property
+    def retries(self):
+        return max(0, self.attempts - 1)
+
+    def emit(self):
+        """Call the hooks with this record."""
+        for hook in self.hooks:
+            hook(self)
+
+    def as_dict(self):
+        """Returns the measurements as a dictionary."""
+        return {name: getattr(self, name) for name in self.__slots__ if name != 'hooks'}
+
+
+def response_json(r):
+    """Returns the decoded JSON body of the response `r`. If the request was instrumented, the
+       decoding is timed and the record given to the hooks again."""
+    record = getattr(r, 'record', None)
+    if record is None:
+        return r.json()
+    start = time.perf_counter()
+    value = r.json()
+    record.parse = time.perf_counter() - start
+    record.phase = PARSED
+    record.emit()
+    return value
+
+
+def cache_record(method: str, url: str, cache: str, hooks: list):
+    """Give the hooks a record of a response to a request to `url` served from a cache. `cache`
+       is "hit" or "revalidated"."""
+    record = RequestRecord(method, url, hooks)
+    record.status = 200
+    record.seconds = 0.0
+    record.cache = cache
+    record.emit()
+
+
+def escape_label(value):
+    """Returns `value` escaped as a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labels(names: tuple, values: tuple):
+    """Returns the Prometheus label set of the label `names` and `values`."""
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{escape_label(v)}"' for n, v in zip(names, values)) + '}'
+
+
+class Histogram:
+    """A Prometheus style histogram of values, with cumulative bucket counts."""
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class PrometheusMetrics:
+    """A hook that collects counters and histograms of the requests by endpoint, and renders
+       them in the Prometheus text exposition format with `render()`. Metric names start with
+       `prefix`."""
+
+    COUNTERS = {"requests_total": ("Requests sent, by final status", ("endpoint", "status")),
+                "attempts_total": ("Attempts sent, including retries", ("endpoint",)),
+                "retries_total": ("Retried attempts", ("endpoint",)),
+                "errors_total": ("Requests failed without a response", ("endpoint", "error")),
+                "response_bytes_total": ("Bytes of response bodies", ("endpoint",)),
+                "cache_total": ("Responses served from a cache", ("endpoint", "cache"))}
+    HISTOGRAMS = {"request_seconds": "Time of requests including retries",
+                  "ttfb_seconds": "Time to the response headers",
+                  "download_seconds": "Time to read the response bodies",
+                  "parse_seconds": "Time to decode the JSON bodies"}
+
+    def __init__(self, prefix: str = 'adb_', buckets: tuple = DEFAULT_BUCKETS):
+        """Initialization."""
+        self.prefix = prefix
+        self.buckets = buckets
+        self.counters = {name: {} for name in self.COUNTERS}
+        self.histograms = {name: {} for name in self.HISTOGRAMS}
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, values: tuple, n: float = 1):
+        self.counters[name][values] = self.counters[name].get(values, 0) + n
+
+    def observe(self, name: str, endpoint: str, value):
+        if value is not None:
+            histograms = self.histograms[name]
+            if endpoint not in histograms:
+                histograms[endpoint] = Histogram(self.buckets)
+            histograms[endpoint].observe(value)
+
+    def __call__(self, record: RequestRecord):
+        with self.lock:
+            e = record.endpoint
+            if record.phase == PARSED:
+                self.observe("parse_seconds", e, record.parse)
+                return
+            if record.cache:
+                self.inc("cache_total", (e, record.cache))
+                return
+            if record.error:
+                self.inc("errors_total", (e, record.error))
+            else:
+                self.inc("requests_total", (e, record.status))
+            self.inc("attempts_total", (e,), record.attempts)
+            self.inc("retries_total", (e,), record.retries)
+            if record.bytes:
+                self.inc("response_bytes_total", (e,), record.bytes)
+            self.observe("request_seconds", e, record.seconds)
+            self.observe("ttfb_seconds", e, record.ttfb)
+            self.observe("download_seconds", e, record.download)
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, (help, names) in self.COUNTERS.items():
+                metric = self.prefix + name
+                lines.append(f"# HELP {metric} {help}")
+                lines.append(f"# TYPE {metric} counter")
+                for values, n in sorted(self.counters[name].items(), key=str):
+                    lines.append(f"{metric}{labels(names, values)} {n}")
+            for name, help in self.HISTOGRAMS.items():
+                metric = self.prefix + name
+                lines.append(f"# HELP {metric} {help}")
+                lines.append(f"# TYPE {metric} histogram")
+                for endpoint, h in sorted(self.histograms[name].items()):
+                    for bound, n in zip(h.buckets, h.counts):
+                        lines.append(f"{metric}_bucket"
+                                     f"{labels(('endpoint', 'le'), (endpoint, bound))} {n}")
+                    lines.append(f"{metric}_bucket{labels(('endpoint', 'le'), (endpoint, '+Inf'))}"
+                                 f" {h.count}")
+                    lines.append(f"{metric}_sum{labels(('endpoint',), (endpoint,))} {h.sum}")
+                    lines.append(f"{metric}_count{labels(('endpoint',), (endpoint,))} {h.count}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        """Write the metrics to the file `path`, for instance for the textfile collector of the
+           Prometheus node exporter."""
+        with open(path, 'w') as f:
+            f.write(self.render())
+
+
+class OpenTelemetrySpans:
+    """A hook that makes an OpenTelemetry span of every request, and of the decoding of its
+       body, with `tracer`, which defaults to the tracer of this module from the global tracer
+       provider. Raises ImportError if the opentelemetry package isn't installed."""
+
+    def __init__(self, tracer=None):
+        """Initialization."""
+        from opentelemetry import trace
+        self.tracer = tracer if tracer is not None else trace.get_tracer(__name__)
+
+    def __call__(self, record: RequestRecord):
+        if record.phase == PARSED:
+            end = time.time()
+            name, start, attributes = f"parse {record.endpoint}", end - record.parse, {}
+        else:
+            start = record.start
+            end = start + (record.seconds or 0.0)
+            name = f"{record.method} {record.endpoint}"
+            attributes = {"http.method": record.method, "http.url": record.url,
+                          "adb.attempts": record.attempts}
+            for key, value in (("http.status_code", record.status),
+                               ("http.response_content_length", record.bytes),
+                               ("adb.cache", record.cache), ("adb.error", record.error),
+                               ("adb.ttfb_seconds", record.ttfb),
+                               ("adb.download_seconds", record.download)):
+                if value is not None:
+                    attributes[key] = value
+        span = self.tracer.start_span(name, start_time=int(start * 1e9), attributes=attributes)
+        span.end(end_time=int(end * 1e9))
+
+
+class ResponseInfo:
+    """The metadata of a response: the `method` and `url` of the request, the `status_code`
+       and `reason`, the `elapsed` seconds to the response headers, the number of `bytes` of
+       the body (None if it was streamed and had no Content-Length), the `request_id` the server
+       gave it, and the start of the body as `text` if the request failed."""
+
+    __slots__ = ('method', 'url', 'status_code', 'reason', 'elapsed', 'bytes', 'request_id',
+                 'text', 'time')
+
+    def __init__(self, r, streamed: bool = False):
+        self.method = r.request.method if r.request is not None else None
+        self.url = r.url
+        self.status_code = r.status_code
+        self.reason = r.reason
+        self.elapsed = r.elapsed.total_seconds()
+        length = r.headers.get('Content-Length')
+        if streamed:
+            self.bytes = int(length) if length and length.isdigit() else None
+        else:
+            self.bytes = len(r.content)
+        self.request_id = next((r.headers[h] for h in REQUEST_ID_HEADERS if h in r.headers),
+                               None)
+        self.text = r.text[:MAX_ERROR_TEXT] if not r.ok and not streamed else None
+        self.time = time.time()
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def __repr__(self):
+        return f"<ResponseInfo {self.method} {self.url} [{self.status_code}]>"
+
+
+def current_context():
+    """Returns the current asyncio task, or the current thread outside of tasks."""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return task if task is not None else threading.current_thread()
+
+
+class ResponseTracker:
+    """Keeps the ResponseInfo of the last `maxlen` responses of each thread, or asyncio task,
+       so concurrent callers sharing an API instance see their own responses. The bodies of the
+       responses are not kept, and the responses of a thread or task are forgotten when it
+       ends."""
+
+    def __init__(self, maxlen: int = DEFAULT_TRACKED_RESPONSES):
+        """Initialization."""
+        self.maxlen = maxlen
+        self.contexts = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def track(self, r, streamed: bool = False):
+        """Record the response `r` in the current context and return its ResponseInfo."""
+        info = ResponseInfo(r, streamed)
+        context = current_context()
+        with self.lock:
+            responses = self.contexts.get(context)
+            if responses is None:
+                responses = self.contexts[context] = deque(maxlen=self.maxlen)
+            responses.append(info)
+        return info
+
+    def history(self):
+        """Returns the list of the ResponseInfo of the current context, oldest first."""
+        with self.lock:
+            return list(self.contexts.get(current_context(), ()))
+
+    def last(self):
+        """Returns the ResponseInfo of the last response of the current context, or None."""
+        with self.lock:
+            responses = self.contexts.get(current_context())
+            return responses[-1] if responses else None
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+"""
+Python module with a query planner for Artportalens ObservationsAPI. The planner counts the
+observations matching a SearchFilter first, and then picks the way to fetch them: paging through
+them with one request at a time, paging through date shards of the filter concurrently, or a
+bulk export job for result sets too big for paging. The date shards are sized by counting their
+observations, so each can be paged through within the skip and take limit of the API, and are
+fetched a few shards ahead of the one being yielded, so memory use stays bounded.
+The plan has estimates of the number of requests and the runtime, so they can be checked before
+the observations are fetched.
+"""
+
+import math
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+import apbulk
+from artportalen import (API_MAX_TAKE, API_MAX_SKIP_TAKE, DEFAULT_MAX_WORKERS, APIError,
+                         ObservationsAPI, SearchFilter, field_value)
+
+# Constants
+PAGING = 'paging'
+SHARDED = 'sharded'
+BULK = 'bulk'
+DEFAULT_PAGING_MAX = 10 * API_MAX_TAKE  # Observations fetched by paging without sharding
+DEFAULT_BULK_MIN = 1000000  # Observations fetched with a bulk export job
+DEFAULT_REQUEST_SECONDS = 2.0  # Estimated seconds per search request of a full page
+DEFAULT_EXPORT_SECONDS = 120.0  # Estimated seconds before an export job starts writing
+DEFAULT_EXPORT_RATE = 20000.0  # Estimated observations exported per second
+DEFAULT_SHARD_SIZE = API_MAX_SKIP_TAKE // 2  # Planned observations per shard, leaving room
+DEFAULT_PREFETCH_SHARDS = 2  # Shards fetched ahead of the one being yielded
+START_DATE_ATTRIBUTE = 'event.startDate'
+
+
+class SearchPlan:
+    """A plan for fetching the observations matching `search_filter`: the `strategy` (PAGING,
+       SHARDED or BULK), the `count` of matching observations, the number of `observations` to
+       fetch, the estimated number of `requests` and `seconds`, and the filters of the `shards`
+       of a sharded plan, in date order, with the counted observations of each in
+       `shard_counts`."""
+
+    def __init__(self, search_filter: SearchFilter, strategy: str, count: int,
+                 observations: int, requests: int, seconds: float, shards: list = None,
+                 skip: int = 0, limit: int = None, page_size: int = API_MAX_TAKE,
+                 shard_counts: list = None):
+        self.search_filter = search_filter
+        self.strategy = strategy
+        self.count = count
+        self.observations = observations
+        self.requests = requests
+        self.seconds = seconds
+        self.shards = shards or []
+        self.shard_counts = shard_counts or []
+        self.skip = skip
+        self.limit = limit
+        self.page_size = page_size
+
+    def describe(self):
+        """Returns a description of the plan."""
+        how = {PAGING: f"paging with {self.page_size} observations per request",
+               SHARDED: f"{len(self.shards)} date shards paged through concurrently",
+               BULK: "a bulk export job"}[self.strategy]
+        return (f"{self.observations} of {self.count} matching observations by {how}: "
+                f"about {self.requests} requests and {format_seconds(self.seconds)}")
+
+    def __str__(self):
+        return self.describe()
+
+
+def format_seconds(seconds: float):
+    """Returns `seconds` as a short duration, like "2 min 5 s"."""
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds} s"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f"{minutes} min {seconds} s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours} h {minutes} min"
+
+
+class SearchPlanner:
+    """Plans and fetches searches with the ObservationsAPI `api`. Up to `paging_max`
+       observations are fetched by paging, and at least `bulk_min` with a bulk export job, as
+       are results too big for paging that can't be split by date. Results in between are split
+       into date shards of at most `shard_size` observations, which are counted with
+       `max_workers` concurrent requests, and paged through concurrently by at most
+       `max_workers` threads, each fetching a shard, up to `prefetch_shards` shards ahead of the
+       shard whose observations are being yielded. The runtime is
+       estimated from `request_seconds` per page request, and for exports from
+       `export_seconds` plus `export_rate` observations per second. `bulk` is the
+       `apbulk.BulkExport` of bulk plans, made with default settings if not given."""
+
+    def __init__(self, api: ObservationsAPI,
+                 max_workers: int = DEFAULT_MAX_WORKERS,
+                 paging_max: int = DEFAULT_PAGING_MAX,
+                 bulk_min: int = DEFAULT_BULK_MIN,
+                 request_seconds: float = DEFAULT_REQUEST_SECONDS,
+                 export_seconds: float = DEFAULT_EXPORT_SECONDS,
+                 export_rate: float = DEFAULT_EXPORT_RATE,
+                 bulk: apbulk.BulkExport = None,
+                 shard_size: int = DEFAULT_SHARD_SIZE,
+                 prefetch_shards: int = DEFAULT_PREFETCH_SHARDS):
+        """Initialization."""
+        assert 0 < shard_size <= API_MAX_SKIP_TAKE
+        assert prefetch_shards >= 0
+        self.api = api
+        self.shard_size = shard_size
+        self.prefetch_shards = prefetch_shards
+        self.max_workers = max_workers
+        self.paging_max = paging_max
+        self.bulk_min = bulk_min
+        self.request_seconds = request_seconds
+        self.export_seconds = export_seconds
+        self.export_rate = export_rate
+        self.bulk = bulk
+
+    def plan(self, search_filter: SearchFilter, skip: int = 0, limit: int = None,
+             page_size: int = API_MAX_TAKE, verbose=False):
+        """Returns the SearchPlan for fetching at most `limit` (all if None) of the observations
+           matching `search_filter`, starting at `skip`. Counts the observations with one
+           request, and the observations of each date shard if the search is sharded."""
+        count = self.api.count(search_filter, verbose=verbose)
+        n = max(0, count - skip)
+        if limit is not None:
+            n = min(n, limit)
+        pages = max(1, math.ceil(n / page_size))
+        date = search_filter.filter.get("date") or {}
+        splittable = skip == 0 and date.get("startDate") and date.get("endDate")
+        if skip + n <= self.paging_max or (skip + n <= API_MAX_SKIP_TAKE and not splittable):
+            return SearchPlan(search_filter, PAGING, count, n, pages,
+                              pages * self.request_seconds, skip=skip, limit=limit,
+                              page_size=page_size)
+        shards = None
+        if n < self.bulk_min and splittable:
+            shards = self.shards(search_filter, count, verbose)
+        if shards is not None:
+            filters = [f for f, c in shards]
+            counts = [c for f, c in shards]
+            requests = sum(max(1, math.ceil(c / page_size)) for c in counts)
+            if limit is not None:
+                requests = min(requests, pages + len(shards))
+            seconds = requests * self.request_seconds / self.shard_workers(len(shards))
+            return SearchPlan(search_filter, SHARDED, count, n, requests, seconds, filters,
+                              limit=limit, page_size=page_size, shard_counts=counts)
+        polls = math.ceil(self.export_seconds / apbulk.DEFAULT_POLL_INTERVAL)
+        seconds = self.export_seconds + count / self.export_rate
+        return SearchPlan(search_filter, BULK, count, n, polls + 2, seconds, skip=skip,
+                          limit=limit, page_size=page_size)
+
+    def shards(self, search_filter: SearchFilter, count: int, verbose=False):
+        """Returns a list of (filter, count) of date shards of `search_filter`, which has
+           `count` observations, in date order, with at most `shard_size` observations each,
+           or None if a single day has more observations than can be paged through. Shards
+           with too many observations are halved by date until they fit."""
+        filters = search_filter.split_by_date(math.ceil(count / self.shard_size))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            counts = list(executor.map(lambda f: self.api.count(f, verbose=verbose), filters))
+        shards = []
+        todo = list(zip(filters, counts))
+        while todo:
+            f, n = todo.pop(0)
+            if n <= self.shard_size:
+                shards.append((f, n))
+                continue
+            halves = f.split_by_date(2)
+            if len(halves) < 2:
+                if n > API_MAX_SKIP_TAKE:
+                    return None
+                shards.append((f, n))
+                continue
+            todo[:0] = [(h, self.api.count(h, verbose=verbose)) for h in halves]
+        return shards
+
+    def shard_workers(self, shards: int):
+        """Returns the number of shards of a plan with `shards` shards that are fetched
+           concurrently."""
+        return max(1, min(self.max_workers, self.prefetch_shards + 1, shards))
+
+    def shard_observations(self, plan: SearchPlan, i: int, sortBy: str, sort_descending: bool,
+                           verbose=False):
+        """Returns the list of the observations of shard `i` of the sharded `plan`. An
+           observation in several shards, which overlaps their dates, is only in the shard of
+           its start date. Raises APIError if the shard has more observations than can be paged
+           through."""
+        f = plan.shards[i]
+        first = f.filter["date"]["startDate"][:10] if i > 0 else None
+        last = f.filter["date"]["endDate"][:10] if i < len(plan.shards) - 1 else None
+        observations = []
+        n = 0
+        for o in self.api.iter_observations(f, page_size=plan.page_size, sortBy=sortBy,
+                                            sort_descending=sort_descending,
+                                            limit=API_MAX_SKIP_TAKE, verbose=verbose):
+            n += 1
+            start = (field_value(o, START_DATE_ATTRIBUTE) or '')[:10]
+            if start and ((first and start < first) or (last and start > last)):
+                continue
+            observations.append(o)
+        if n == API_MAX_SKIP_TAKE and self.api.count(f, verbose=verbose) > n:
+            raise APIError(f"The shard {f.filter['date']['startDate']}.."
+                           f"{f.filter['date']['endDate']} has grown to more than the "
+                           f"{API_MAX_SKIP_TAKE} observations that can be paged through")
+        return observations
+
+    def sharded_observations(self, plan: SearchPlan, sortBy: str, sort_descending: bool,
+                             verbose=False):
+        """Yields the observations of the sharded `plan`, shard by shard in date order, or in
+           reverse date order if `sort_descending`. The shards are fetched concurrently with
+           `shard_observations()`, at most `prefetch_shards` shards ahead of the one being
+           yielded. Raises APIError if a shard has more observations than can be paged
+           through."""
+        for i, n in enumerate(plan.shard_counts):
+            if n > API_MAX_SKIP_TAKE:
+                raise APIError(f"Shard {i} of the plan has {n} observations, more than the "
+                               f"{API_MAX_SKIP_TAKE} that can be paged through")
+        order = range(len(plan.shards))
+        todo = iter(reversed(order) if sort_descending else order)
+        workers = self.shard_workers(len(plan.shards))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = deque(executor.submit(self.shard_observations, plan, i, sortBy,
+                                            sort_descending, verbose)
+                            for i in islice(todo, workers))
+            try:
+                while futures:
+                    observations = futures.popleft().result()
+                    yield from observations
+                    observations = None
+                    for i in islice(todo, 1):
+                        futures.append(executor.submit(self.shard_observations, plan, i,
+                                                       sortBy, sort_descending, verbose))
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def execute(self, plan: SearchPlan,
+                sortBy: str = ObservationsAPI.DEFAULT_SORT_BY_ATTRIBUTE_FOR_OBSERVATIONS,
+                sort_descending: bool = True,
+                verbose=False):
+        """Returns an iterator over the observations of `plan`. Paged results are sorted by
+           `sortBy`, and sharded results within each shard, which are in date order; bulk
+           exports are in the order of the export file. Only a page of observations at a time
+           is kept in memory, except for bulk exports, which are downloaded to a file first."""
+        if plan.strategy == PAGING:
+            return self.api.iter_observations(plan.search_filter, page_size=plan.page_size,
+                                              sortBy=sortBy, sort_descending=sort_descending,
+                                              skip=plan.skip, limit=plan.limit, verbose=verbose)
+        if plan.strategy == SHARDED:
+            observations = self.sharded_observations(plan, sortBy, sort_descending, verbose)
+        else:
+            bulk = self.bulk if self.bulk is not None else apbulk.BulkExport(self.api)
+            observations = bulk.observations(plan.search_filter, verbose=verbose)
+        stop = plan.skip + plan.limit if plan.limit is not None else None
+        return islice(observations, plan.skip, stop)
+
+    def fetch(self, search_filter: SearchFilter, skip: int = 0, limit: int = None,
+              verbose=False, **kwargs):
+        """Plan the search and return an iterator over its observations, like `execute()` with
+           the keyword arguments `kwargs`."""
+        return self.execute(self.plan(search_filter, skip, limit, verbose=verbose),
+                            verbose=verbose, **kwargs)
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+
+"""
+Python module with a request executor for Artportalens API:s, that rate limits requests per API
+key with token buckets, retries throttled and failed requests with exponential backoff and
+jitter, respects the Retry-After header by pausing all requests with the throttled key, and
+optionally adapts the number of concurrent requests and the request rate to the throttling it
+sees.
+"""
+
+import time
+import random
+import threading
+import collections
+import requests
+from email.utils import parsedate_to_datetime
+from apmetrics import RequestRecord
+
+# Constants
+API_KEY_HEADER = 'Ocp-Apim-Subscription-Key'
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF = 0.5  # Seconds before the first retry, doubled for every retry
+DEFAULT_MAX_BACKOFF = 60.0
+ADAPTIVE_RATE_STEP = 0.05  # Part of the adaptive rate it is increased by per success
+ADAPTIVE_MIN_RATE = 1 / 64  # The lowest adaptive rate, as a part of the rate limit
+RATE_SAMPLES = 1024  # Most successes per API key kept for measuring the rate in adaptive mode
+
+
+def retry_after_seconds(response):
+    """Returns the number of seconds the Retry-After header of `response` asks the client to
+       wait, or None if there is no such header."""
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """A token bucket that allows `rate` requests per second on average, and bursts of at most
+       `burst` requests. It can be paused, and its rate changed. It can be used from several
+       threads."""
+
+    def __init__(self, rate: float, burst: float = None):
+        """Initialization."""
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self, now: float):
+        """Add the tokens of the time until `now`. Call with the lock held."""
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def reserve(self, tokens: float = 1):
+        """Take `tokens` tokens, and return the number of seconds to wait before they may be
+           used. Taking tokens that are not there yet puts later callers behind in the queue."""
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.tokens -= tokens
+            wait = self.updated - now
+            return wait if self.tokens >= 0 else wait - self.tokens / self.rate
+
+    def pause(self, seconds: float):
+        """Let no tokens be used for `seconds` seconds, and let the tokens refill from empty
+           after that, so the callers waiting for tokens are spread out again."""
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.tokens = min(self.tokens, 0.0)
+            self.updated = max(self.updated, now + seconds)
+
+    def set_rate(self, rate: float):
+        """Change the rate to `rate` tokens per second."""
+        with self.lock:
+            self.refill(time.monotonic())
+            self.rate = rate
+
+    def acquire(self, tokens: float = 1):
+        """Take `tokens` tokens, waiting until they may be used."""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    def available(self):
+        """Returns the number of tokens that may be used now."""
+        with self.lock:
+            now = time.monotonic()
+            return min(self.burst, self.tokens + max(0.0, now - self.updated) * self.rate)
+
+
+class AdaptiveConcurrency:
+    """Limits the number of concurrent requests with a limit that adapts to throttling: it is
+       halved when a request is throttled and increased by one after a limit's worth of
+       successful requests (additive increase, multiplicative decrease). Use an instance as a
+       context manager around each request."""
+
+    def __init__(self, initial: int = 4, minimum: int = 1, maximum: int = 32):
+        """Initialization."""
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.active = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def try_acquire(self):
+        """Start a request if the limit allows it, without waiting. Returns True if it was
+           started, and then `release()` must be called when it has finished."""
+        with self.condition:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        """Register that a request has finished."""
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        """Register a successful request."""
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+    def on_throttle(self):
+        """Register a throttled request."""
+        with self.condition:
+            self.limit = max(self.minimum, self.limit // 2)
+            self.successes = 0
+
+
+class RequestExecutor:
+    """Sends HTTP requests with rate limiting and retries. If `rate` is given, requests are
+       limited to `rate` per second and bursts of `burst` per API key, the key being the value
+       of the subscription key header. Requests that fail with a connection error or a status
+       code in RETRY_STATUS_CODES are retried at most `max_retries` times, after the delay in
+       the Retry-After header or else an exponential backoff with full jitter. A 429 response
+       with a Retry-After header pauses all requests with its API key, from all threads, for
+       that delay. If `adaptive` is an AdaptiveConcurrency, concurrent requests are limited by
+       it, and the rate limit of a throttled key is halved, and then increased step by step
+       with the successful requests. A key without a rate limit gets one when it is throttled:
+       its number of successful requests in the last second. The `hooks` (see the module
+       apmetrics) are called with a record of every request. An executor can be shared by
+       several API instances and threads."""
+
+    def __init__(self, rate: float = None, burst: float = None,
+                 max_retries: int = DEFAULT_MAX_RETRIES,
+                 backoff: float = DEFAULT_BACKOFF,
+                 max_backoff: float = DEFAULT_MAX_BACKOFF,
+                 adaptive: AdaptiveConcurrency = None,
+                 hooks: list = None):
+        """Initialization."""
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.adaptive = adaptive
+        self.hooks = list(hooks or [])
+        self.buckets = {}
+        self.pauses = {}
+        self.rate_limits = {}
+        self.successes = {}
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """Add the instrumentation hook `hook`, a callable that is called with an
+           `apmetrics.RequestRecord`."""
+        self.hooks.append(hook)
+
+    def bucket(self, api_key: str):
+        """Returns the token bucket of `api_key`, or None if requests are not rate limited."""
+        with self.lock:
+            if api_key not in self.buckets and self.rate is not None:
+                self.buckets[api_key] = TokenBucket(self.rate, self.burst)
+                self.rate_limits[api_key] = self.rate
+            return self.buckets.get(api_key)
+
+    def pause(self, api_key: str, seconds: float):
+        """Pause the requests with `api_key` for `seconds` seconds."""
+        bucket = self.bucket(api_key)
+        with self.lock:
+            self.pauses[api_key] = max(self.pauses.get(api_key, 0.0), time.monotonic() + seconds)
+        if bucket is not None:
+            bucket.pause(seconds)
+
+    def paused(self, api_key: str):
+        """Returns the number of seconds left of the pause of the requests with `api_key`."""
+        with self.lock:
+            return max(0.0, self.pauses.get(api_key, 0.0) - time.monotonic())
+
+    def wait_for_pause(self, api_key: str):
+        """Wait until requests with `api_key` are not paused."""
+        while (wait := self.paused(api_key)) > 0:
+            time.sleep(wait)
+
+    def measured_rate(self, api_key: str):
+        """Returns the number of successful requests with `api_key` in the last second, but at
+           least 1."""
+        with self.lock:
+            successes = self.successes.get(api_key) or []
+            now = time.monotonic()
+            return max(1.0, sum(1 for t in successes if now - t <= 1.0))
+
+    def congestion(self, api_key: str, throttled: bool):
+        """Register a response to a request with `api_key` that was `throttled` (429) or not
+           retried, so the adaptive concurrency and rate follow the throttling. Does nothing
+           without `adaptive`."""
+        if self.adaptive is None:
+            return
+        if throttled:
+            self.adaptive.on_throttle()
+        else:
+            self.adaptive.on_success()
+        self.adapt_rate(api_key, throttled)
+
+    def adapt_rate(self, api_key: str, throttled: bool):
+        """Halve the rate of the token bucket of `api_key` if a request was `throttled`, or
+           else increase it by a step, up to the rate limit. A throttled key without a token
+           bucket gets one with its measured rate as the rate limit. Requests that are
+           throttled while the key is paused were sent before the pause, and don't halve the
+           rate again."""
+        bucket = self.bucket(api_key)
+        if not throttled:
+            with self.lock:
+                successes = self.successes.setdefault(api_key,
+                                                      collections.deque(maxlen=RATE_SAMPLES))
+                successes.append(time.monotonic())
+            limit = self.rate_limits.get(api_key)
+            if bucket is not None and bucket.rate < limit:
+                bucket.set_rate(min(limit, bucket.rate * (1 + ADAPTIVE_RATE_STEP)))
+            return
+        if self.paused(api_key) > 0:
+            return
+        if bucket is None:
+            rate = self.measured_rate(api_key)
+            with self.lock:
+                bucket = self.buckets.setdefault(api_key, TokenBucket(rate))
+                self.rate_limits.setdefault(api_key, rate)
+        bucket.set_rate(max(self.rate_limits[api_key] * ADAPTIVE_MIN_RATE, bucket.rate / 2))
+
+    def retry_delay(self, attempt: int, response=None):
+        """Returns the number of seconds to wait before retry number `attempt` (starting at 0)
+           of a request that got `response`, or None for a connection error."""
+        delay = retry_after_seconds(response)
+        if delay is not None:
+            return min(delay, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def should_retry(self, status_code: int):
+        """True if a request that got `status_code` should be retried."""
+        return status_code in RETRY_STATUS_CODES
+
+    def request(self, session, method: str, url: str, key_pool=None, **kwargs):
+        """Send the request with `session` (a requests session, or the requests module) and
+           returns the response. Returns the last response if all retries failed, and raises
+           the last exception if all retries failed with connection errors. If there are hooks,
+           the response has the RequestRecord of the request in its attribute `record`. If
+           `key_pool` (an `apkeys.KeyPool`) is given, every attempt is sent with the API key
+           it picks, and throttled attempts are retried with another key after the exponential
+           backoff, but without waiting for the Retry-After of the throttled key."""
+        record = RequestRecord(method, url, self.hooks) if self.hooks else None
+        if record is not None:
+            start = time.perf_counter()
+        headers = kwargs.get('headers') or {}
+        key = None
+        attempt = 0
+        while True:
+            if key_pool is not None:
+                key = key_pool.acquire()
+                kwargs['headers'] = headers | {API_KEY_HEADER: key.key}
+            api_key = (kwargs.get('headers') or {}).get(API_KEY_HEADER)
+            self.wait_for_pause(api_key)
+            bucket = self.bucket(api_key)
+            if bucket is not None:
+                bucket.acquire()
+            try:
+                if record is not None:
+                    attempt_start = time.perf_counter()
+                if self.adaptive is not None:
+                    with self.adaptive:
+                        r = session.request(method, url, **kwargs)
+                else:
+                    r = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if key is not None:
+                    key_pool.release(key)
+                if attempt >= self.max_retries:
+                    if record is not None:
+                        record.attempts = attempt + 1
+                        record.error = type(e).__name__
+                        record.seconds = time.perf_counter() - start
+                        record.emit()
+                    raise
+                time.sleep(self.retry_delay(attempt))
+                attempt += 1
+                continue
+            except BaseException:
+                if key is not None:
+                    key_pool.release(key)
+                raise
+            if key is not None:
+                key_pool.release(key, r)
+            if not self.should_retry(r.status_code):
+                self.congestion(api_key, False)
+                break
+            paused = False
+            if r.status_code == 429:
+                self.congestion(api_key, True)
+                delay = retry_after_seconds(r)
+                if delay is not None:
+                    self.pause(api_key, min(delay, self.max_backoff))
+                    paused = True
+            if attempt >= self.max_retries:
+                break
+            r.close()
+            if key is not None and r.status_code == 429:
+                # Back off before the next key too, as the keys may share a limit.
+                time.sleep(self.retry_delay(attempt))
+            elif not paused:
+                time.sleep(self.retry_delay(attempt, r))
+            attempt += 1
+        if record is not None:
+            now = time.perf_counter()
+            record.attempts = attempt + 1
+            record.status = r.status_code
+            record.seconds = now - start
+            record.ttfb = r.elapsed.total_seconds()
+            if kwargs.get('stream'):
+                length = r.headers.get('Content-Length')
+                record.bytes = int(length) if length and length.isdigit() else None
+            else:
+                record.bytes = len(r.content)
+                record.download = max(0.0, now - attempt_start - record.ttfb)
+            r.record = record
+            record.emit()
+        return r
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+"""
+Python module with a local store of observations from Artportalens ObservationsAPI. The
+observations are stored as JSON in an SQLite database, keyed by observation id, so storing an
+observation again replaces it. The WGS 84 coordinates of the observations are indexed in an
+SQLite R*Tree, for fast bounding box, radius and nearest neighbour queries.
+"""
+
+import os
+import os.path
+import math
+import json
+import sqlite3
+import threading
+from artportalen import observation_id, field_value, observation_wgs84
+
+# Constants
+MODIFIED_ATTRIBUTE = 'modified'  # The attribute of an observation with its modification time
+EARTH_RADIUS = 6371008.8  # Mean earth radius in meters
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+# The R*Tree stores 32 bit floats rounded outwards, so it is used to find candidates and the
+# exact coordinates of the observations table are used to filter them.
+BOX_JOIN = ("observations_rtree r JOIN observations o ON o.rowid = r.id "
+            "WHERE r.max_x >= ? AND r.min_x <= ? AND r.max_y >= ? AND r.min_y <= ? "
+            "AND o.lon BETWEEN ? AND ? AND o.lat BETWEEN ? AND ?")
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS observations_rtree USING rtree(id, min_x, max_x, min_y, max_y);
+CREATE TRIGGER IF NOT EXISTS observations_insert AFTER INSERT ON observations
+WHEN new.lon IS NOT NULL BEGIN
+    INSERT INTO observations_rtree VALUES (new.rowid, new.lon, new.lon, new.lat, new.lat);
+END;
+CREATE TRIGGER IF NOT EXISTS observations_update AFTER UPDATE ON observations BEGIN
+    DELETE FROM observations_rtree WHERE id = old.rowid;
+    INSERT INTO observations_rtree SELECT new.rowid, new.lon, new.lon, new.lat, new.lat
+    WHERE new.lon IS NOT NULL;
+END;
+CREATE TRIGGER IF NOT EXISTS observations_delete AFTER DELETE ON observations BEGIN
+    DELETE FROM observations_rtree WHERE id = old.rowid;
+END;
+"""
+
+
+def distance(lon0: float, lat0: float, lon1: float, lat1: float):
+    """Returns the great circle distance in meters between two WGS 84 points."""
+    phi0, phi1 = math.radians(lat0), math.radians(lat1)
+    a = (math.sin((phi1 - phi0) / 2) ** 2
+         + math.cos(phi0) * math.cos(phi1) * math.sin(math.radians(lon1 - lon0) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_box(lon: float, lat: float, radius: float):
+    """Returns the bounding box (west, south, east, north) of the circle with `radius` meters
+       around the WGS 84 point (lon, lat)."""
+    dlat = radius / METERS_PER_DEGREE
+    coslat = math.cos(math.radians(min(89.9, abs(lat) + dlat)))
+    dlon = min(180.0, radius / (METERS_PER_DEGREE * coslat))
+    return lon - dlon, lat - dlat, lon + dlon, lat + dlat
+
+
+def box_params(box: tuple):
+    """Returns the parameters of BOX_JOIN for the box (west, south, east, north)."""
+    west, south, east, north = box
+    return (west, east, south, north, west, east, south, north)
+
+
+def write_json_atomic(path: str, data):
+    """Write `data` as JSON to the file `path`, so the file either has the old or the new
+       contents even if the program crashes while writing."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_json(path: str, default=None):
+    """Returns the JSON data in the file `path`, or `default` if there is no such file."""
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+class ObservationStore:
+    """Observations stored in the SQLite database `path`. The store can be used from several
+       threads. Instances are context managers."""
+
+    def __init__(self, path: str):
+        """Initialization. Creates the database if it doesn't exist."""
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS observations ("
+                            "id TEXT PRIMARY KEY, modified TEXT, lon REAL, lat REAL, data TEXT)")
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(observations)")]
+            if "lon" not in columns:
+                # Add the coordinates to a store made before they were indexed.
+                self.db.execute("ALTER TABLE observations ADD COLUMN lon REAL")
+                self.db.execute("ALTER TABLE observations ADD COLUMN lat REAL")
+            self.db.executescript(SCHEMA)
+            if "lon" not in columns:
+                rows = self.db.execute("SELECT id, data FROM observations").fetchall()
+                self.db.executemany("UPDATE observations SET lon = ?, lat = ? WHERE id = ?",
+                                    [observation_wgs84(json.loads(data)) + (id,)
+                                     for id, data in rows])
+
+    def close(self):
+        """Close the database."""
+        with self.lock:
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT count(*) FROM observations").fetchone()[0]
+
+    def __iter__(self):
+        """Iterate over the stored observations."""
+        with self.lock:
+            rows = self.db.execute("SELECT data FROM observations").fetchall()
+        for (data,) in rows:
+            yield json.loads(data)
+
+    def upsert(self, observations):
+        """Store the observations in `observations` in one transaction, replacing stored
+           observations with the same id. Returns the number of observations stored."""
+        rows = [(str(observation_id(o)), field_value(o, MODIFIED_ATTRIBUTE))
+                + observation_wgs84(o) + (json.dumps(o),)
+                for o in observations]
+        with self.lock, self.db:
+            self.db.executemany("INSERT INTO observations (id, modified, lon, lat, data) "
+                                "VALUES (?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+                                "modified = excluded.modified, lon = excluded.lon, "
+                                "lat = excluded.lat, data = excluded.data", rows)
+        return len(rows)
+
+    def get(self, id):
+        """Returns the observation with the given id, or None."""
+        with self.lock:
+            row = self.db.execute("SELECT data FROM observations WHERE id = ?",
+                                  (str(id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete(self, id):
+        """Remove the observation with the given id, if there is one."""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM observations WHERE id = ?", (str(id),))
+
+    def query(self, sql: str, params: tuple = ()):
+        """Returns the observations selected by the data column of `sql`."""
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def in_box(self, west: float, south: float, east: float, north: float, limit: int = -1):
+        """Returns at most `limit` (all if negative) observations within the bounding box."""
+        return self.query("SELECT o.data FROM " + BOX_JOIN + " LIMIT ?",
+                          box_params((west, south, east, north)) + (limit,))
+
+    def count_in_box(self, west: float, south: float, east: float, north: float):
+        """Returns the number of observations within the bounding box."""
+        with self.lock:
+            return self.db.execute("SELECT count(*) FROM " + BOX_JOIN,
+                                   box_params((west, south, east, north))).fetchone()[0]
+
+    def located_in_box(self, box: tuple):
+        """Returns a list of (lon, lat, rowid) of the observations within `box` (west, south,
+           east, north)."""
+        with self.lock:
+            return self.db.execute("SELECT o.lon, o.lat, o.rowid FROM " + BOX_JOIN,
+                                   box_params(box)).fetchall()
+
+    def by_rowids(self, rowids: list):
+        """Returns the observations with the given row ids, in that order."""
+        found = {}
+        for i in range(0, len(rowids), 500):
+            batch = rowids[i:i + 500]
+            with self.lock:
+                rows = self.db.execute("SELECT rowid, data FROM observations WHERE rowid IN "
+                                       "(%s)" % ",".join("?" * len(batch)), batch).fetchall()
+            found.update(rows)
+        return [json.loads(found[r]) for r in rowids]
+
+    def within_radius(self, lon: float, lat: float, radius: float):
+        """Returns the observations within `radius` meters of the WGS 84 point (lon, lat),
+           nearest first."""
+        candidates = [(distance(lon, lat, x, y), rowid)
+                      for x, y, rowid in self.located_in_box(radius_box(lon, lat, radius))]
+        return self.by_rowids([rowid for d, rowid in sorted(candidates) if d <= radius])
+
+    def nearest(self, lon: float, lat: float, k: int = 10):
+        """Returns the `k` observations nearest the WGS 84 point (lon, lat), nearest first. The
+           search radius starts at 1 km and is doubled until the k nearest are found."""
+        radius = 1000.0
+        while True:
+            candidates = sorted((distance(lon, lat, x, y), rowid)
+                                for x, y, rowid in self.located_in_box(radius_box(lon, lat,
+                                                                                  radius)))
+            within = [c for c in candidates if c[0] <= radius]
+            if len(within) >= k or radius > math.pi * EARTH_RADIUS:
+                return self.by_rowids([rowid for d, rowid in within[:k]])
+            radius *= 2
+
+    def grid_counts(self, cell_size: float, box: tuple = None):
+        """Returns a dictionary of the number of observations in each cell of a grid of square
+           cells of `cell_size` degrees, optionally only within the bounding box `box` (west,
+           south, east, north). The cells are indexed by (column, row), the cell with the
+           corner (0, 0) being (0, 0)."""
+        column = "CAST(o.lon / ? + 1000000 AS INTEGER) - 1000000"
+        row = "CAST(o.lat / ? + 1000000 AS INTEGER) - 1000000"
+        if box is not None:
+            where, params = BOX_JOIN, box_params(box)
+        else:
+            where, params = "observations o WHERE o.lon IS NOT NULL", ()
+        with self.lock:
+            rows = self.db.execute(f"SELECT {column}, {row}, count(*) FROM {where} GROUP BY 1, 2",
+                                   (cell_size, cell_size) + params).fetchall()
+        return {(column, row): n for column, row, n in rows}
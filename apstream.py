@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""
+Python module for parsing a JSON array incrementally while it is being downloaded. Large pages
+of observations from Artportalens ObservationsAPI are JSON objects with the observations in a
+"records" array. With a JSONArrayStream the observations are decoded and yielded one at a time as
+their bytes arrive, so only about one observation at a time is kept in memory and the first one
+is available before the page has been downloaded.
+"""
+
+import re
+import json
+import codecs
+
+# Constants
+DEFAULT_CHUNK_SIZE = 65536  # Bytes read from the response at a time
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class JSONArrayStream:
+    """Iterates over the elements of the array `key` of the JSON object in the byte chunks
+       `chunks`, decoding one element at a time. If `key` is None, or the JSON document is an
+       array, the elements of the document are iterated over. The other members of the object
+       are put in the dictionary `meta`, which is complete when the iteration has ended. Raises
+       ValueError if the document is not valid JSON or doesn't have the array. `close` is called
+       when the iteration ends or the stream is closed, if it is given. Instances are context
+       managers."""
+
+    def __init__(self, chunks, key: str = "records", close=None):
+        """Initialization."""
+        self.chunks = iter(chunks)
+        self.key = key
+        self.meta = {}
+        self.count = 0
+        self._close = close
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def close(self):
+        """Close the underlying response, if any."""
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        try:
+            yield from self.elements()
+        finally:
+            self.close()
+
+    def fill(self):
+        """Read the next chunk into the buffer, dropping what has been parsed. Returns False if
+           there are no more chunks."""
+        if self.eof:
+            return False
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer += self.utf8.decode(chunk)
+                return True
+        self.buffer += self.utf8.decode(b'', final=True)
+        self.eof = True
+        return False
+
+    def next_char(self):
+        """Returns the next character that is not white space, without consuming it, or '' at
+           the end of the document."""
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars: str):
+        """Consume and return the next character, which must be one of `chars`."""
+        c = self.next_char()
+        if not c or c not in chars:
+            raise ValueError(f"Expected one of {chars!r} at {c!r} in the JSON document")
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Decode and return the next JSON value, reading chunks until it is complete."""
+        c = self.next_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise ValueError("The JSON document is truncated or invalid")
+            # A number at the end of the buffer may continue in the next chunk.
+            if c not in '{["' and end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def array(self):
+        """Yield the elements of the array whose '[' has been consumed."""
+        if self.next_char() == ']':
+            self.pos += 1
+            return
+        while True:
+            self.count += 1
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+    def elements(self):
+        """Yield the elements of the array in the document."""
+        if self.expect('{[') == '[':
+            yield from self.array()
+            return
+        found = False
+        if self.next_char() == '}':
+            self.pos += 1
+        else:
+            while True:
+                name = self.value()
+                self.expect(':')
+                if name == self.key and not found and self.next_char() == '[':
+                    self.pos += 1
+                    found = True
+                    yield from self.array()
+                else:
+                    self.meta[name] = self.value()
+                if self.expect(',}') == '}':
+                    break
+        if not found and self.key is not None:
+            raise ValueError(f"The JSON document has no array {self.key!r}")
+
+
+def stream_response(response, key: str = "records", chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Returns a JSONArrayStream over the array `key` in the body of the requests response
+       `response`, which should have been requested with `stream=True`. The response is closed
+       when the stream is."""
+    return JSONArrayStream(response.iter_content(chunk_size), key, response.close)
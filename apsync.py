@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+Python module for incremental synchronization of observations from Artportalens ObservationsAPI
+to a local `apstore.ObservationStore`. For every search filter a watermark is kept in a state
+file: the latest modification time of the synchronized observations, and the ids of the
+observations with that modification time. A synchronization only fetches the observations that
+have been modified since the watermark.
+"""
+
+from artportalen import (API_MAX_TAKE, ObservationsAPI, SearchFilter, field_value,
+                         observation_id)
+from apstore import MODIFIED_ATTRIBUTE, ObservationStore, read_json, write_json_atomic
+
+
+class ObservationSync:
+    """Synchronizes observations from `api` to `store`, keeping the watermarks in the JSON file
+       `state_path`."""
+
+    def __init__(self, api: ObservationsAPI, store: ObservationStore, state_path: str):
+        """Initialization."""
+        self.api = api
+        self.store = store
+        self.state_path = state_path
+        self.state = read_json(state_path, {})
+
+    def filter_key(self, search_filter: SearchFilter):
+        """Returns the key of the watermark of `search_filter`. The modified date criteria are
+           not part of the key, since they are set by the synchronization."""
+        return search_filter.canonical_hash(exclude=("modifiedDate",))
+
+    def watermark(self, search_filter: SearchFilter):
+        """Returns the watermark of `search_filter` as a tuple of the latest modification time
+           (None if the filter has never been synchronized) and the ids of the observations with
+           that modification time."""
+        w = self.state.get(self.filter_key(search_filter), {})
+        return w.get("modified"), set(w.get("ids", []))
+
+    def reset(self, search_filter: SearchFilter):
+        """Forget the watermark of `search_filter`, so the next synchronization fetches all
+           observations."""
+        self.state.pop(self.filter_key(search_filter), None)
+        write_json_atomic(self.state_path, self.state)
+
+    def sync(self, search_filter: SearchFilter, page_size: int = API_MAX_TAKE, verbose=False):
+        """Fetch the observations matching `search_filter` that have been modified since its
+           watermark, store them and advance the watermark. The watermark is saved after each
+           stored page, so an interrupted synchronization continues where it stopped. The
+           search cache of the API is bypassed, since it would hide new modifications. Returns
+           the number of stored observations."""
+        key = self.filter_key(search_filter)
+        modified, boundary_ids = self.watermark(search_filter)
+        f = search_filter.copy()
+        f.set_modified_date(from_date=modified)
+        output = f.filter.get("output")
+        if output and output.get("fields"):
+            for field in ("occurrence.occurrenceId", MODIFIED_ATTRIBUTE):
+                if field not in output["fields"]:
+                    output["fields"].append(field)
+        stored = 0
+        page = []
+        for o in self.api.iter_observations(f, page_size=page_size, sortBy=MODIFIED_ATTRIBUTE,
+                                            sort_descending=False, cached=False,
+                                            verbose=verbose):
+            m = field_value(o, MODIFIED_ATTRIBUTE)
+            oid = str(observation_id(o))
+            if m == modified and oid in boundary_ids:
+                continue
+            page.append(o)
+            if m != modified:
+                modified, boundary_ids = m, set()
+            boundary_ids.add(oid)
+            if len(page) == page_size:
+                stored += self.commit(key, page, modified, boundary_ids)
+                page = []
+        if page:
+            stored += self.commit(key, page, modified, boundary_ids)
+        return stored
+
+    def commit(self, key: str, page: list, modified: str, boundary_ids: set):
+        """Store the observations in `page` and then save the watermark."""
+        n = self.store.upsert(page)
+        self.state[key] = {"modified": modified, "ids": sorted(boundary_ids)}
+        write_json_atomic(self.state_path, self.state)
+        return n
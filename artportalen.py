@@ -5,15 +5,40 @@ Python module for interacting with Artportalens API. This is the new implementat
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 import pprint
 import json
-from datetime import datetime
+import re
+import time
+import hashlib
+import unicodedata
+import copy
+import heapq
+from datetime import date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from apcache import CacheEntry, CacheStats, TieredCache, HTTPCache, key_scope
+from apretry import RequestExecutor
+from apstream import DEFAULT_CHUNK_SIZE, stream_response
+from apmetrics import ResponseTracker, cache_record, response_json
+import apgeo
 
 # Constants
 DEFAULT_FROM_DATE_RFC3339 = '1900-01-01T00:00'
 API_ROOT_URL = 'https://api.artdatabanken.se'
 API_COORDINATSYSTEM_WGS_84_ID = 10
 API_AVES_TAXON_ID = 4000104
+API_MAX_TAKE = 1000  # Maximum number of observations returned in one search request
+API_MAX_SKIP_TAKE = 50000  # Maximum skip + take of a search request
+DEFAULT_POOL_SIZE = 10  # Number of kept-alive connections per host in a session
+DEFAULT_MAX_WORKERS = 4  # Number of concurrent requests when fetching shards of a search
+SPECIES_API_MAX_TAXA_PER_REQUEST = 100  # Number of taxon ids sent in one request for species data
+DEFAULT_SPECIES_CACHE_TTL = 7 * 24 * 3600  # Seconds before cached species data is revalidated
+DEFAULT_AREA_CATALOG_TTL = 30 * 24 * 3600  # Seconds before a cached area catalog is refreshed
+DEFAULT_REFERENCE_CACHE_TTL = 24 * 3600  # Seconds reference data responses are fresh by default
+CLOSED_SEARCH_CACHE_TTL = 30 * 24 * 3600  # Seconds search results for past dates are cached
+OPEN_SEARCH_CACHE_TTL = 5 * 60  # Seconds other search results are cached
+ORDERED_CRITERIA = frozenset(["coordinates"])  # Search filter lists whose order matters
+ISO_FRACTION = re.compile(r'(?<=\d\d:\d\d:\d\d)\.(\d+)')  # Fractional seconds of a time
 
 EXAMPLE_SPECIES = "Tajgasångare"
 EXAMPLE_TAXON_ID = 205835  # Id för Tajgasångare
@@ -77,6 +102,15 @@ class Person:
         self.full_name = None
 
 
+class APIError(Exception):
+    """Raised when an API request fails in a way the caller can't be told about with a return
+       value, for instance in the middle of iterating over paged results."""
+
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+
+
 def auth_headers(api_key, auth_token=None):
     """Dictionary of authentication headers for API requests."""
     h = {'Ocp-Apim-Subscription-Key': api_key}
@@ -85,6 +119,146 @@ def auth_headers(api_key, auth_token=None):
     return h
 
 
+def field_value(d: dict, path: str):
+    """Returns the value of the attribute `path` in the JSON object `d`, where `path` is a dot
+       separated attribute path like "event.startDate" as used by the "sortBy" request parameter.
+       Attribute names are matched case insensitively, like the API does. Returns None if there
+       is no such attribute."""
+    for name in path.split('.'):
+        if not isinstance(d, dict):
+            return None
+        if name in d:
+            d = d[name]
+        else:
+            lname = name.lower()
+            d = next((v for k, v in d.items() if k.lower() == lname), None)
+    return d
+
+
+def normalize_name(name: str):
+    """Returns `name` normalized for comparisons of names: Unicode NFC normalized, case folded
+       and with surrounding and repeated whitespace removed."""
+    return " ".join(unicodedata.normalize("NFC", name).casefold().split())
+
+
+def parse_iso_datetime(s: str):
+    """Returns the ISO 8601 date and time `s` as a datetime. Unlike `datetime.fromisoformat()`
+       in Python 3.10 it accepts the UTC designator Z and fractional seconds of any number of
+       digits, like the "2024-05-01T06:00:00.1234567Z" of the API, truncated to microseconds.
+       Raises ValueError if `s` is not a date and time."""
+    if s[-1:] in ('Z', 'z'):
+        s = s[:-1] + '+00:00'
+    s = ISO_FRACTION.sub(lambda m: '.' + (m.group(1) + '00000')[:6], s)
+    return datetime.fromisoformat(s)
+
+
+def observation_id(o: dict):
+    """Returns the unique id of the observation `o`."""
+    occurrence_id = field_value(o, "occurrence.occurrenceId")
+    if occurrence_id is not None:
+        return occurrence_id
+    return o.get("id")
+
+
+def observation_wgs84(o: dict):
+    """Returns the WGS 84 coordinates of the observation `o` as the tuple (easting, northing),
+       that is (longitude, latitude), or (None, None) if it has none. Handles both the location
+       of the ObservationsAPI and the site coordinates of the older Artportalen API."""
+    location = o.get("location")
+    if location and location.get("decimalLongitude") is not None:
+        return location["decimalLongitude"], location["decimalLatitude"]
+    for c in o.get("site", {}).get("coordinates", []):
+        if c["coordinateSystemId"] == API_COORDINATSYSTEM_WGS_84_ID:
+            return c["easting"], c["northing"]
+    return None, None
+
+
+def new_session(pool_size: int = DEFAULT_POOL_SIZE):
+    """Returns a new requests session with a connection pool of `pool_size` kept-alive
+       connections per host and gzip compressed responses. A session can be shared by several
+       API instances, and by several threads, so they reuse the same TCP/TLS connections."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                            'Connection': 'keep-alive'})
+    return session
+
+
+class SessionClient:
+    """Base class for the API classes. Manages the requests session used for all HTTP requests.
+       If no session is given a session of its own is created, which is closed by `close()`. A
+       given session is owned by the caller and is left open. Instances are context managers.
+       If a `cache` (see the module apcache) is given, responses to GET requests made with
+       `get_json()` are cached by an `apcache.HTTPCache` in `http_cache`, for as long as their
+       Cache-Control header says or else `cache_ttl` seconds, and then revalidated with a
+       conditional request if the response had an ETag or Last-Modified header. Its `stats` has
+       the hit rate. Requests are sent by an `apretry.RequestExecutor`, which retries failed
+       requests and can rate limit them. It can be shared with other API instances. If a
+       `key_pool` (see the module apkeys) is given, the requests are spread over its API keys.
+       The metadata of the last responses of each thread or asyncio task is kept by an
+       `apmetrics.ResponseTracker` in `responses`."""
+
+    def __init__(self, session: requests.Session = None, pool_size: int = DEFAULT_POOL_SIZE,
+                 cache=None, cache_ttl: float = None, executor: RequestExecutor = None,
+                 key_pool=None):
+        """Initialization."""
+        self.owns_session = session is None
+        self.session = session if session is not None else new_session(pool_size)
+        self.cache = cache
+        self.cache_ttl = cache_ttl
+        self.http_cache = HTTPCache(cache, cache_ttl) if cache is not None else None
+        self.executor = executor if executor is not None else RequestExecutor()
+        self.key_pool = key_pool
+        self.responses = ResponseTracker()
+
+    def close(self):
+        """Close the session, if this instance created it."""
+        if self.owns_session:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def request(self, method: str, url: str, authenticated=True, **kwargs):
+        """Send an HTTP request with the executor and return the response. A request that is
+           not `authenticated` is not sent with the keys of the key pool."""
+        key_pool = self.key_pool if authenticated else None
+        r = self.executor.request(self.session, method, url, key_pool=key_pool, **kwargs)
+        self.responses.track(r, streamed=kwargs.get('stream', False))
+        return r
+
+    def last_response(self):
+        """Returns the metadata of the last response (an `apmetrics.ResponseInfo`) of the
+           current thread or asyncio task, or None. Use this to check any problems in the last
+           API request. You can use the attributes "status_code", "request_id" and "text" (the
+           start of the body of a failed response) to find out more."""
+        return self.responses.last()
+
+    def get_json(self, url: str, headers: dict, verbose=False, cached=True):
+        """Returns the tuple (status code, decoded JSON body) of a GET request to `url`. The
+           body is None if the request failed. Successful responses are cached if there is a
+           cache and `cached` is true, and then the status code of a cached response is 200."""
+        def send(url, headers):
+            r = self.request('GET', url, headers=headers)
+            if verbose:
+                print('GET %s' % url)
+                print_http_response(r)
+            return r
+
+        if cached and self.http_cache is not None:
+            r, value = self.http_cache.fetch(send, url, headers, verbose)
+            if self.executor.hooks and getattr(r, 'from_cache', False):
+                cache_record('GET', url, r.cache, self.executor.hooks)
+            return r.status_code, value
+        r = send(url, headers)
+        return r.status_code, response_json(r) if r.status_code == 200 else None
+
+
 def print_http_response(r):
     """Print the HTTP resonse (from a requests.get call) to stdout."""
     print('HTTP Status code: %s' % (r.status_code))
@@ -97,46 +271,210 @@ def print_http_response(r):
         pprint.pprint(r.content.decode())
 
 
-class SpeciesAPI:
+def search_params(skip: int, take: int, sortBy: str, sort_descending: bool,
+                  validateSearchFilter: bool = False, translationCultureCode: str = None):
+    """Returns the request parameters for a search in the ObservationsAPI."""
+    params = {"skip": skip,
+              "take": take,
+              "sortBy": sortBy,
+              "sortOrder": 'Desc' if sort_descending else 'Asc',
+              "validateSearchFilter": validateSearchFilter}
+    if translationCultureCode:
+        params["translationCultureCode"] = translationCultureCode
+    return params
+
+
+def page_records(page):
+    """Returns the list of observations in `page`, which is a response from the ObservationsAPI
+       search resource. The resource wraps the observations in a "records" attribute."""
+    if isinstance(page, dict):
+        return page.get("records", [])
+    return page
+
+
+def canonical_criteria(value, key: str = None):
+    """Returns the search filter criteria `value` with the elements of lists sorted, except
+       within the criteria in ORDERED_CRITERIA, where the order matters."""
+    if key in ORDERED_CRITERIA:
+        return value
+    if isinstance(value, dict):
+        return {k: canonical_criteria(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        items = [canonical_criteria(v) for v in value]
+        return sorted(items, key=lambda v: json.dumps(v, sort_keys=True))
+    return value
+
+
+def merge_observations(shards: list[list], sortBy: str, sort_descending: bool = True):
+    """Returns the observations in the lists in `shards`, each of which is sorted by the
+       attribute `sortBy`, merged into one sorted list without duplicate observations."""
+    def key(o):
+        v = field_value(o, sortBy)
+        return (v is not None, v if v is not None else '')
+
+    seen = set()
+    merged = []
+    for o in heapq.merge(*shards, key=key, reverse=sort_descending):
+        oid = observation_id(o)
+        if oid is None or oid not in seen:
+            seen.add(oid)
+            merged.append(o)
+    return merged
+
+
+class SpeciesAPI(SessionClient):
     """Handles requests to Artportalens Artfakta - Species information API."""
 
-    def __init__(self, api_key: str):
-        """Initialization. The client is responsible for managing secrets."""
+    def __init__(self, api_key: str, session: requests.Session = None,
+                 pool_size: int = DEFAULT_POOL_SIZE,
+                 cache=None, cache_ttl: float = DEFAULT_SPECIES_CACHE_TTL,
+                 index=None, executor: RequestExecutor = None, root_url: str = API_ROOT_URL,
+                 key_pool=None):
+        """Initialization. The client is responsible for managing secrets. A `session` from
+           `new_session()` can be shared with other API instances. Taxa are cached in `cache`,
+           for instance `apcache.open_cache("species")`, if it is given. Names are looked up
+           in the local `index`, a `taxonindex.TaxonIndex`, before the API, if it is given.
+           `root_url` can be set to use a stand-in server. Requests are sent with the keys of
+           `key_pool`, an `apkeys.KeyPool`, if it is given, and otherwise with `api_key`."""
+        super().__init__(session, pool_size, cache, cache_ttl, executor, key_pool)
+        self.index = index
         self.key = api_key
-        self.url = API_ROOT_URL + "/information/v1/speciesdataservice/v1/"
+        self.url = root_url + "/information/v1/speciesdataservice/v1/"
         self.search_url = self.url + "speciesdata"
         self.headers = auth_headers(self.key)
 
-    def taxa_by_name(self, name, exact_match=True, verbose=False):
-        """Returns list of all taxa that match the name."""
+    def taxa_by_name(self, name, exact_match=True, verbose=False, fuzzy=False):
+        """Returns list of all taxa that match the name. If there is an index, the taxa with the
+           name, or names starting with the name if not `exact_match`, or names within a small
+           edit distance of the name, the closest first, if `fuzzy`, are looked up in the index
+           first, and the API is only called if there are none. Without an index `fuzzy` is
+           ignored."""
+        if self.index is not None:
+            if fuzzy:
+                taxa = self.index.fuzzy(name)
+            else:
+                taxa = self.index.exact(name) if exact_match else self.index.prefix(name)
+            if taxa:
+                return taxa
         url = self.search_url + f"/search?searchString={name}"
-        r = requests.get(url, headers=self.headers)
-        if verbose:
-            print('GET %s' % url)
-            print_http_response(r)
-        if r.status_code == 200:
-            for d in r.json():
+        status, taxa = self.get_json(url, self.headers, verbose)
+        if status == 200:
+            for d in taxa:
                 if exact_match:
                     if d['swedishName'] == name.lower():
                         return [d]
                 else:
-                    return r.json()
+                    return taxa
         else:
             if verbose:
                 print("Something went wrong in the API request.")
         return None
 
+    def taxon_url(self, id):
+        """Returns the URL for the species data of the taxon with the given id."""
+        return self.search_url + f"?taxa={id}"
+
     def taxon_by_id(self, id, verbose=False):
         """Returns the taxon with the given id."""
-        url = self.search_url + f"?taxa={id}"
-        r = requests.get(url, headers=self.headers)
-        if verbose:
-            print('GET %s' % url)
-            print_http_response(r)
-        if r.json() == []:
+        url = self.taxon_url(id)
+        status, taxon = self.get_json(url, self.headers, verbose)
+        if not taxon:
             return None
         else:
-            return r.json()
+            return taxon
+
+    def taxa_by_ids(self, ids: list,
+                    batch_size: int = SPECIES_API_MAX_TAXA_PER_REQUEST,
+                    max_workers: int = DEFAULT_MAX_WORKERS,
+                    verbose=False):
+        """Returns a dictionary of the taxa with the given ids, indexed by taxon id. Taxa that
+           aren't found are left out. The ids are requested in batches of `batch_size` ids per
+           request, with at most `max_workers` concurrent requests. Taxa in the cache are not
+           requested, and the requested taxa are cached one by one, as `taxon_by_id()` does.
+           Raises APIError, with the response of the failed request, if a batch fails."""
+        assert batch_size > 0
+        taxa = {}
+        missing = []
+        for id in dict.fromkeys(ids):
+            cached = None
+            if self.http_cache is not None:
+                cached = self.http_cache.lookup(self.taxon_url(id), self.headers)
+            if cached is not None:
+                for d in cached:
+                    taxa[d['taxonId']] = d
+            else:
+                missing.append(id)
+
+        def fetch(batch):
+            url = self.search_url + "?taxa=" + ",".join(str(id) for id in batch)
+            status, result = self.get_json(url, self.headers, verbose, cached=False)
+            if result is None:
+                raise APIError(f"Taxa request failed with status {status} for the ids "
+                               f"{batch[0]}..{batch[-1]}", self.last_response())
+            return result
+
+        batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for result in executor.map(fetch, batches):
+                for d in result:
+                    taxa[d['taxonId']] = d
+                    if self.http_cache is not None:
+                        self.http_cache.put(self.taxon_url(d['taxonId']), self.headers, [d])
+        return taxa
+
+
+class Projection:
+    """A named projection of the observations returned by a search: the output field set and
+       the observation attributes (dot separated paths) to ask for. `strings` maps names to the
+       string attributes that readers of the observations decode, which are included in the
+       fields. The projection is set on a search filter with `SearchFilter.set_projection()`,
+       and `apdecode.decode_observations()` only decodes the attributes it includes."""
+
+    def __init__(self, name: str, fields: list[str], strings: dict = None,
+                 fieldSet: str = "Minimum"):
+        """Initialization."""
+        self.name = name
+        self.strings = dict(strings or {})
+        self.fields = list(dict.fromkeys(list(fields) + list(self.strings.values())))
+        self.fieldSet = fieldSet
+
+    def includes(self, attribute: str):
+        """True if the attribute, or an attribute containing it, is in the projection."""
+        return any(attribute == f or attribute.startswith(f + '.') for f in self.fields)
+
+    def missing(self, attributes):
+        """Returns the list of the attributes in `attributes` not in the projection."""
+        return [a for a in attributes if not self.includes(a)]
+
+    def check(self, attributes, reader: str):
+        """Raise ValueError if any of the attributes `attributes`, which are read by `reader`,
+           are not in the projection."""
+        missing = self.missing(attributes)
+        if missing:
+            raise ValueError(f"The projection {self.name} lacks the attributes "
+                             f"{', '.join(missing)} read by {reader}")
+
+
+ID_ATTRIBUTES = ["occurrence.occurrenceId"]
+TAXON_ID_ATTRIBUTES = ["taxon.id"]
+DATE_ATTRIBUTES = ["event.startDate", "event.endDate"]
+WGS84_ATTRIBUTES = ["location.decimalLongitude", "location.decimalLatitude"]
+# The named projections of observations.
+PROJECTIONS = {p.name: p for p in [
+    Projection("geo", ID_ATTRIBUTES + DATE_ATTRIBUTES + WGS84_ATTRIBUTES),
+    Projection("taxon-count", ID_ATTRIBUTES + TAXON_ID_ATTRIBUTES + DATE_ATTRIBUTES[:1]),
+    Projection("display", ID_ATTRIBUTES + DATE_ATTRIBUTES + WGS84_ATTRIBUTES,
+               {"discovery_method": "event.discoveryMethod.value",
+                "reporter": "occurrence.reportedBy",
+                "observers": "occurrence.recordedBy",
+                "site": "location.locality",
+                "comment": "occurrence.occurrenceRemarks"}),
+    Projection("export", ID_ATTRIBUTES + TAXON_ID_ATTRIBUTES + DATE_ATTRIBUTES + WGS84_ATTRIBUTES,
+               {"scientific_name": "taxon.scientificName",
+                "vernacular_name": "taxon.vernacularName",
+                "county": "location.county.name",
+                "municipality": "location.municipality.name",
+                "data_provider_id": "dataProviderId"})]}
 
 
 class SearchFilter:
@@ -159,6 +497,75 @@ class SearchFilter:
         """Returns a JSON string representation of this filter."""
         return json.dumps(self.filter)
 
+    def canonical_hash(self, exclude: tuple = (), sort_lists: bool = False):
+        """Returns a hash (a hex string) of the criteria of this filter, which is the same for
+           equal filters regardless of the order the criteria were set in. Top level criteria
+           named in `exclude` are left out. If `sort_lists` is true the hash is also the same
+           regardless of the order of the elements of lists, like taxon ids or areas, except for
+           the coordinates of geometries."""
+        criteria = {k: v for k, v in self.filter.items() if k not in exclude}
+        if sort_lists:
+            criteria = canonical_criteria(criteria)
+        s = json.dumps(criteria, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(s.encode()).hexdigest()
+
+    def date_window_closed(self, today: date = None):
+        """True if the filter has an end date before `today`, which defaults to the current
+           date, and no modified date criteria. The observations of such a date window are not
+           expected to change, but observations modified since a given time are."""
+        if any((self.filter.get("modifiedDate") or {}).values()):
+            return False
+        end = (self.filter.get("date") or {}).get("endDate")
+        if not end:
+            return False
+        try:
+            end_date = parse_iso_datetime(end).date()
+        except ValueError:
+            return False
+        return end_date < (today if today is not None else date.today())
+
+    def copy(self):
+        """Returns a deep copy of this filter."""
+        c = SearchFilter()
+        c.filter = copy.deepcopy(self.filter)
+        return c
+
+    def split_by_date(self, shards: int):
+        """Returns a list of at most `shards` copies of this filter, whose date ranges split the
+           date range of this filter into consecutive, equally long ranges of whole days. The first
+           and last copy keep the start and end date of this filter as they are."""
+        date = self.filter.get("date", {})
+        if not date.get("startDate") or not date.get("endDate"):
+            raise ValueError("The search filter has no date range to split")
+        start = parse_iso_datetime(date["startDate"]).date()
+        end = parse_iso_datetime(date["endDate"]).date()
+        days = (end - start).days + 1
+        shards = max(1, min(shards, days))
+        filters = []
+        for i in range(shards):
+            f = self.copy()
+            first = start + timedelta(days=i * days // shards)
+            last = start + timedelta(days=(i + 1) * days // shards - 1)
+            if i > 0:
+                f.filter["date"]["startDate"] = first.isoformat()
+            if i < shards - 1:
+                f.filter["date"]["endDate"] = last.isoformat()
+            filters.append(f)
+        return filters
+
+    def split_by_areas(self, areas_per_shard: int = 1):
+        """Returns a list of copies of this filter, each with at most `areas_per_shard` of the
+           areas set with `set_geographics_areas()`."""
+        areas = self.filter.get("geographics", {}).get("areas")
+        if not areas:
+            raise ValueError("The search filter has no geographic areas to split")
+        filters = []
+        for i in range(0, len(areas), areas_per_shard):
+            f = self.copy()
+            f.filter["geographics"]["areas"] = areas[i:i + areas_per_shard]
+            filters.append(f)
+        return filters
+
     def set_dataProvider(self, ids: list[str] = []):
         """Set the data providers by providing a list of id:s.
            Use `ObservationsAPI.data_providers()` to find out valid data providers."""
@@ -262,47 +669,124 @@ class SearchFilter:
         self.filter["output"] = {"fieldSet": fieldSet,
                                  "fields": fields}
 
+    def set_projection(self, projection):
+        """Set the output scope of the search filter to the Projection `projection`, or the
+           projection in PROJECTIONS with that name."""
+        if isinstance(projection, str):
+            projection = PROJECTIONS[projection]
+        self.set_output(fieldSet=projection.fieldSet, fields=list(projection.fields))
+
 
-class ObservationsAPI:
+class AreaCatalog:
+    """A catalog of the areas of each area type in the ObservationsAPI, indexed by normalized
+       name. The areas of a type are downloaded the first time they are needed, and are kept in
+       `cache` for `ttl` seconds before they are downloaded again. The pages of areas are not
+       cached by the HTTP cache of the API, since the catalog caches them."""
+
+    def __init__(self, api, cache=None, ttl: float = DEFAULT_AREA_CATALOG_TTL):
+        """Initialization. `api` is the ObservationsAPI to download the areas with."""
+        self.api = api
+        self.cache = cache if cache is not None else TieredCache()
+        self.ttl = ttl
+        self.indexes = {}
+
+    def areas(self, area_type: str, verbose=False):
+        """Returns the list of all areas of the type `area_type`."""
+        key = f"areas:{area_type}"
+        entry = self.cache.get(key)
+        if entry is None or not entry.fresh():
+            areas = []
+            while True:
+                page = self.api.areas(area_type, skip=len(areas), verbose=verbose, cached=False)
+                if page is None:
+                    raise APIError(f"Could not get the areas of type {area_type}",
+                                   self.api.last_response())
+                records = page_records(page)
+                areas.extend({"areaType": a.get("areaType", area_type),
+                              "featureId": a["featureId"],
+                              "name": a["name"]} for a in records)
+                total = page.get("totalCount") if isinstance(page, dict) else None
+                if len(records) < API_MAX_TAKE or (total is not None and len(areas) >= total):
+                    break
+            entry = CacheEntry(areas, time.time() + self.ttl)
+            self.cache.set(key, entry)
+        return entry.value
+
+    def index(self, area_type: str, verbose=False):
+        """Returns a dictionary of the areas of type `area_type` indexed by normalized name."""
+        expires, index = self.indexes.get(area_type, (0, None))
+        if index is None or time.time() >= expires:
+            index = {}
+            for a in self.areas(area_type, verbose):
+                index.setdefault(normalize_name(a["name"]), []).append(a)
+            self.indexes[area_type] = (time.time() + self.ttl, index)
+        return index
+
+    def resolve(self, area_type: str, name: str, verbose=False):
+        """Returns the list of areas of the type `area_type` named `name`, ignoring case, as
+           dictionaries with the attributes "areaType" and "featureId" that can be used with
+           `SearchFilter.set_geographics_areas()`."""
+        return [{"areaType": a["areaType"], "featureId": a["featureId"]}
+                for a in self.index(area_type, verbose).get(normalize_name(name), [])]
+
+
+class ObservationsAPI(SessionClient):
     """Handles requests to Artportalens Species Observations Service API."""
 
     # See the Observation object in the API for alternative attributes to sort by.
     DEFAULT_SORT_BY_ATTRIBUTE_FOR_OBSERVATIONS = 'event.startDate'
 
-    def __init__(self, api_key: str):
-        """Initialization. The client is responsible for managing secrets."""
+    def __init__(self, api_key: str, session: requests.Session = None,
+                 pool_size: int = DEFAULT_POOL_SIZE, executor: RequestExecutor = None,
+                 area_cache=None, cache=None, cache_ttl: float = DEFAULT_REFERENCE_CACHE_TTL,
+                 search_cache=None, root_url: str = API_ROOT_URL, key_pool=None):
+        """Initialization. The client is responsible for managing secrets. A `session` from
+           `new_session()` can be shared with other API instances. The area catalogs used to
+           find areas by name are cached in `area_cache`, for instance
+           `apcache.open_cache("areas")`, if it is given, and otherwise only in memory. The
+           responses of the reference data resources (version, data providers and areas) are
+           cached in `cache`, for instance `apcache.open_cache("http")`, if it is given. Search
+           results are cached in `search_cache` if it is given (see `observations()`).
+           `root_url` can be set to use a stand-in server. Requests are sent with the keys of
+           `key_pool`, an `apkeys.KeyPool`, if it is given, and otherwise with `api_key`."""
+        super().__init__(session, pool_size, cache, cache_ttl, executor, key_pool)
         self.key = api_key
-        self.url = API_ROOT_URL + "/species-observation-system/v1/"
+        self.url = root_url + "/species-observation-system/v1/"
         self.search_url = self.url + "Observations/Search"
         self.headers = auth_headers(self.key)
-
-    def last_response(self):
-        """Returns the last response (a requests response object). Use this to check any problems
-           in the last API request. You can use the attributes "status_code" and "content" to find
-           out more. See: https://requests.readthedocs.io/en/latest/api/#requests.Response"""
-        return self.last_response
+        self.area_catalog = AreaCatalog(self, area_cache)
+        self.search_cache = search_cache
+        self.search_stats = CacheStats()
 
     def version(self, verbose=False):
         """Returns version of the API. This can be used to ping the API.
            See: https://api-portal.artdatabanken.se/api-details#
            api=sos-api-v1&operation=ApiInfo_GetApiInfo"""
         url = self.url + "api/ApiInfo"
-        r = requests.get(url, headers=self.headers)
-        if verbose:
-            print('GET %s' % url)
-            print_http_response(r)
-        return r.json()
+        status, v = self.get_json(url, self.headers, verbose)
+        return v
 
     def data_providers(self, verbose=False):
         """Returns a list of data providers that have observations in the API.
            See: https://api-portal.artdatabanken.se/api-details#
            api=sos-api-v1&operation=DataProviders_GetDataProviders"""
-        url = self.url + "/DataProviders"
-        r = requests.get(url, headers=self.headers)
-        if verbose:
-            print('GET %s' % url)
-            print_http_response(r)
-        return r.json()
+        url = self.url + "DataProviders"
+        status, providers = self.get_json(url, self.headers, verbose)
+        return providers
+
+    def areas(self, area_type: str, search_string: str = None, skip: int = 0,
+              take: int = API_MAX_TAKE, verbose=False, cached=True):
+        """Returns `take` areas of the type `area_type` starting at `skip` + 1, optionally only
+           those whose names match `search_string`. See `SearchFilter.set_geographics_areas()`
+           for the area types. The response is cached in the HTTP cache if `cached`. Returns
+           None if the request fails.
+           See: https://api-portal.artdatabanken.se/api-details#
+           api=sos-api-v1&operation=Areas_GetAreas"""
+        url = self.url + f"Areas?areaTypes={area_type}&skip={skip}&take={take}"
+        if search_string:
+            url += f"&searchString={search_string}"
+        status, areas = self.get_json(url, self.headers, verbose, cached)
+        return areas
 
     def observations_test(self, verbose=False):
         """Returns the observations based on a hard coded search filter."""
@@ -317,13 +801,11 @@ class ObservationsAPI:
             print(f"HTTP request: POST {url}")
             print(f"HTTP headers: {headers}")
             print(f"HTTP body: {search_filter}")
-        r = requests.post(url, params=params, headers=headers, data=search_filter)
-        self.last_response = r
+        r = self.request('POST', url, params=params, headers=headers, data=search_filter)
         if r.ok:
-            self.last_response = r
             if verbose:
                 print_http_response(r)
-            return r.json()
+            return response_json(r)
         else:
             return None
 
@@ -336,39 +818,299 @@ class ObservationsAPI:
                      translationCultureCode: str = None,  # "sv-SE" or "en-GB"
                      sensitiveObservations: bool = False,  # If true, only sensitive observations
                                                            # will be searched.
+                     cached: bool = True,
                      verbose=False):
         """Returns `take` observations starting at `skip` + 1 according to the criteria in
-           the `search_filter` and the other request parameters.
+           the `search_filter` and the other request parameters. If there is a search cache,
+           results are cached for CLOSED_SEARCH_CACHE_TTL seconds if the date window of the
+           filter has ended, and otherwise for OPEN_SEARCH_CACHE_TTL seconds. The search cache
+           is bypassed if `cached` is false.
            See: https://api-portal.artdatabanken.se/api-details#
            api=sos-api-v1&operation=Observations_ObservationsBySearch"""
-        if sort_descending:
-            sortOrder = 'Desc'
-        else:
-            sortOrder = 'Asc'
         url = self.search_url
-        params = {"skip": skip,
-                  "take": take,
-                  "sortBy": sortBy,
-                  "sortOrder": sortOrder,
-                  "validateSearchFilter": validateSearchFilter,
-                  "translationCultureCode": translationCultureCode}
+        params = search_params(skip, take, sortBy, sort_descending,
+                               validateSearchFilter, translationCultureCode)
+        key = None
+        if cached and self.search_cache is not None:
+            key = self.search_cache_key(search_filter, params)
+            entry = self.search_cache.get(key)
+            if entry is not None and entry.fresh():
+                if verbose:
+                    print(f"HTTP request: POST {url} (cached)")
+                self.search_stats.count('hits')
+                if self.executor.hooks:
+                    cache_record('POST', url, 'hit', self.executor.hooks)
+                return entry.value
+            self.search_stats.count('misses')
         headers = self.headers | {"Content-Type": "application/json"}
         if verbose:
             print(f"HTTP request: POST {url}")
             print(f"HTTP headers: {headers}")
             print(f"HTTP body: {search_filter.json_string()}")
-        r = requests.post(url, params=params, headers=headers, data=search_filter.json_string())
-        self.last_response = r
+        r = self.request('POST', url, params=params, headers=headers,
+                         data=search_filter.json_string())
         if r.ok:
             if verbose:
                 print_http_response(r)
-            return r.json()
+            page = response_json(r)
+            if key is not None:
+                ttl = (CLOSED_SEARCH_CACHE_TTL if search_filter.date_window_closed()
+                       else OPEN_SEARCH_CACHE_TTL)
+                self.search_cache.set(key, CacheEntry(page, time.time() + ttl))
+                self.search_stats.count('stores')
+            return page
         else:
             return None
 
+    def count(self, search_filter: SearchFilter, verbose=False):
+        """Returns the number of observations matching `search_filter`. Counts are cached in the
+           search cache like search results. Raises APIError if the request fails.
+           See: https://api-portal.artdatabanken.se/api-details#
+           api=sos-api-v1&operation=Observations_Count"""
+        url = self.url + "Observations/Count"
+        key = None
+        if self.search_cache is not None:
+            key = self.search_cache_key(search_filter, {"count": True})
+            entry = self.search_cache.get(key)
+            if entry is not None and entry.fresh():
+                self.search_stats.count('hits')
+                if self.executor.hooks:
+                    cache_record('POST', url, 'hit', self.executor.hooks)
+                return entry.value
+            self.search_stats.count('misses')
+        headers = self.headers | {"Content-Type": "application/json"}
+        r = self.request('POST', url, headers=headers, data=search_filter.json_string())
+        if verbose:
+            print(f"HTTP request: POST {url}")
+            print_http_response(r)
+        if not r.ok:
+            raise APIError("Observations count failed", self.last_response())
+        n = int(response_json(r))
+        if key is not None:
+            ttl = (CLOSED_SEARCH_CACHE_TTL if search_filter.date_window_closed()
+                   else OPEN_SEARCH_CACHE_TTL)
+            self.search_cache.set(key, CacheEntry(n, time.time() + ttl))
+            self.search_stats.count('stores')
+        return n
+
+    def search_cache_key(self, search_filter: SearchFilter, params: dict):
+        """Returns the search cache key of a search with `search_filter` and the request
+           parameters `params`. It doesn't depend on the order of the criteria of the filter,
+           or of the elements of its lists."""
+        p = json.dumps(params, sort_keys=True, separators=(',', ':'))
+        return "search %s %s %s" % (key_scope(self.key),
+                                    search_filter.canonical_hash(sort_lists=True),
+                                    hashlib.sha256(p.encode()).hexdigest()[:16])
+
+    def observations_stream(self, search_filter: SearchFilter,
+                            skip: int = 0,
+                            take: int = 100,  # Maximum is 1000
+                            sortBy: str = DEFAULT_SORT_BY_ATTRIBUTE_FOR_OBSERVATIONS,
+                            sort_descending: bool = True,
+                            validateSearchFilter: bool = False,
+                            translationCultureCode: str = None,
+                            chunk_size: int = DEFAULT_CHUNK_SIZE,
+                            verbose=False):
+        """Like `observations()`, but returns an `apstream.JSONArrayStream` that yields the
+           observations one at a time while the response is being downloaded, instead of the
+           whole page. The other attributes of the page, like "totalCount", are in the `meta`
+           dictionary of the stream when it has been iterated over. Raises APIError if the
+           request fails."""
+        url = self.search_url
+        params = search_params(skip, take, sortBy, sort_descending,
+                               validateSearchFilter, translationCultureCode)
+        headers = self.headers | {"Content-Type": "application/json"}
+        if verbose:
+            print(f"HTTP request: POST {url} (streamed)")
+            print(f"HTTP headers: {headers}")
+            print(f"HTTP body: {search_filter.json_string()}")
+        r = self.request('POST', url, params=params, headers=headers,
+                         data=search_filter.json_string(), stream=True)
+        if not r.ok:
+            r.close()
+            raise APIError(f"Observations search failed at skip={skip}",
+                           self.last_response())
+        if verbose:
+            print(f"HTTP Status code: {r.status_code}")
+        return stream_response(r, "records", chunk_size)
+
+    def iter_observations(self, search_filter: SearchFilter,
+                          page_size: int = API_MAX_TAKE,
+                          sortBy: str = DEFAULT_SORT_BY_ATTRIBUTE_FOR_OBSERVATIONS,
+                          sort_descending: bool = True,
+                          skip: int = 0,
+                          limit: int = None,
+                          prefetch: bool = True,
+                          stream: bool = False,
+                          cached: bool = True,
+                          verbose=False):
+        """Yields the observations matching `search_filter` one at a time, fetching them page by
+           page with `page_size` observations per request. Only the current page and the next one
+           are kept in memory. If `prefetch` is true the next page is fetched in a background
+           thread while the current page is being consumed. If `stream` is true the pages are
+           instead parsed while they are downloaded (see `observations_stream()`), so only about
+           one observation is kept in memory. At most `limit` observations are yielded if `limit`
+           is given. The search cache is bypassed if `cached` is false. Raises APIError if a
+           page request fails."""
+        assert 0 < page_size <= API_MAX_TAKE
+        if limit is not None and limit <= 0:
+            return
+        if stream:
+            yield from self._stream_observations(search_filter, page_size, sortBy,
+                                                 sort_descending, skip, limit, verbose)
+            return
+
+        def fetch(skip, take):
+            page = self.observations(search_filter, skip=skip, take=take, sortBy=sortBy,
+                                     sort_descending=sort_descending, cached=cached,
+                                     verbose=verbose)
+            if page is None:
+                raise APIError(f"Observations search failed at skip={skip}",
+                               self.last_response())
+            return page
+
+        def take_at(skip):
+            if limit is None:
+                return page_size
+            return min(page_size, limit - yielded - (skip - position))
+
+        yielded = 0
+        position = skip
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            page = fetch(position, take_at(position))
+            while True:
+                records = page_records(page)
+                next_skip = position + len(records)
+                total = page.get("totalCount") if isinstance(page, dict) else None
+                more = len(records) == page_size and (total is None or next_skip < total)
+                if limit is not None and yielded + len(records) >= limit:
+                    more = False
+                future = None
+                if more and prefetch:
+                    future = executor.submit(fetch, next_skip, take_at(next_skip))
+                # Drop the reference to the page so only the records are kept alive.
+                page = None
+                for record in records:
+                    if limit is not None and yielded >= limit:
+                        break
+                    yielded += 1
+                    yield record
+                if not more:
+                    return
+                records = None
+                position = next_skip
+                page = future.result() if future else fetch(position, take_at(position))
+
+    def _stream_observations(self, search_filter, page_size, sortBy, sort_descending, skip,
+                             limit, verbose):
+        """The streaming page loop of `iter_observations()`."""
+        yielded = 0
+        position = skip
+        while True:
+            take = page_size if limit is None else min(page_size, limit - yielded)
+            with self.observations_stream(search_filter, skip=position, take=take,
+                                          sortBy=sortBy, sort_descending=sort_descending,
+                                          verbose=verbose) as page:
+                for record in page:
+                    yielded += 1
+                    yield record
+            position += page.count
+            total = page.meta.get("totalCount")
+            if page.count < take or (total is not None and position >= total):
+                return
+            if limit is not None and yielded >= limit:
+                return
+
+    def sharded_observations(self, filters: list[SearchFilter],
+                             max_workers: int = DEFAULT_MAX_WORKERS,
+                             page_size: int = API_MAX_TAKE,
+                             sortBy: str = DEFAULT_SORT_BY_ATTRIBUTE_FOR_OBSERVATIONS,
+                             sort_descending: bool = True,
+                             verbose=False):
+        """Returns the observations matching any of the search filters in `filters`, which are
+           typically made with `SearchFilter.split_by_date()` or `SearchFilter.split_by_areas()`.
+           The filters are searched concurrently with at most `max_workers` requests at a time.
+           The results are merged in the order given by `sortBy` and `sort_descending`, and
+           observations found by more than one filter are only returned once. The observations
+           of each filter are counted first, and a filter with more observations than can be
+           paged through is split in two by date until they fit. Raises APIError if a filter
+           that can't be split further has too many observations."""
+        def fetch(f):
+            n = self.count(f, verbose=verbose)
+            if n <= API_MAX_SKIP_TAKE:
+                return [list(self.iter_observations(f, page_size=page_size, sortBy=sortBy,
+                                                    sort_descending=sort_descending,
+                                                    prefetch=False, verbose=verbose))]
+            date = f.filter.get("date") or {}
+            halves = f.split_by_date(2) if date.get("startDate") and date.get("endDate") else []
+            if len(halves) < 2:
+                raise APIError(f"A shard has {n} observations, more than the {API_MAX_SKIP_TAKE} "
+                               "that can be paged through. Use a bulk export (see apbulk).")
+            return [shard for half in halves for shard in fetch(half)]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            shards = [shard for split in executor.map(fetch, filters) for shard in split]
+        return merge_observations(shards, sortBy, sort_descending)
+
     def observations_by_georegion(self, from_date: str, to_date: str,
-                                  region_type: str, region_name: str):
-        """Returns the observations in a named geographical region."""
+                                  region_type: str, region_name: str,
+                                  search_filter: SearchFilter = None,
+                                  page_size: int = API_MAX_TAKE,
+                                  sortBy: str = DEFAULT_SORT_BY_ATTRIBUTE_FOR_OBSERVATIONS,
+                                  sort_descending: bool = True,
+                                  verbose=False):
+        """Returns an iterator over the observations in a named geographical region, like
+           `iter_observations()`. `region_type` is an area type, like "Municipality", and
+           `region_name` the name of an area of that type, like "Stockholm". The other search
+           criteria are taken from `search_filter` if it is given. The name is looked up in the
+           area catalog. Raises ValueError if there is no area with that name."""
+        areas = self.area_catalog.resolve(region_type, region_name, verbose=verbose)
+        if not areas:
+            raise ValueError(f"No area of type {region_type} named {region_name}")
+        f = search_filter.copy() if search_filter is not None else SearchFilter()
+        f.set_date(startDate=from_date,
+                   endDate=to_date,
+                   dateFilterType="OverlappingStartDateAndEndDate",
+                   timeRanges=[])
+        f.set_geographics_areas(areas)
+        return self.iter_observations(f, page_size=page_size, sortBy=sortBy,
+                                      sort_descending=sort_descending, verbose=verbose)
 
-    def observations_by_geopolygon(self, from_date: str, to_date: str, polygon: list):
-        """Returns the observations within a specified geographical polygon."""
+    def observations_by_geopolygon(self, from_date: str, to_date: str, polygon: list,
+                                   search_filter: SearchFilter = None,
+                                   tile_size: float = apgeo.DEFAULT_TILE_SIZE,
+                                   max_workers: int = DEFAULT_MAX_WORKERS,
+                                   page_size: int = API_MAX_TAKE,
+                                   sortBy: str = DEFAULT_SORT_BY_ATTRIBUTE_FOR_OBSERVATIONS,
+                                   sort_descending: bool = True,
+                                   verbose=False):
+        """Returns the observations within a specified geographical polygon. `polygon` is a
+           ring, polygon or multipolygon of WGS 84 [longitude, latitude] points, nested like
+           GeoJSON coordinates (see the module apgeo). The other search criteria are taken from
+           `search_filter` if it is given. The bounding box of the polygon is split into tiles
+           of at most `tile_size` degrees, and the tiles that intersect the polygon are searched
+           concurrently as bounding boxes. Then the observations outside the polygon are
+           removed."""
+        polygons = apgeo.polygons(polygon)
+        f = search_filter.copy() if search_filter is not None else SearchFilter()
+        f.set_date(startDate=from_date,
+                   endDate=to_date,
+                   dateFilterType="OverlappingStartDateAndEndDate",
+                   timeRanges=[])
+        filters = []
+        for west, south, east, north in apgeo.tiles(polygons, tile_size):
+            t = f.copy()
+            t.set_geographics_bounding_box(bottomRight_latitude=south,
+                                           bottomRight_longitude=east,
+                                           topLeft_latitude=north,
+                                           topLeft_longitude=west)
+            filters.append(t)
+        observations = self.sharded_observations(filters, max_workers=max_workers,
+                                                 page_size=page_size, sortBy=sortBy,
+                                                 sort_descending=sort_descending,
+                                                 verbose=verbose)
+        located = [(o, observation_wgs84(o)) for o in observations]
+        located = [(o, x, y) for o, (x, y) in located if x is not None]
+        inside = apgeo.points_in_polygons([x for o, x, y in located], [y for o, x, y in located],
+                                          polygons)
+        return [o for (o, x, y), i in zip(located, inside) if i]
@@ -13,6 +13,9 @@ import requests
 import json
 import pprint
 import os
+from apretry import RequestExecutor
+from apcache import HTTPCache
+from apmetrics import cache_record
 
 # Constants
 API_NAME = 'Artdatabankens Species Observation System API'
@@ -21,6 +24,7 @@ API_ROOT_URL = 'https://api.artdatabanken.se'
 API_ROOT_PATH = '/species-observation-system/v1/'
 API_PING_RESOURCE = 'environment'
 ADB_COORDINATSYSTEM_WGS_84_ID = 10
+DEFAULT_CACHE_TTL = 24 * 3600  # Seconds cached responses are fresh by default
 
 
 def auth_headers(api_key, auth_token=None):
@@ -76,13 +80,18 @@ def observations_search_filter():
 class SOSAPI():
     """Represents the API."""
 
-    def __init__(self, api_key):
-        """Create a new API instance. A valid API-key 'api_key' must be provided."""
+    def __init__(self, api_key, executor=None, cache=None, cache_ttl=DEFAULT_CACHE_TTL):
+        """Create a new API instance. A valid API-key 'api_key' must be provided. Requests are
+        sent by 'executor', an apretry.RequestExecutor, which retries failed requests. Responses
+        with reference data, like areas, are cached in 'cache' (see apcache.open_cache) if it is
+        given."""
         self.api_key = api_key
+        self.executor = executor if executor is not None else RequestExecutor()
+        self.http_cache = HTTPCache(cache, cache_ttl) if cache is not None else None
 
     def ping(self, verbose=False):
         """Call the root resource of the API. Returns a requests response object."""
-        r = requests.get(ping_url(), headers=auth_headers(self.api_key))
+        r = self.executor.request(requests, 'GET', ping_url(), headers=auth_headers(self.api_key))
         if verbose:
             print("%s: %s" % (API_NAME, API_INFO_URL))
             print_http_response(url, r)
@@ -139,10 +148,19 @@ class SOSAPI():
         if search_string:
             url = url + "searchString=%s&" % (search_string)
         url = url + "skip=%d&take=%d" % (index, count)
-        r = requests.get(url, headers=auth_headers(self.api_key))
-        if verbose:
-            print_http_response(url, r)
-        return r
+
+        def send(url, headers):
+            r = self.executor.request(requests, 'GET', url, headers=headers)
+            if verbose:
+                print_http_response(r)
+            return r
+
+        if self.http_cache is not None:
+            r = self.http_cache.get(send, url, auth_headers(self.api_key), verbose)
+            if self.executor.hooks and getattr(r, 'from_cache', False):
+                cache_record('GET', url, r.cache, self.executor.hooks)
+            return r
+        return send(url, auth_headers(self.api_key))
 
     def observations(self, search_filter, index=0, count=10, sort_by=None,
                      sort_order="Desc", lang="sv-SE", sensitive=False, verbose=False):
@@ -161,9 +179,9 @@ class SOSAPI():
             url = url + "sensitiveObservations=false"
         headers = {**auth_headers(self.api_key), **{"Content-Type": "application/json"}}
         print(headers)
-        r = requests.post(url,
-                          data=search_filter,
-                          headers=headers)
+        r = self.executor.request(requests, 'POST', url,
+                                  data=search_filter,
+                                  headers=headers)
         if verbose:
             print_http_response(url, r)
         return r
@@ -177,7 +195,7 @@ class SOSAPI():
             url = url + "sensitiveObservations=true"
         else:
             url = url + "sensitiveObservations=false"
-        r = requests.get(url, headers=auth_headers(self.api_key))
+        r = self.executor.request(requests, 'GET', url, headers=auth_headers(self.api_key))
         if verbose:
             print_http_response(url, r)
         return r
@@ -0,0 +1,64 @@
+"""
+Fixtures of the tests. The API classes are tested against `apbench.MockServer`, a local mock of
+Artdatabankens API:s, so the tests need neither the network nor API keys.
+"""
+
+import pytest
+import artportalen
+from apbench import MockServer
+from apretry import RequestExecutor
+
+# Constants
+TEST_OBSERVATIONS = 2500  # Observations matching every search of the mock server
+TEST_RECORD_SIZE = 300  # Approximate bytes per observation
+
+
+def fast_executor(**kwargs):
+    """Returns a RequestExecutor that retries quickly, for tests."""
+    return RequestExecutor(**({"backoff": 0.01, "max_backoff": 0.2} | kwargs))
+
+
+@pytest.fixture
+def mock_server():
+    """A function that starts a MockServer with the given keyword arguments. The servers are
+       stopped after the test."""
+    servers = []
+
+    def start(**kwargs):
+        kwargs = {"observations": TEST_OBSERVATIONS, "record_size": TEST_RECORD_SIZE} | kwargs
+        server = MockServer(**kwargs).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def server(mock_server):
+    """A MockServer with the default test settings."""
+    return mock_server()
+
+
+@pytest.fixture
+def oapi(server):
+    """An ObservationsAPI using the mock server."""
+    with artportalen.ObservationsAPI("test", root_url=server.url,
+                                     executor=fast_executor()) as api:
+        yield api
+
+
+@pytest.fixture
+def sapi(server):
+    """A SpeciesAPI using the mock server."""
+    with artportalen.SpeciesAPI("test", root_url=server.url, executor=fast_executor()) as api:
+        yield api
+
+
+@pytest.fixture
+def search_filter():
+    """A search filter matching all the synthetic observations of the mock server."""
+    f = artportalen.SearchFilter()
+    f.set_date("2024-05-01", "2024-05-31", "OverlappingStartDateAndEndDate", [])
+    return f
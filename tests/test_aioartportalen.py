@@ -0,0 +1,65 @@
+"""Tests of the module aioartportalen."""
+
+import asyncio
+import aiohttp
+import pytest
+import artportalen
+import aioartportalen
+from apretry import AdaptiveConcurrency
+from tests.conftest import TEST_OBSERVATIONS, fast_executor
+
+
+def test_async_iter_observations_equals_sync(server, oapi, search_filter):
+    async def fetch():
+        async with aioartportalen.AsyncObservationsAPI("test", root_url=server.url) as api:
+            return [o async for o in api.iter_observations(search_filter, page_size=1000)]
+
+    observations = asyncio.run(fetch())
+    assert len(observations) == TEST_OBSERVATIONS
+    assert observations == list(oapi.iter_observations(search_filter))
+
+
+def test_async_sharded_observations(server, search_filter):
+    async def fetch():
+        async with aioartportalen.AsyncObservationsAPI("test", root_url=server.url,
+                                                       max_concurrency=2) as api:
+            return await api.sharded_observations(search_filter.split_by_date(3))
+
+    observations = asyncio.run(fetch())
+    assert len({artportalen.observation_id(o) for o in observations}) == TEST_OBSERVATIONS
+
+
+def test_async_timeouts_are_retried(mock_server, search_filter):
+    server = mock_server(latency=0.3)
+    records = []
+
+    async def search():
+        timeout = aiohttp.ClientTimeout(total=0.1)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            api = aioartportalen.AsyncObservationsAPI(
+                "test", session=session, root_url=server.url,
+                executor=fast_executor(max_retries=2, hooks=[records.append]))
+            return await api.observations(search_filter, take=1)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(search())
+    assert [(r.attempts, r.error) for r in records] == [(3, "TimeoutError")]
+
+
+@pytest.mark.parametrize("retry_after", [0.05, None])
+def test_async_throttling_decreases_adaptive_concurrency(mock_server, search_filter,
+                                                         retry_after):
+    server = mock_server(retry_after=retry_after)
+    adaptive = AdaptiveConcurrency(initial=8)
+
+    async def search():
+        async with aioartportalen.AsyncObservationsAPI(
+                "test", root_url=server.url,
+                executor=fast_executor(adaptive=adaptive)) as api:
+            return await api.observations(search_filter, take=10)
+
+    server.fail(429, times=1)
+    page = asyncio.run(search())
+    assert len(page["records"]) == 10
+    assert adaptive.limit == 4
+    assert adaptive.active == 0
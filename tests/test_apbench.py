@@ -0,0 +1,36 @@
+"""Tests of the module apbench."""
+
+import io
+import json
+import tempfile
+import zipfile
+import requests
+import apbench
+from apbench import OBSERVATIONS_PATH
+
+
+def test_scenarios_count_only_their_own_traffic(server, monkeypatch, tmp_path):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    results = apbench.run(["warm_cache", "single_page"], server, {"repeat": 3}, isolate=False)
+    results = {r["scenario"]: r for r in results}
+    assert results["warm_cache"]["requests"] == 0
+    assert results["warm_cache"]["bytes"] == 0
+    assert results["single_page"]["requests"] == 3
+    assert results["single_page"]["bytes"] > 0
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_export_job_routes(mock_server):
+    server = mock_server(observations=30, export_polls=2)
+    api = server.url + OBSERVATIONS_PATH
+    body = json.dumps({"date": {"startDate": "2024-05-01", "endDate": "2024-05-02"}})
+    job_id = requests.post(api + "Exports/Order/GeoJson", data=body).json()
+    statuses = [requests.get(api + f"Jobs/{job_id}/Status").json()["status"] for i in range(3)]
+    assert statuses == ["Processing", "Processing", "Succeeded"]
+    r = requests.get(api + f"Exports/Download/{job_id}")
+    with zipfile.ZipFile(io.BytesIO(r.content)) as archive:
+        features = json.loads(archive.read("export.geojson"))["features"]
+    assert len(features) == 4
+    assert features[0]["properties"]["event.startDate"].startswith("2024-05-0")
+    assert requests.get(api + "Jobs/job-99/Status").status_code == 404
+    assert server.log[0][:2] == ("POST", "/species-observation-system/v1/Exports/Order/GeoJson")
@@ -0,0 +1,55 @@
+"""Tests of the module apbulk."""
+
+import pytest
+import artportalen
+from apbulk import BulkExport
+from apkeys import KeyPool
+from apstore import ObservationStore
+from apretry import API_KEY_HEADER
+from artportalen import APIError, observation_id
+from tests.conftest import fast_executor
+
+
+def bulk_export(server, key_pool=None, **kwargs):
+    api = artportalen.ObservationsAPI("test", root_url=server.url, key_pool=key_pool,
+                                      executor=fast_executor(max_retries=0))
+    return BulkExport(api, auth_token="secret", poll_interval=0.01, **kwargs)
+
+
+def test_export_is_ordered_polled_downloaded_and_parsed(mock_server, oapi, search_filter,
+                                                        tmp_path):
+    server = mock_server(export_polls=3)
+    bulk = bulk_export(server)
+    exported = sorted(bulk.observations(search_filter), key=observation_id)
+    assert exported == sorted(oapi.iter_observations(search_filter), key=observation_id)
+    paths = [path for method, path, headers in server.log]
+    assert sum(1 for p in paths if p.endswith("/Status")) == 4
+    with ObservationStore(str(tmp_path / "s.db")) as store:
+        assert bulk.to_store(search_filter, store, batch_size=700) == len(exported)
+        assert len(store) == len(exported)
+
+
+@pytest.mark.parametrize("key_pool", [None, KeyPool(["pooled"])])
+def test_credentials_are_only_sent_to_the_api_host(mock_server, search_filter, tmp_path,
+                                                   key_pool):
+    server = mock_server(download_host="localhost")
+    bulk = bulk_export(server, key_pool)
+    bulk.run(search_filter, str(tmp_path / "export.zip"))
+    for method, path, headers in server.log:
+        on_api_host = not path.startswith("/_files/")
+        assert (API_KEY_HEADER in headers) == on_api_host
+        assert ("Authorization" in headers) == on_api_host
+    assert server.log[-1][1].startswith("/_files/")
+
+
+def test_failed_export_job_raises(mock_server, search_filter, tmp_path):
+    server = mock_server(export_status="Failed")
+    with pytest.raises(APIError, match="failed"):
+        bulk_export(server).run(search_filter, str(tmp_path / "export.zip"))
+    assert not (tmp_path / "export.zip").exists()
+
+
+def test_export_job_timeout_raises(mock_server, search_filter, tmp_path):
+    server = mock_server(export_polls=1000)
+    with pytest.raises(APIError, match="didn't finish"):
+        bulk_export(server, timeout=0.1).run(search_filter, str(tmp_path / "export.zip"))
@@ -0,0 +1,50 @@
+"""Tests of the module apcache."""
+
+import time
+import artportalen
+from apcache import CacheEntry, LRUCache, SQLiteCache, TieredCache, open_cache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    for key in "abc":
+        cache.set(key, CacheEntry(key, time.time() + 60))
+        cache.get("a")
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+
+
+def test_sqlite_cache_persists_and_evicts(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = SQLiteCache(path, max_bytes=100)
+    cache.set("old", CacheEntry("x" * 60, time.time() + 60, etag='"1"'))
+    cache.set("new", CacheEntry("y" * 60, time.time() + 60))
+    cache.close()
+    cache = SQLiteCache(path, max_bytes=100)
+    assert cache.get("old") is None
+    assert cache.get("new").value == "y" * 60
+    assert cache.size() <= 100
+
+
+def test_tiered_cache_copies_to_memory(tmp_path):
+    store = SQLiteCache(str(tmp_path / "c.sqlite"))
+    store.set("k", CacheEntry([1], time.time() + 60))
+    cache = TieredCache(store=store)
+    assert cache.get("k").value == [1]
+    assert cache.memory.get("k").value == [1]
+
+
+def test_http_cache_serves_and_revalidates(mock_server, tmp_path):
+    server = mock_server()
+    api = artportalen.ObservationsAPI("test", root_url=server.url,
+                                      cache=open_cache("http", str(tmp_path)))
+    assert api.version() == api.version()
+    assert server.stats["requests"] == 1
+    assert api.http_cache.stats.hits == 1
+    # Expire the entry, so it is revalidated with its ETag.
+    key = api.http_cache.key(api.url + "api/ApiInfo", api.headers)
+    entry = api.http_cache.cache.get(key)
+    entry.expires = 0
+    api.http_cache.cache.set(key, entry)
+    assert api.version() == {"apiName": "Mock"}
+    assert server.stats["requests"] == 2
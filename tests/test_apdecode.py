@@ -0,0 +1,31 @@
+"""Tests of the module apdecode."""
+
+import pytest
+from apbench import synthetic_observation
+from apdecode import decode_observations, parse_date
+from artportalen import parse_iso_datetime
+
+
+@pytest.mark.parametrize("date, expected", [
+    ("2024-05-01T06:00:00+02:00", (1714536000, 7200)),
+    ("2024-05-01T04:00:00Z", (1714536000, 0)),
+    ("2024-05-01T04:00:00z", (1714536000, 0)),
+    ("2024-05-01T06:00:00.1234567+02:00", (1714536000, 7200)),
+    ("2024-05-01T04:00:00.1234567Z", (1714536000, 0)),
+    ("2024-05-01T04:00:00.12Z", (1714536000, 0)),
+    ("2024-05-01T04:00:00", (1714536000, 0)),
+    ("2024-05-01", (1714521600, 0))])
+def test_parse_date_accepts_api_timestamps(date, expected):
+    assert parse_date(date) == expected
+
+
+def test_fractions_are_truncated_to_microseconds():
+    assert parse_iso_datetime("2024-05-01T04:00:00.1234567Z").microsecond == 123456
+    assert parse_iso_datetime("2024-05-01T04:00:00.5Z").microsecond == 500000
+
+
+def test_decode_utc_dates_with_long_fractions():
+    o = synthetic_observation(0, 0)
+    o["event"]["startDate"] = "2024-05-01T04:00:00.1234567Z"
+    batch = decode_observations([o])
+    assert batch[0].start_date.isoformat() == "2024-05-01T04:00:00+00:00"
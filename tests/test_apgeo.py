@@ -0,0 +1,31 @@
+"""Tests of the module apgeo."""
+
+import apgeo
+from artportalen import observation_wgs84
+
+TRIANGLE = [[12.0, 56.0], [22.0, 58.0], [15.0, 68.0]]
+
+
+def test_tiles_cover_polygon():
+    polygons = apgeo.polygons(TRIANGLE)
+    tiles = apgeo.tiles(polygons, 1.0)
+    assert all(apgeo.box_intersects_polygons(t, polygons) for t in tiles)
+    # A tile in the far corner of the bounding box is left out.
+    assert not any(t[0] >= 21.0 and t[1] >= 66.0 for t in tiles)
+
+
+def test_points_in_polygons_with_hole():
+    square = [[0, 0], [10, 0], [10, 10], [0, 10]]
+    hole = [[4, 4], [6, 4], [6, 6], [4, 6]]
+    assert apgeo.points_in_polygons([1, 5, 11], [1, 5, 5], [[square, hole]]) == [True, False,
+                                                                                 False]
+
+
+def test_observations_by_geopolygon(oapi, search_filter):
+    found = oapi.observations_by_geopolygon("2024-05-01", "2024-05-31", TRIANGLE,
+                                            tile_size=2.0)
+    everything = list(oapi.iter_observations(search_filter))
+    xs, ys = zip(*(observation_wgs84(o) for o in everything))
+    inside = apgeo.points_in_polygons(list(xs), list(ys), apgeo.polygons(TRIANGLE))
+    assert (sorted(o["occurrence"]["occurrenceId"] for o in found)
+            == sorted(o["occurrence"]["occurrenceId"] for o, i in zip(everything, inside) if i))
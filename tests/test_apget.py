@@ -0,0 +1,72 @@
+"""Tests of the module apget."""
+
+import sys
+import pytest
+import apget
+import artportalen
+from apbench import synthetic_observation
+from apdecode import numeric_columns
+from apkeys import APIKey, KeyPool
+from apexport import read_columns
+from artportalen import PROJECTIONS
+
+
+def test_pretty_print_observations_without_dates_or_coordinates(capsys):
+    complete = synthetic_observation(1, 0)
+    incomplete = synthetic_observation(2, 0)
+    del incomplete["event"]
+    del incomplete["location"]
+    apget.pretty_print_observations([complete, incomplete])
+    output = capsys.readouterr().out
+    assert output.count("Google Maps location:") == 1
+    assert output.startswith(complete["event"]["startDate"][:10])
+    assert "\n<attributet saknas>\n" in output
+    assert " Plats: <attributet saknas>" in output
+
+
+def run_apget(monkeypatch, server, *args):
+    """Run apget with the arguments `args` against `server`, and return the exit code."""
+    monkeypatch.setenv(apget.ADB_SPECIES_API_KEY_ENV_NAME, "test")
+    monkeypatch.setenv(apget.ADB_OBSERVATIONS_API_KEY_ENV_NAME, "test")
+    monkeypatch.delenv(apget.ADB_OBSERVATIONS_API_KEYS_ENV_NAME, raising=False)
+    monkeypatch.setenv(apget.ADB_API_ROOT_URL_ENV_NAME, server.url)
+    monkeypatch.setattr(sys, "argv", ["apget.py", "--no-cache", "-g", "--from-date",
+                                      "2024-05-01", "--to-date", "2024-05-31"] + list(args))
+    with pytest.raises(SystemExit) as e:
+        apget.main()
+    return e.value.code
+
+
+@pytest.mark.parametrize("projection", sorted(artportalen.PROJECTIONS))
+def test_every_projection_pretty_prints(monkeypatch, capsys, server, projection):
+    assert run_apget(monkeypatch, server, "--pretty-print", "--projection", projection) == 0
+    output = capsys.readouterr().out
+    assert output.count(" Rapportör: ") == 200
+    assert ("Warning" in output) == bool(PROJECTIONS[projection].missing(
+        apget.PRETTY_PRINT_ATTRIBUTES))
+
+
+@pytest.mark.parametrize("projection", sorted(artportalen.PROJECTIONS))
+def test_every_projection_exports(monkeypatch, capsys, server, tmp_path, projection):
+    path = str(tmp_path / "observations.npz")
+    assert run_apget(monkeypatch, server, "--export", path, "--projection", projection) == 0
+    columns = read_columns(path)
+    assert len(columns["id"]) == 200
+    assert set(columns) == ({"id"} | set(numeric_columns(PROJECTIONS[projection]))
+                            | set(PROJECTIONS[projection].strings))
+    if "taxon_id" in columns:
+        assert all(t > 0 for t in columns["taxon_id"])
+
+
+def test_streamed_export_equals_paged_export(monkeypatch, capsys, server, tmp_path):
+    paged, streamed = str(tmp_path / "paged.npz"), str(tmp_path / "streamed.npz")
+    assert run_apget(monkeypatch, server, "--export", paged) == 0
+    assert run_apget(monkeypatch, server, "--export", streamed, "--stream") == 0
+    assert list(read_columns(streamed)["id"]) == list(read_columns(paged)["id"])
+
+
+def test_exhausted_key_pool_exits_with_an_error(monkeypatch, capsys, server):
+    monkeypatch.setattr(apget, "observations_key_pool",
+                        lambda: KeyPool([APIKey("used", quota=0)]))
+    assert run_apget(monkeypatch, server) == 9
+    assert "Error: The quotas of all 1 API keys are used" in capsys.readouterr().out
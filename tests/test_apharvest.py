@@ -0,0 +1,67 @@
+"""Tests of the module apharvest."""
+
+import pytest
+import artportalen
+from apharvest import HarvestJob
+from apstore import ObservationStore
+from artportalen import APIError, observation_id
+from tests.conftest import TEST_OBSERVATIONS, fast_executor
+
+
+class RecordingStore(ObservationStore):
+    """An ObservationStore that records the ids of the observations it stores."""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.stored = []
+
+    def upsert(self, observations):
+        self.stored.extend(observation_id(o) for o in observations)
+        return super().upsert(observations)
+
+
+@pytest.fixture
+def api(server):
+    with artportalen.ObservationsAPI("test", root_url=server.url,
+                                     executor=fast_executor(max_retries=0)) as api:
+        yield api
+
+
+@pytest.mark.parametrize("shards", [1, 3])
+def test_killed_harvest_resumes_with_the_remaining_records(api, server, search_filter,
+                                                           tmp_path, shards):
+    state = str(tmp_path / "state.json")
+    with RecordingStore(str(tmp_path / "s.db")) as store:
+        server.fail(500, after=4)
+        with pytest.raises(APIError):
+            HarvestJob(api, store, state).run(search_filter, shards=shards, max_workers=1,
+                                              page_size=200)
+        server.recover()
+        first = store.stored
+        assert 0 < len(first) < TEST_OBSERVATIONS
+        store.stored = []
+        job = HarvestJob(api, store, state)
+        job.run(search_filter, shards=shards, max_workers=1, page_size=200)
+        assert set(first).isdisjoint(store.stored)
+        assert len(first) + len(store.stored) == len(store) == TEST_OBSERVATIONS
+        assert job.progress()["done"] == job.progress()["shards"] == shards
+
+
+@pytest.mark.parametrize("shape", ["no total", "list"])
+def test_harvest_pages_without_total_count_to_the_end(api, search_filter, tmp_path,
+                                                      monkeypatch, shape):
+    observations = api.observations
+
+    def reshaped(*args, **kwargs):
+        result = observations(*args, **kwargs)
+        if shape == "list":
+            return result["records"]
+        result.pop("totalCount", None)
+        return result
+
+    monkeypatch.setattr(api, "observations", reshaped)
+    with ObservationStore(str(tmp_path / "s.db")) as store:
+        job = HarvestJob(api, store, str(tmp_path / "state.json"))
+        job.run(search_filter, page_size=1000)
+        assert len(store) == TEST_OBSERVATIONS
+        assert job.progress()["pages"] == 3
@@ -0,0 +1,50 @@
+"""Tests of the module apkeys."""
+
+import pytest
+import artportalen
+from apkeys import APIKey, KeyPool, QuotaExhausted, parse_keys
+from tests.conftest import fast_executor
+
+
+def test_parse_keys():
+    keys = parse_keys("k1:5:100, k2::50,k3")
+    assert [(k.key, k.quota) for k in keys] == [("k1", 100), ("k2", 50), ("k3", None)]
+    assert keys[0].bucket.rate == 5
+    with pytest.raises(ValueError):
+        parse_keys("k:x")
+
+
+def test_quotas_are_enforced():
+    pool = KeyPool([APIKey("a", quota=2), APIKey("b", quota=1)])
+    assert sorted(pool.acquire().key for i in range(3)) == ["a", "a", "b"]
+    with pytest.raises(QuotaExhausted):
+        pool.acquire()
+
+
+def test_throttled_key_is_backed_off(mock_server, search_filter):
+    server = mock_server(throttle=1000)
+    pool = KeyPool(["a", "b"])
+    api = artportalen.ObservationsAPI("a", root_url=server.url, key_pool=pool)
+    server.fail(429, times=1)
+    assert api.observations(search_filter, take=1) is not None
+    usage = {u["name"][0]: u for u in pool.usage()}
+    assert usage["a"]["throttled"] + usage["b"]["throttled"] == 1
+    assert usage["a"]["requests"] + usage["b"]["requests"] == 2
+
+
+def test_next_key_is_tried_after_a_backoff(mock_server, search_filter, monkeypatch):
+    server = mock_server()
+    executor = fast_executor()
+    delays = []
+    retry_delay = executor.retry_delay
+
+    def recorded(attempt, response=None):
+        delays.append((attempt, response))
+        return retry_delay(attempt, response)
+
+    monkeypatch.setattr(executor, "retry_delay", recorded)
+    api = artportalen.ObservationsAPI("a", root_url=server.url, executor=executor,
+                                      key_pool=KeyPool(["a", "b"]))
+    server.fail(429, times=1)
+    assert api.observations(search_filter, take=1) is not None
+    assert delays == [(0, None)]
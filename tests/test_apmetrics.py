@@ -0,0 +1,51 @@
+"""Tests of the module apmetrics."""
+
+import threading
+import pytest
+import artportalen
+from apbulk import BulkExport
+from apmetrics import PrometheusMetrics, ResponseInfo
+from apretry import RequestExecutor
+from artportalen import APIError
+from tests.conftest import fast_executor
+
+
+def test_prometheus_metrics_of_requests(server, search_filter):
+    metrics = PrometheusMetrics()
+    api = artportalen.ObservationsAPI("test", root_url=server.url,
+                                      executor=RequestExecutor(hooks=[metrics]))
+    api.observations(search_filter, take=10)
+    api.count(search_filter)
+    text = metrics.render()
+    endpoint = "/species-observation-system/v1/Observations/Search"
+    assert f'adb_requests_total{{endpoint="{endpoint}",status="200"}} 1' in text
+    assert f'adb_parse_seconds_count{{endpoint="{endpoint}"}} 1' in text
+
+
+def test_response_tracker_is_per_thread(oapi, search_filter):
+    oapi.observations(search_filter, take=1)
+    seen = []
+    thread = threading.Thread(target=lambda: seen.append(oapi.last_response()))
+    thread.start()
+    thread.join()
+    assert seen == [None]
+    assert oapi.last_response().status_code == 200
+    assert oapi.last_response().request_id is None
+
+
+@pytest.mark.parametrize("path, after", [
+    ("count", 0), ("stream", 0), ("order", 0), ("status", 1), ("download", 3)])
+def test_api_errors_keep_response_metadata_only(server, search_filter, tmp_path, path, after):
+    api = artportalen.ObservationsAPI("test", root_url=server.url,
+                                      executor=fast_executor(max_retries=0))
+    bulk = BulkExport(api, poll_interval=0.01)
+    calls = {"count": lambda: api.count(search_filter),
+             "stream": lambda: list(api.observations_stream(search_filter)),
+             "order": lambda: bulk.order(search_filter),
+             "status": lambda: bulk.wait(bulk.order(search_filter)),
+             "download": lambda: bulk.run(search_filter, str(tmp_path / "export.zip"))}
+    server.fail(500, after=after)
+    with pytest.raises(APIError) as e:
+        calls[path]()
+    assert isinstance(e.value.response, ResponseInfo)
+    assert e.value.response.status_code == 500
@@ -0,0 +1,78 @@
+"""Tests of the module applan."""
+
+import math
+import time
+from itertools import combinations
+import pytest
+import applan
+from artportalen import APIError, observation_id
+from tests.conftest import TEST_OBSERVATIONS
+
+
+def ids(observations):
+    return [observation_id(o) for o in observations]
+
+
+def test_small_search_is_paged(oapi, search_filter):
+    plan = applan.SearchPlanner(oapi).plan(search_filter, limit=100)
+    assert plan.strategy == applan.PAGING
+    assert len(list(applan.SearchPlanner(oapi).execute(plan))) == 100
+
+
+def test_sharded_plan_matches_paging(oapi, search_filter):
+    planner = applan.SearchPlanner(oapi, paging_max=500, shard_size=400)
+    plan = planner.plan(search_filter, page_size=200)
+    assert plan.strategy == applan.SHARDED
+    assert len(plan.shards) > 1
+    assert max(plan.shard_counts) <= 400
+    assert sum(plan.shard_counts) == TEST_OBSERVATIONS
+    sharded = ids(planner.execute(plan, sort_descending=False))
+    paged = ids(oapi.iter_observations(search_filter, sort_descending=False))
+    assert sharded == paged
+
+
+def test_sharded_plan_is_fetched_lazily(oapi, server, search_filter):
+    planner = applan.SearchPlanner(oapi, paging_max=500, shard_size=400)
+    plan = planner.plan(search_filter, page_size=100)
+    requests = server.stats["requests"]
+    observations = planner.execute(plan)
+    next(observations)
+    time.sleep(0.5)
+    # Only the first shard and the prefetched ones are fetched, with at most a page too many.
+    shards = planner.prefetch_shards + 1
+    ahead = sum(math.ceil(n / 100) + 1 for n in plan.shard_counts[-shards:])
+    assert server.stats["requests"] - requests <= ahead < plan.requests
+
+
+def test_shards_are_fetched_concurrently(oapi, server, search_filter, monkeypatch):
+    planner = applan.SearchPlanner(oapi, paging_max=500, shard_size=400)
+    plan = planner.plan(search_filter, page_size=200)
+    server.latency = 0.02
+    spans = []
+    fetch = planner.shard_observations
+
+    def timed(*args, **kwargs):
+        start = time.monotonic()
+        observations = fetch(*args, **kwargs)
+        spans.append((start, time.monotonic()))
+        return observations
+
+    monkeypatch.setattr(planner, "shard_observations", timed)
+    assert len(list(planner.execute(plan))) == TEST_OBSERVATIONS
+    assert len(spans) == len(plan.shards)
+    assert any(a[0] < b[1] and b[0] < a[1] for a, b in combinations(spans, 2))
+
+
+def test_unsplittable_search_is_exported(oapi, search_filter, monkeypatch):
+    monkeypatch.setattr(applan, "API_MAX_SKIP_TAKE", 50)
+    plan = applan.SearchPlanner(oapi, paging_max=40, shard_size=40).plan(search_filter)
+    assert plan.strategy == applan.BULK
+
+
+def test_too_big_shard_raises(oapi, search_filter):
+    shards = search_filter.split_by_date(2)
+    plan = applan.SearchPlan(search_filter, applan.SHARDED, TEST_OBSERVATIONS,
+                             TEST_OBSERVATIONS, 10, 1.0, shards,
+                             shard_counts=[applan.API_MAX_SKIP_TAKE + 1, 0])
+    with pytest.raises(APIError):
+        list(applan.SearchPlanner(oapi).execute(plan, sort_descending=False))
@@ -0,0 +1,43 @@
+"""Tests of the module apretry."""
+
+import time
+import pytest
+import artportalen
+from artportalen import APIError
+from apretry import AdaptiveConcurrency, RequestExecutor, TokenBucket
+
+
+def test_token_bucket_pause_and_rate():
+    bucket = TokenBucket(100, burst=1)
+    assert bucket.reserve() == 0
+    bucket.pause(0.5)
+    assert bucket.available() <= 0
+    assert bucket.reserve() == pytest.approx(0.51, abs=0.005)
+    assert bucket.reserve() == pytest.approx(0.52, abs=0.005)
+    bucket.set_rate(10)
+    assert bucket.reserve() == pytest.approx(0.8, abs=0.005)
+
+
+def test_retry_after_pauses_all_requests_with_the_key(mock_server, search_filter):
+    server = mock_server(retry_after=0.3)
+    executor = RequestExecutor(max_retries=0)
+    throttled = artportalen.ObservationsAPI("test", root_url=server.url, executor=executor)
+    other = artportalen.ObservationsAPI("test", root_url=server.url, executor=executor)
+    server.fail(429, times=1)
+    with pytest.raises(APIError):
+        throttled.count(search_filter)
+    assert 0.2 < executor.paused("test") <= 0.3
+    start = time.monotonic()
+    assert other.count(search_filter) == server.observations
+    assert time.monotonic() - start > 0.2
+
+
+@pytest.mark.parametrize("rate", [None, 10])
+def test_throttled_sharded_observations(mock_server, search_filter, rate):
+    server = mock_server(observations=1200, throttle=5)
+    executor = RequestExecutor(rate=rate, adaptive=AdaptiveConcurrency())
+    api = artportalen.ObservationsAPI("test", root_url=server.url, executor=executor)
+    observations = api.sharded_observations(search_filter.split_by_date(6), page_size=100,
+                                            max_workers=4)
+    assert len(observations) == 1200
+    assert executor.bucket("test").rate < 10
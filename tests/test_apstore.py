@@ -0,0 +1,32 @@
+"""Tests of the module apstore."""
+
+from apbench import synthetic_observation
+from apstore import ObservationStore, distance
+
+
+def test_upsert_is_idempotent(tmp_path):
+    with ObservationStore(str(tmp_path / "s.db")) as store:
+        observations = [synthetic_observation(i, 0) for i in range(50)]
+        store.upsert(observations)
+        store.upsert(observations[:10])
+        assert len(store) == 50
+        assert store.get("urn:lsid:bench:sighting:3") == observations[3]
+
+
+def test_spatial_queries_match_brute_force(tmp_path):
+    observations = [synthetic_observation(i, 0) for i in range(500)]
+    points = {o["occurrence"]["occurrenceId"]: (o["location"]["decimalLongitude"],
+                                                o["location"]["decimalLatitude"])
+              for o in observations}
+    with ObservationStore(str(tmp_path / "s.db")) as store:
+        store.upsert(observations)
+        box = (14.0, 58.0, 18.0, 62.0)
+        in_box = {o["occurrence"]["occurrenceId"] for o in store.in_box(*box)}
+        assert in_box == {i for i, (x, y) in points.items()
+                          if box[0] <= x <= box[2] and box[1] <= y <= box[3]}
+        within = store.within_radius(16.0, 60.0, 100000)
+        expected = sorted((distance(16.0, 60.0, x, y), i) for i, (x, y) in points.items())
+        assert ([o["occurrence"]["occurrenceId"] for o in within]
+                == [i for d, i in expected if d <= 100000])
+        nearest = store.nearest(16.0, 60.0, k=5)
+        assert [o["occurrence"]["occurrenceId"] for o in nearest] == [i for d, i in expected[:5]]
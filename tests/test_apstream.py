@@ -0,0 +1,27 @@
+"""Tests of the module apstream."""
+
+import json
+import pytest
+from apstream import JSONArrayStream
+
+
+def chunked(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 3, 64, 100000])
+def test_stream_equals_json_loads(size):
+    page = {"skip": 0, "totalCount": 3,
+            "records": [{"a": "åäö", "n": 12345.5e3}, [1, 2, {"b": None}], "x"],
+            "take": 10}
+    stream = JSONArrayStream(chunked(json.dumps(page, ensure_ascii=False).encode(), size))
+    assert list(stream) == page["records"]
+    assert stream.meta == {"skip": 0, "totalCount": 3, "take": 10}
+    assert stream.count == 3
+
+
+def test_stream_errors():
+    with pytest.raises(ValueError):
+        list(JSONArrayStream([b'{"records": [1, 2']))
+    with pytest.raises(ValueError):
+        list(JSONArrayStream([b'{"other": []}']))
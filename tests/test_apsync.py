@@ -0,0 +1,39 @@
+"""Tests of the module apsync."""
+
+import artportalen
+from apcache import TieredCache
+from apstore import ObservationStore
+from apsync import ObservationSync
+from tests.conftest import TEST_OBSERVATIONS, fast_executor
+
+
+def test_sync_only_fetches_modified_observations(oapi, server, search_filter, tmp_path):
+    with ObservationStore(str(tmp_path / "s.db")) as store:
+        sync = ObservationSync(oapi, store, str(tmp_path / "state.json"))
+        assert sync.sync(search_filter) == TEST_OBSERVATIONS
+        modified, ids = sync.watermark(search_filter)
+        assert modified == "2024-06-28T12:00:00Z"
+        # Only the observations modified at the watermark are fetched again, and skipped.
+        requests = server.stats["requests"]
+        resumed = ObservationSync(oapi, store, str(tmp_path / "state.json"))
+        assert resumed.sync(search_filter) == 0
+        assert server.stats["requests"] == requests + 1
+        assert len(store) == TEST_OBSERVATIONS
+
+
+def test_sync_with_search_cache_sees_new_modifications(server, search_filter, tmp_path):
+    api = artportalen.ObservationsAPI("test", root_url=server.url, executor=fast_executor(),
+                                      search_cache=TieredCache())
+    with ObservationStore(str(tmp_path / "s.db")) as store:
+        sync = ObservationSync(api, store, str(tmp_path / "state.json"))
+        assert sync.sync(search_filter) == TEST_OBSERVATIONS
+        assert sync.sync(search_filter) == 0
+        server.modify(7, "2024-07-01T12:00:00Z")
+        assert sync.sync(search_filter) == 1
+        assert sync.watermark(search_filter)[0] == "2024-07-01T12:00:00Z"
+
+
+def test_modified_date_criteria_keep_the_date_window_open(search_filter):
+    assert search_filter.date_window_closed()
+    search_filter.set_modified_date(from_date="2024-06-01T00:00:00Z")
+    assert not search_filter.date_window_closed()
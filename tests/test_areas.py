@@ -0,0 +1,55 @@
+"""Tests of the AreaCatalog of the module artportalen."""
+
+import pytest
+import artportalen
+from apcache import open_cache
+from artportalen import API_MAX_TAKE, AreaCatalog
+
+
+class PagedAreas:
+    """A stand-in for the areas resource of the ObservationsAPI, that answers with pages of
+       `count` areas as bare lists, or as dictionaries with or without "totalCount"."""
+
+    def __init__(self, count: int, shape: str):
+        self.all = [{"featureId": str(i), "name": f"Område {i}"} for i in range(count)]
+        self.shape = shape
+        self.requests = 0
+
+    def areas(self, area_type, skip=0, take=API_MAX_TAKE, verbose=False, cached=True):
+        assert not cached
+        self.requests += 1
+        records = self.all[skip:skip + take]
+        if self.shape == "list":
+            return records
+        if self.shape == "records":
+            return {"records": records}
+        return {"records": records, "totalCount": len(self.all)}
+
+    def last_response(self):
+        return None
+
+
+@pytest.mark.parametrize("shape", ["list", "records", "total"])
+@pytest.mark.parametrize("count", [0, 10, API_MAX_TAKE, 2 * API_MAX_TAKE + 5])
+def test_catalog_pages_through_all_shapes(shape, count):
+    api = PagedAreas(count, shape)
+    catalog = AreaCatalog(api)
+    areas = catalog.areas("Municipality")
+    assert [a["featureId"] for a in areas] == [a["featureId"] for a in api.all]
+    # Only a page with "totalCount" tells that a full last page is the last one.
+    full_last_page = shape == "total" and count and count % API_MAX_TAKE == 0
+    assert api.requests == count // API_MAX_TAKE + (0 if full_last_page else 1)
+    requests = api.requests
+    assert catalog.areas("Municipality") == areas
+    assert api.requests == requests
+    if count > 3:
+        assert catalog.resolve("Municipality", "område 3") == [{"areaType": "Municipality",
+                                                                "featureId": "3"}]
+
+
+def test_catalog_pages_are_not_cached_twice(server, tmp_path):
+    api = artportalen.ObservationsAPI("test", root_url=server.url,
+                                      cache=open_cache("http", str(tmp_path)))
+    assert api.area_catalog.areas("County") == []
+    url = api.url + f"Areas?areaTypes=County&skip=0&take={API_MAX_TAKE}"
+    assert api.http_cache.lookup(url, api.headers) is None
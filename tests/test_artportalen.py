@@ -0,0 +1,115 @@
+"""Tests of the module artportalen."""
+
+import pytest
+import artportalen
+from artportalen import APIError, SearchFilter, field_value, observation_id
+from tests.conftest import TEST_OBSERVATIONS, fast_executor
+
+
+def ids(observations):
+    return [observation_id(o) for o in observations]
+
+
+def test_iter_observations_pages_through_all(oapi, server, search_filter):
+    observations = list(oapi.iter_observations(search_filter, page_size=1000))
+    assert len(observations) == TEST_OBSERVATIONS
+    assert len(set(ids(observations))) == TEST_OBSERVATIONS
+    assert server.stats["requests"] == 3
+
+
+@pytest.mark.parametrize("prefetch", [True, False])
+def test_iter_observations_skip_and_limit(oapi, search_filter, prefetch):
+    everything = ids(oapi.iter_observations(search_filter, page_size=100))
+    some = ids(oapi.iter_observations(search_filter, page_size=100, skip=150, limit=230,
+                                      prefetch=prefetch))
+    assert some == everything[150:380]
+
+
+def test_iter_observations_streamed_equals_paged(oapi, search_filter):
+    paged = ids(oapi.iter_observations(search_filter, page_size=700))
+    streamed = ids(oapi.iter_observations(search_filter, page_size=700, stream=True))
+    assert streamed == paged
+
+
+def test_iter_observations_sorted(oapi, search_filter):
+    dates = [field_value(o, "event.startDate")
+             for o in oapi.iter_observations(search_filter, sort_descending=False)]
+    assert dates == sorted(dates)
+
+
+def test_iter_observations_raises_on_failed_page(mock_server, search_filter):
+    server = mock_server()
+    api = artportalen.ObservationsAPI("test", root_url=server.url,
+                                      executor=fast_executor(max_retries=0))
+    server.fail(500, after=1)
+    with pytest.raises(APIError) as e:
+        list(api.iter_observations(search_filter, page_size=1000, prefetch=False))
+    assert e.value.response.status_code == 500
+    assert api.last_response().status_code == 500
+
+
+def test_retries_recover_from_failures(oapi, server, search_filter):
+    server.fail(503, times=2)
+    page = oapi.observations(search_filter, take=10)
+    assert len(page["records"]) == 10
+
+
+def test_sharded_observations_match_unsharded(oapi, search_filter):
+    shards = search_filter.split_by_date(4)
+    assert len(shards) == 4
+    sharded = oapi.sharded_observations(shards, page_size=500)
+    assert ids(sharded) == ids(oapi.iter_observations(search_filter))
+
+
+def test_too_big_shards_are_split_by_date(oapi, search_filter, monkeypatch):
+    monkeypatch.setattr(artportalen, "API_MAX_SKIP_TAKE", 500)
+    sharded = oapi.sharded_observations(search_filter.split_by_date(2), page_size=500)
+    assert ids(sharded) == ids(oapi.iter_observations(search_filter))
+
+
+def test_too_big_shard_of_one_day_raises(oapi, monkeypatch):
+    monkeypatch.setattr(artportalen, "API_MAX_SKIP_TAKE", 50)
+    f = SearchFilter()
+    f.set_date("2024-05-03", "2024-05-03", "OverlappingStartDateAndEndDate", [])
+    with pytest.raises(APIError):
+        oapi.sharded_observations([f])
+
+
+def test_split_by_date_covers_range():
+    f = SearchFilter()
+    f.set_date("2024-01-01", "2024-01-10", "OverlappingStartDateAndEndDate", [])
+    dates = [(s.filter["date"]["startDate"], s.filter["date"]["endDate"])
+             for s in f.split_by_date(3)]
+    assert dates == [("2024-01-01", "2024-01-03"), ("2024-01-04", "2024-01-06"),
+                     ("2024-01-07", "2024-01-10")]
+
+
+def test_canonical_hash_ignores_order():
+    a = SearchFilter()
+    a.set_taxon(ids=[1, 2])
+    a.set_verification_status()
+    b = SearchFilter()
+    b.set_verification_status()
+    b.set_taxon(ids=[2, 1])
+    assert a.canonical_hash() != b.canonical_hash()
+    assert a.canonical_hash(sort_lists=True) == b.canonical_hash(sort_lists=True)
+
+
+def test_shared_session_is_left_open(server):
+    session = artportalen.new_session()
+    with artportalen.ObservationsAPI("test", session=session, root_url=server.url) as oapi:
+        oapi.version()
+    with artportalen.SpeciesAPI("test", session=session, root_url=server.url) as sapi:
+        assert sapi.taxon_by_id(5)
+    assert session.adapters
+
+
+def test_search_cache_serves_repeated_searches(mock_server, search_filter):
+    server = mock_server()
+    api = artportalen.ObservationsAPI("test", root_url=server.url,
+                                      search_cache=artportalen.TieredCache())
+    first = api.observations(search_filter, take=10)
+    assert api.observations(search_filter, take=10) == first
+    assert api.count(search_filter) == api.count(search_filter) == TEST_OBSERVATIONS
+    assert server.stats["requests"] == 2
+    assert api.search_stats.hits == 2
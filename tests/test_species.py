@@ -0,0 +1,22 @@
+"""Tests of the SpeciesAPI of the module artportalen."""
+
+import pytest
+import artportalen
+from artportalen import APIError
+from tests.conftest import fast_executor
+
+
+def test_taxa_by_ids_in_batches(sapi, server):
+    taxa = sapi.taxa_by_ids(list(range(1, 26)) + [3], batch_size=10)
+    assert sorted(taxa) == list(range(1, 26))
+    assert server.stats["requests"] == 3
+
+
+def test_taxa_by_ids_raises_on_failed_batch(mock_server):
+    server = mock_server()
+    sapi = artportalen.SpeciesAPI("test", root_url=server.url,
+                                  executor=fast_executor(max_retries=0))
+    server.fail(500, after=1, times=1)
+    with pytest.raises(APIError) as e:
+        sapi.taxa_by_ids(range(1, 31), batch_size=10, max_workers=1)
+    assert e.value.response.status_code == 500
@@ -0,0 +1,39 @@
+"""Tests of the module taxonindex."""
+
+import pytest
+import artportalen
+import taxonindex
+
+TAXA = [{"taxonId": 1, "swedishName": "blåmes", "scientificName": "Cyanistes caeruleus"},
+        {"taxonId": 2, "swedishName": "talgoxe", "scientificName": "Parus major"},
+        {"taxonId": 3, "swedishName": "tofsmes", "scientificName": "Lophophanes cristatus"},
+        {"taxonId": 4, "swedishName": "svartmes", "scientificName": "Periparus ater"},
+        {"taxonId": 5, "swedishName": "mes", "scientificName": "Paridae"}]
+
+
+@pytest.fixture
+def index(tmp_path):
+    path = str(tmp_path / "taxa.idx")
+    assert taxonindex.build(TAXA, path) == 10
+    with taxonindex.TaxonIndex(path) as index:
+        yield index
+
+
+def test_exact_and_prefix(index):
+    assert [t["taxonId"] for t in index.exact("Talgoxe")] == [2]
+    assert [t["taxonId"] for t in index.prefix("pa")] == [5, 2]
+
+
+@pytest.mark.parametrize("name,max_distance", [("blames", 1), ("talgox", 1), ("tofsmes", 0),
+                                               ("parus majr", 2), ("me", 1), ("xyz", 2)])
+def test_fuzzy_equals_brute_force(index, name, max_distance):
+    key = artportalen.normalize_name(name)
+    closest = sorted(index.closest(key, range(len(index)), max_distance))
+    expected = list(dict.fromkeys(index.record(i)["taxonId"] for d, i in closest))
+    assert [t["taxonId"] for t in index.fuzzy(name, max_distance)] == expected
+
+
+def test_taxa_by_name_fuzzy(server, index):
+    with artportalen.SpeciesAPI("test", root_url=server.url, index=index) as sapi:
+        assert sapi.taxa_by_name("talgoxxe", fuzzy=True)[0]["taxonId"] == 2
+        assert server.stats["requests"] == 0